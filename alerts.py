@@ -0,0 +1,216 @@
+"""Send alerts in the background, and not too often.
+
+We used to send each alert to each of Slack and PagerDuty in turn, right
+there in the middle of a run, so one slow webhook held up the rest of the
+run (and saving our state); and a surge that lasted an hour sent the same
+alert on every poll.
+
+Instead, DISPATCHER.send() queues an alert for each place it's going,
+and worker threads send them all at once, retrying failures.  Each alert
+is about some incident, named by a key like 'zendesk'.  Once we've sent
+an alert about an incident somewhere, we hold back any more about it to
+the same place for the next `cooldown` seconds, and mention how many we
+held back in the next one we do send.  When we last alerted about each
+incident is kept in our state store, so this works across cron runs too.
+
+Call DISPATCHER.flush() before exiting, to wait for everything queued
+to be sent.
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.request
+
+import metrics
+import util
+
+# How long we hold back repeat alerts about the same incident.
+DEFAULT_COOLDOWN = 30 * 60
+
+# How many alerts we send at once.
+DEFAULT_WORKERS = 4
+
+# How many times we try to send each alert.
+SEND_ATTEMPTS = 3
+
+# How long we wait for queued alerts to be sent, when we're exiting.
+DEFAULT_FLUSH_TIMEOUT = 60
+
+# How long http_sink waits for a response.
+HTTP_SINK_TIMEOUT = 10
+
+
+def http_sink(url, timeout=HTTP_SINK_TIMEOUT):
+    """Return a sink that POSTs each alert to url, as Slack-style JSON
+    ({"channel": ..., "text": ...}), raising if that fails.
+
+    This is handy for pointing alerts at a local stand-in for Slack or
+    PagerDuty, for testing.
+    """
+    def _send(message, target):
+        body = json.dumps({'channel': target, 'text': message})
+        request = urllib.request.Request(
+            url, data=body.encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+        util.urlopen(request, timeout=timeout).read()
+    return _send
+
+
+class AlertDispatcher(object):
+    """Sends alerts to sinks on worker threads, with a cooldown.
+
+    sinks maps a sink name to a function taking (message, target), where
+    target is e.g. the Slack channel.  By default, they're 'slack' and
+    'pagerduty', via alertlib.  alertlib logs most failures rather than
+    raising them, so we can only retry those that it raises.
+
+    With workers=0, send() sends alerts right away instead of queueing
+    them.  clock is what we ask for the time (handy for replays).
+    """
+    def __init__(self, sinks=None, cooldown=DEFAULT_COOLDOWN,
+                 workers=DEFAULT_WORKERS, clock=time.time):
+        if sinks is None:
+            # We look these up when we call them, so they can be stubbed.
+            sinks = {
+                'slack': lambda message, channel: util.send_to_slack(
+                    message, channel),
+                'pagerduty': lambda message, service: util.send_to_pagerduty(
+                    message, service),
+            }
+        self.sinks = sinks
+        self.cooldown = cooldown
+        self.workers = workers
+        self.clock = clock
+        self.store = None
+        # '<incident>/<sink>:<target>' -> [last sent time, alerts held
+        # back since then].
+        self._cooldowns = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        # How many alerts are queued or being sent.
+        self._pending = 0
+        self._done = threading.Condition(self._lock)
+        self._threads = []
+
+    def set_store(self, store):
+        """Keep our cooldowns in store (a state_store.StateStore), starting
+        with those it already has.
+
+        We forget those that have run out, unless we held back alerts
+        since, which we'll still mention next time.
+        """
+        now = self.clock()
+        with self._lock:
+            self.store = store
+            saved = store.get_all('alert_cooldowns')
+            expired = [key for (key, (sent_time, held_back)) in saved.items()
+                       if now - sent_time >= self.cooldown and not held_back]
+            store.delete('alert_cooldowns', expired)
+            for key in expired:
+                del saved[key]
+            self._cooldowns.update(saved)
+
+    def send(self, incident, message, slack_channels=(),
+             pagerduty_services=()):
+        """Send message about incident to each of the given Slack channels
+        and PagerDuty services, except those we've alerted about this
+        incident within the cooldown.  Returns how many we sent (or
+        queued) it to."""
+        targets = ([('slack', channel) for channel in slack_channels] +
+                   [('pagerduty', service) for service in pagerduty_services])
+        sent = 0
+        for (sink, target) in targets:
+            full_message = self._check_cooldown(incident, sink, target,
+                                                message)
+            if full_message is None:
+                continue
+            sent += 1
+            if self.workers:
+                self._enqueue((sink, target, full_message, incident))
+            else:
+                self._send_one(sink, target, full_message, incident)
+        return sent
+
+    def _check_cooldown(self, incident, sink, target, message):
+        """Return the message to send to target, or None to hold it back,
+        and note what we did."""
+        key = '%s/%s:%s' % (incident, sink, target)
+        now = self.clock()
+        with self._lock:
+            (sent_time, held_back) = self._cooldowns.get(key, (None, 0))
+            if sent_time is not None and now - sent_time < self.cooldown:
+                value = [sent_time, held_back + 1]
+                message = None
+                metrics.inc('beep_boop_alerts_total', sink=sink,
+                            outcome='held_back')
+            else:
+                value = [now, 0]
+                if held_back:
+                    message += (
+                        '\n(We also held back %s similar alert%s since %s.)'
+                        % (held_back, '' if held_back == 1 else 's',
+                           time.strftime('%I:%M %p',
+                                         time.localtime(sent_time))))
+            self._cooldowns[key] = value
+            if self.store is not None:
+                self.store.update('alert_cooldowns', {key: value})
+        return message
+
+    def _enqueue(self, job):
+        with self._lock:
+            self._pending += 1
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work,
+                                          name='alert-sender')
+                # Don't let a hung webhook keep us from exiting; flush()
+                # is how we wait for alerts to go out.
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put(job)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._send_one(*job)
+            finally:
+                with self._lock:
+                    self._pending -= 1
+                    if not self._pending:
+                        self._done.notify_all()
+
+    def _send_one(self, sink, target, message, incident):
+        try:
+            with metrics.timed('alert_delivery'):
+                util.retry(lambda: self.sinks[sink](message, target),
+                           'sending alert to %s %s' % (sink, target),
+                           lambda exc: True, SEND_ATTEMPTS)
+        except Exception:
+            logging.exception('Failed sending %s alert to %s %s'
+                              % (incident, sink, target))
+            metrics.inc('beep_boop_alerts_total', sink=sink,
+                        outcome='failed')
+        else:
+            metrics.inc('beep_boop_alerts_total', sink=sink, outcome='sent')
+
+    def flush(self, timeout=DEFAULT_FLUSH_TIMEOUT):
+        """Wait up to timeout seconds for queued alerts to be sent.
+        Returns whether they all were."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.error('Gave up waiting for %s alert(s) to send'
+                                  % self._pending)
+                    return False
+                self._done.wait(remaining)
+        return True
+
+
+# The dispatcher everything in this process shares.
+DISPATCHER = AlertDispatcher()
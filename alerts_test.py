@@ -0,0 +1,140 @@
+"""Tests for alerts.py.  Run with
+    python -m unittest alerts_test
+"""
+
+import json
+import time
+import unittest
+import unittest.mock
+
+import alerts
+import state_store
+import util_test
+
+
+class _SlackHandler(util_test._PagesHandler):
+    """Stands in for a Slack webhook, keeping what's posted to it, and
+    failing the first server.failures posts with a 500."""
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.failures:
+            self.server.failures -= 1
+            status = 500
+        else:
+            self.server.posted.append(json.loads(body.decode('utf-8')))
+            status = 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+
+class AlertDispatcherTest(util_test.StandInServerTestCase):
+    handler_class = _SlackHandler
+
+    def setUp(self):
+        super(AlertDispatcherTest, self).setUp()
+        self.server.posted = []
+        self.server.failures = 0
+        self.store = state_store.StateStore(':memory:')
+        self.addCleanup(self.store.close)
+        self.now = 1500000 * 3600
+        self.dispatcher = self._dispatcher()
+        # Don't wait between retries.
+        patcher = unittest.mock.patch('time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _dispatcher(self):
+        dispatcher = alerts.AlertDispatcher(
+            {'slack': alerts.http_sink(self.base_url + '/slack')},
+            cooldown=600, clock=lambda: self.now)
+        dispatcher.set_store(self.store)
+        return dispatcher
+
+    def _send(self, message, channels=('#1s-and-0s',), dispatcher=None):
+        dispatcher = dispatcher or self.dispatcher
+        sent = dispatcher.send('zendesk', message, slack_channels=channels)
+        self.assertTrue(dispatcher.flush(timeout=10))
+        return sent
+
+    def test_sends(self):
+        self.assertEqual(self._send('Surge!', ('#a', '#b')), 2)
+        self.assertEqual(
+            sorted(self.server.posted, key=lambda post: post['channel']),
+            [{'channel': '#a', 'text': 'Surge!'},
+             {'channel': '#b', 'text': 'Surge!'}])
+
+    def test_retries(self):
+        self.server.failures = alerts.SEND_ATTEMPTS - 1
+        self._send('Surge!')
+        self.assertEqual(self.server.posted,
+                         [{'channel': '#1s-and-0s', 'text': 'Surge!'}])
+
+    def test_gives_up(self):
+        self.server.failures = alerts.SEND_ATTEMPTS
+        with unittest.mock.patch('logging.exception') as log:
+            self._send('Surge!')
+        self.assertEqual(self.server.posted, [])
+        self.assertEqual(log.call_count, 1)
+
+    def test_cooldown(self):
+        self._send('Surge 1')
+        self.now += 60
+        self.assertEqual(self._send('Surge 2'), 0)
+        self.now += 60
+        self.assertEqual(self._send('Surge 3'), 0)
+        # Other incidents, and other places, are on their own.
+        self.assertEqual(self._send('Surge 4', ('#other',)), 1)
+        self.assertEqual(self.dispatcher.send('github', 'Issues', ('#x',)),
+                         1)
+        self.dispatcher.flush(timeout=10)
+
+        self.now += 600 - 120
+        self._send('Surge 5')
+        self.assertEqual(
+            [post['text'] for post in self.server.posted
+             if post['channel'] == '#1s-and-0s'],
+            ['Surge 1',
+             'Surge 5\n(We also held back 2 similar alerts since %s.)'
+             % time.strftime('%I:%M %p', time.localtime(1500000 * 3600))])
+
+    def test_one_held_back(self):
+        self._send('Surge 1')
+        self.now += 1
+        self._send('Surge 2')
+        self.now += 600
+        self._send('Surge 3')
+        self.assertIn('held back 1 similar alert since',
+                      self.server.posted[-1]['text'])
+
+    def test_cooldown_is_saved(self):
+        self._send('Surge 1')
+        self.now += 60
+        self._send('Surge 2')
+        self.assertEqual(self.store.get_all('alert_cooldowns'),
+                         {'zendesk/slack:#1s-and-0s': [1500000 * 3600, 1]})
+
+        # As in the next cron run.
+        self.now += 60
+        dispatcher = self._dispatcher()
+        self.assertEqual(self._send('Surge 3', dispatcher=dispatcher), 0)
+        self.now += 600
+        self._send('Surge 4', dispatcher=dispatcher)
+        self.assertEqual(len(self.server.posted), 2)
+        self.assertIn('held back 2 similar alerts',
+                      self.server.posted[-1]['text'])
+
+    def test_expired_cooldowns_are_forgotten(self):
+        self._send('Surge', ('#a', '#b'))
+        self.now += 60
+        self._send('Surge', ('#b',))
+        self.now += 600
+        self._dispatcher()
+        # We still have to mention the one we held back from #b.
+        self.assertEqual(list(self.store.get_all('alert_cooldowns')),
+                         ['zendesk/slack:#b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""Replay our recorded ticket history, to see how well we'd spot surges.
+
+We replay the per-minute ticket history that zendesk_reports keeps (see
+minute_history.py) as though we were polling it every --poll_minutes,
+learning the hour-of-week baseline as we go, just like poll() does.  At
+each poll we ask both util.probability (the way handle_alerts does) and
+a CUSUM (see cusum.py) whether the rate has gone up.
+
+First we replay the history as it is.  We assume it's mostly normal, so
+any alerts there count as false alarms.  Then we replay it --trials more
+times, each time with a surge of --surge_ratio times the usual rate,
+lasting --surge_minutes, starting at a random time, and see how long
+each method takes to notice it, if it does at all.
+
+If you don't have a history to hand, --synthetic_days makes one up.
+"""
+
+import argparse
+import math
+import random
+import statistics
+import time
+
+import baseline
+import cusum
+import minute_history
+import util
+import zendesk_reports
+
+
+def load_counts(filename):
+    """Return the first minute of the history in filename, and a list of
+    the number of tickets in each minute from then on."""
+    history = minute_history.MinuteHistory(filename)
+    try:
+        if history.newest_minute is None:
+            raise ValueError('%s has no history in it' % filename)
+        start_minute = history.oldest_minute
+        counts = [history.count(minute, 1)
+                  for minute in range(start_minute,
+                                      history.newest_minute + 1)]
+    finally:
+        history.close()
+    return (start_minute, counts)
+
+
+def random_poisson(rng, mean):
+    """A random number from a Poisson distribution with the given mean."""
+    if mean > 30:
+        # Close enough, and Knuth's method below would be slow.
+        return max(0, int(round(rng.gauss(mean, math.sqrt(mean)))))
+    # Knuth's method.
+    limit = math.exp(-mean)
+    (count, product) = (0, rng.random())
+    while product > limit:
+        count += 1
+        product *= rng.random()
+    return count
+
+
+def synthetic_counts(days, tickets_per_hour, rng):
+    """Make up days of per-minute ticket counts, busier in the daytime
+    and on weekdays.  Returns them like load_counts."""
+    # Always the same start (a Monday), so results are repeatable.
+    start_minute = int(time.mktime((2017, 1, 2, 0, 0, 0, 0, 0, -1))) // 60
+    counts = []
+    for minute in range(start_minute, start_minute + days * 24 * 60):
+        hour = baseline.hour_of_week(minute * 60)
+        (day, hour_of_day) = divmod(hour, 24)
+        busyness = 0.3 + 0.7 * max(
+            0.0, math.sin(math.pi * (hour_of_day - 6) / 16.0))
+        if day >= 5:
+            busyness *= 0.6
+        counts.append(random_poisson(rng, tickets_per_hour * busyness / 60.0))
+    return (start_minute, counts)
+
+
+def usual_rates(start_minute, counts):
+    """Return the average number of tickets a minute in counts, for each
+    hour of the week."""
+    tickets = [0] * baseline.HOURS_PER_WEEK
+    minutes = [0] * baseline.HOURS_PER_WEEK
+    for (i, count) in enumerate(counts):
+        hour = baseline.hour_of_week((start_minute + i) * 60)
+        tickets[hour] += count
+        minutes[hour] += 1
+    return [tickets[hour] / minutes[hour] if minutes[hour] else 0.0
+            for hour in range(baseline.HOURS_PER_WEEK)]
+
+
+def add_surge(start_minute, counts, rates, start, minutes, ratio, rng):
+    """Return a copy of counts where from index start, for minutes
+    minutes, we expect ratio times the usual rates of tickets."""
+    counts = list(counts)
+    for i in range(start, min(start + minutes, len(counts))):
+        hour = baseline.hour_of_week((start_minute + i) * 60)
+        counts[i] += random_poisson(rng, rates[hour] * (ratio - 1))
+    return counts
+
+
+def _probability_alarm(count, mean):
+    """Whether handle_alerts would have sent an alert."""
+    return (mean != 0 and
+            count >= zendesk_reports.alert_thresholds(mean)[0])
+
+
+def replay(start_minute, counts, poll_minutes, warmup_minutes,
+           rate_ratio=cusum.DEFAULT_RATE_RATIO,
+           threshold=cusum.DEFAULT_THRESHOLD):
+    """Poll counts every poll_minutes, but only start checking for
+    surges after the first warmup_minutes.
+
+    Returns the indices into counts at which util.probability alarmed,
+    and those at which the CUSUM did (each as of the end of the poll).
+    """
+    ticket_baseline = baseline.HourOfWeekBaseline()
+    detector = cusum.PoissonCusum(rate_ratio=rate_ratio,
+                                  threshold=threshold)
+    probability_alarms = []
+    cusum_alarms = []
+    for end in range(poll_minutes, len(counts) + 1, poll_minutes):
+        start_time = (start_minute + end - poll_minutes) * 60
+        end_time = (start_minute + end) * 60
+        period_counts = counts[end - poll_minutes:end]
+        count = sum(period_counts)
+
+        if end > warmup_minutes:
+            (mean, _) = util.probability(
+                *ticket_baseline.past_totals(start_time, end_time),
+                errors_this_period=count,
+                time_this_period=end_time - start_time)
+            if _probability_alarm(count, mean):
+                probability_alarms.append(end)
+            if mean != 0 and detector.update('', count, mean, start_time):
+                cusum_alarms.append(end)
+
+        report_times = [start_time + i * 60
+                        for (i, minute_count) in enumerate(period_counts)
+                        for _ in range(minute_count)]
+        ticket_baseline.observe(start_time, end_time, report_times)
+    return (probability_alarms, cusum_alarms)
+
+
+def _first_alarm_delay(alarms, surge_start, surge_minutes):
+    """Minutes from surge_start to the first alarm during the surge, or
+    None if there wasn't one."""
+    for alarm in alarms:
+        if surge_start < alarm <= surge_start + surge_minutes:
+            return alarm - surge_start
+    return None
+
+
+def _summarize(name, false_alarms, days, delays):
+    detected = [delay for delay in delays if delay is not None]
+    print('%-18s %10.2f %8s/%-4s %14s'
+          % (name, false_alarms / days, len(detected), len(delays),
+             statistics.median(detected) if detected else '-'))
+
+
+def backtest(start_minute, counts, poll_minutes, warmup_minutes, trials,
+             surge_ratio, surge_minutes, rng,
+             rate_ratio=cusum.DEFAULT_RATE_RATIO,
+             threshold=cusum.DEFAULT_THRESHOLD):
+    """Print false alarms per day, and how many surges each method
+    caught and how quickly, for the history in counts."""
+    if len(counts) <= warmup_minutes + surge_minutes:
+        raise ValueError('We need more than %s minutes of history'
+                         % (warmup_minutes + surge_minutes))
+
+    (probability_alarms, cusum_alarms) = replay(
+        start_minute, counts, poll_minutes, warmup_minutes,
+        rate_ratio, threshold)
+    days = (len(counts) - warmup_minutes) / (24 * 60.0)
+
+    rates = usual_rates(start_minute, counts)
+    probability_delays = []
+    cusum_delays = []
+    for _ in range(trials):
+        surge_start = rng.randrange(warmup_minutes,
+                                    len(counts) - surge_minutes)
+        surged_counts = add_surge(start_minute, counts, rates, surge_start,
+                                  surge_minutes, surge_ratio, rng)
+        (surge_probability_alarms, surge_cusum_alarms) = replay(
+            start_minute, surged_counts, poll_minutes, warmup_minutes,
+            rate_ratio, threshold)
+        probability_delays.append(_first_alarm_delay(
+            surge_probability_alarms, surge_start, surge_minutes))
+        cusum_delays.append(_first_alarm_delay(
+            surge_cusum_alarms, surge_start, surge_minutes))
+
+    print('%.1f days of history, %s tickets a day; %sx surges for %s'
+          ' minutes' % (days, int(sum(counts[warmup_minutes:]) / days),
+                        surge_ratio, surge_minutes))
+    print('%-18s %10s %13s %14s'
+          % ('', 'false/day', 'caught', 'median delay'))
+    _summarize('util.probability', len(probability_alarms), days,
+               probability_delays)
+    _summarize('cusum', len(cusum_alarms), days, cusum_delays)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=('Measure how quickly we spot surges, and how often we'
+                     ' alert when there is none, on recorded history.'))
+    parser.add_argument('--history',
+                        default=zendesk_reports.MINUTE_HISTORY_FILE,
+                        help='The minute history to replay.')
+    parser.add_argument('--synthetic_days', type=int,
+                        help='Make up this many days of history instead.')
+    parser.add_argument('--tickets_per_hour', type=float, default=20,
+                        help='Peak rate for --synthetic_days.')
+    parser.add_argument('--poll_minutes', type=int, default=5,
+                        help='How often to pretend we poll.')
+    parser.add_argument('--warmup_days', type=int, default=7,
+                        help=('How many days of history to only learn the'
+                              ' baseline from.'))
+    parser.add_argument('--trials', type=int, default=20,
+                        help='How many surges to try.')
+    parser.add_argument('--surge_ratio', type=float, default=1.5,
+                        help='How many times the usual rate a surge is.')
+    parser.add_argument('--surge_minutes', type=int, default=240,
+                        help='How long a surge lasts.')
+    parser.add_argument('--rate_ratio', type=float,
+                        default=cusum.DEFAULT_RATE_RATIO,
+                        help='The rise the CUSUM looks for.')
+    parser.add_argument('--threshold', type=float,
+                        default=cusum.DEFAULT_THRESHOLD,
+                        help='The CUSUM threshold.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed, for repeatable results.')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.synthetic_days:
+        (start_minute, counts) = synthetic_counts(
+            args.synthetic_days, args.tickets_per_hour, rng)
+    else:
+        (start_minute, counts) = load_counts(args.history)
+    backtest(start_minute, counts, args.poll_minutes,
+             args.warmup_days * 24 * 60, args.trials, args.surge_ratio,
+             args.surge_minutes, rng, args.rate_ratio, args.threshold)
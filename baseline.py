@@ -0,0 +1,128 @@
+"""An hour-of-week model of how many reports we expect.
+
+Report rates vary a lot over the week: Monday at 9am is nothing like
+Saturday at 3am.  So we keep a separate rate for each of the 168 hours of
+the week (in local time), and use the rates for the hours a period
+overlaps to say how many reports we'd expect in it.
+
+Each hour's rate is the ratio of an exponentially decayed report count to
+an exponentially decayed amount of time observed, so old data fades out
+by itself (with a half-life of half_life seconds) and the model follows
+real changes in traffic without anyone having to reset it.  Updating or
+querying a period only touches the hours it overlaps.
+"""
+
+import math
+import time
+
+HOURS_PER_WEEK = 7 * 24
+
+# How long it takes for an observation to count half as much.  Each hour
+# of the week only gets observed once a week, so this can't be too short
+# or we won't have enough data to go on.
+DEFAULT_HALF_LIFE = 28 * 86400
+
+
+def hour_of_week(time_t):
+    """Return which hour of the week (0 = midnight Monday) time_t is in."""
+    t = time.localtime(time_t)
+    return t.tm_wday * 24 + t.tm_hour
+
+
+def _hour_slices(start_time_t, end_time_t):
+    """Split the period from start to end time at hour boundaries.
+
+    Yields (hour of week, seconds) for each piece.
+    """
+    t = start_time_t
+    while t < end_time_t:
+        next_hour = min((int(t) // 3600 + 1) * 3600, end_time_t)
+        yield (hour_of_week(t), next_hour - t)
+        t = next_hour
+
+
+class HourOfWeekBaseline(object):
+    """Decayed report counts and observed time for each hour of the week.
+
+    buckets, if given, is what to_state() returned last time.
+    """
+    def __init__(self, buckets=None, half_life=DEFAULT_HALF_LIFE):
+        self.half_life = half_life
+        # For each hour: [decayed count, decayed seconds observed, as of].
+        self.buckets = [[0.0, 0.0, 0] for _ in range(HOURS_PER_WEEK)]
+        for (hour, bucket) in (buckets or {}).items():
+            self.buckets[int(hour)] = list(bucket)
+        # The hours we've changed since we were loaded.
+        self.dirty = set()
+
+    def _decay_to(self, hour, now):
+        """Decay the given hour's data to as of now, and return it."""
+        bucket = self.buckets[hour]
+        if now > bucket[2]:
+            factor = math.pow(0.5, (now - bucket[2]) / self.half_life)
+            bucket[0] *= factor
+            bucket[1] *= factor
+            bucket[2] = now
+        return bucket
+
+    def is_empty(self):
+        return not any(bucket[1] for bucket in self.buckets)
+
+    def seed(self, rate_fn, seconds, now):
+        """Start each hour off as though we'd watched it for seconds, and
+        seen reports at rate_fn(hour) per second."""
+        for hour in range(HOURS_PER_WEEK):
+            self.buckets[hour] = [rate_fn(hour) * seconds, seconds, now]
+            self.dirty.add(hour)
+
+    def observe(self, start_time_t, end_time_t, report_times, now=None):
+        """Record that we watched from start to end time, and saw reports
+        at report_times (a list of time_t's in that period)."""
+        if now is None:
+            now = end_time_t
+        for (hour, seconds) in _hour_slices(start_time_t, end_time_t):
+            self._decay_to(hour, now)[1] += seconds
+            self.dirty.add(hour)
+        for report_time in report_times:
+            hour = hour_of_week(report_time)
+            self._decay_to(hour, now)[0] += 1
+            self.dirty.add(hour)
+
+    def _overall_rate(self):
+        """Reports per second over the whole week, for hours we have no
+        data for yet."""
+        count = sum(bucket[0] for bucket in self.buckets)
+        seconds = sum(bucket[1] for bucket in self.buckets)
+        return count / seconds if seconds else 0.0
+
+    def rate(self, hour):
+        """Our best guess at the rate of reports per second in this hour
+        of the week."""
+        # The ratio doesn't change with decay, so we don't need to decay.
+        (count, seconds, _) = self.buckets[hour]
+        if not seconds:
+            return self._overall_rate()
+        return count / seconds
+
+    def expected(self, start_time_t, end_time_t):
+        """How many reports we'd expect between start and end time."""
+        return sum(self.rate(hour) * seconds
+                   for (hour, seconds) in _hour_slices(start_time_t,
+                                                       end_time_t))
+
+    def past_totals(self, start_time_t, end_time_t):
+        """Return (past reports, past time) for util.probability to use
+        for a period from start to end time.
+
+        Any pair with the right ratio will do; we use the expected count
+        and the length of the period.
+        """
+        seconds = max(end_time_t - start_time_t, 1)
+        return (self.expected(start_time_t, end_time_t), seconds)
+
+    def to_state(self, hours=None):
+        """Return the data for the given hours (default: all of them), to
+        save and later pass back in as buckets."""
+        if hours is None:
+            hours = range(HOURS_PER_WEEK)
+        return {str(hour): self.buckets[hour] for hour in hours}
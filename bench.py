@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+
+"""Benchmark our hot paths on made-up surges, to catch slowdowns early.
+
+Most runs see a handful of tickets, so a change that makes a poll of
+100,000 tickets ten times slower, or ten times bigger, would go
+unnoticed until a real incident -- just when we need alerts quickly.
+So this runs a poll of each size in CASES against a stand-in for the
+Zendesk export API (or GitHub's issues API), served from a separate
+process so that its work doesn't count as ours, and times it through
+the real get_tickets_between, util.probability, handle_alerts and the
+rest, with alerts captured rather than sent.  A few smaller cases time
+single functions, like util.poisson_cdf and _parse_time.
+
+For each case we report how many tickets (or calls) a second we
+managed, how long the case took end to end, and the most memory we had
+allocated at once along the way (from tracemalloc, in a separate run,
+since tracing slows everything down).  Then we compare with the
+baseline we last saved with --save_baseline, and exit with an error if
+any case got more than --tolerance worse.  So:
+    ./bench.py --save_baseline      # before a change
+    ./bench.py                      # after it
+Timings vary between machines, so compare runs on the same one.
+
+Cases with more than --max_tickets tickets (by default, the 1,000,000
+ticket poll) are skipped, since they take a while.
+"""
+
+import argparse
+import array
+import bisect
+import contextlib
+import fnmatch
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import http.server
+
+import github_reports
+import replay
+import state_store
+import ticket_batch
+import util
+import zendesk_reports
+
+# Where --save_baseline saves our results, to compare later runs with.
+BASELINE_FILE = util.relative_path("bench_baseline.json")
+
+# How much worse than the baseline a case can get, as a fraction, before
+# we call it a regression.  Timings are noisy, so this can't be tiny.
+DEFAULT_TOLERANCE = 0.2
+
+# By default we skip cases with more tickets than this.
+DEFAULT_MAX_TICKETS = 100000
+
+# We time each case this many times, and keep the best.
+DEFAULT_REPEAT = 3
+
+# The polls we benchmark fetch an hour of tickets, at SURGE_RATIO times
+# the rate the baseline expects, so that they alert.
+POLL_SECONDS = 3600
+SURGE_RATIO = 5
+
+# Tags for the stand-in tickets.  We make them up from the ticket's
+# number, rather than at random, so that each run gets the same ones.
+PRODUCT_TAGS = ['web', 'mobile_app', 'video', 'exercises', 'login',
+                'coach', 'district', 'donations', 'translation', 'other']
+TAG_MIXES = {
+    # Every ticket is one we count, with one product tag.
+    'technical': lambda i: ['technical_issue',
+                            PRODUCT_TAGS[i % len(PRODUCT_TAGS)]],
+    # Half of the tickets are ones our filter drops.
+    'mixed': lambda i: (['technical_issue'] if i % 2 else ['billing']) + (
+        ['spam'] if i % 7 == 0 else []) + [
+            PRODUCT_TAGS[i % len(PRODUCT_TAGS)]],
+    # Lots of distinct tags, as when agents tag freely, which makes for a
+    # lot of series to count.
+    'many_tags': lambda i: ['technical_issue'] + [
+        'tag%d' % ((i * 7919 + k * 104729) % 5000) for k in range(8)],
+}
+
+SUBJECTS = ["Video won't play on %s", "Can't log in (order #%s)",
+            "exercise %s is broken", "My progress disappeared!! %s",
+            "Request for help with %s"]
+
+
+def _fake_ticket(i, created_at, tag_mix):
+    """The made-up ticket number i (counting from 0), with about the
+    fields the export API would give us."""
+    subject = SUBJECTS[i % len(SUBJECTS)] % (i % 1000)
+    return {
+        'id': i + 1,
+        'url': 'https://khanacademy.zendesk.com/api/v2/tickets/%d.json'
+               % (i + 1),
+        'created_at': created_at,
+        'updated_at': created_at,
+        'subject': subject,
+        'description': subject * 5,
+        'status': 'new',
+        'current_tags': TAG_MIXES[tag_mix](i),
+        'group_id': 1000 + i % 4,
+        'brand_id': 360000000 + i % 2,
+        'locale': ('en-US', 'es', 'pt-BR')[i % 3],
+    }
+
+
+class FakeExport(object):
+    """Stands in for Zendesk's incremental export API: num_tickets
+    tickets, created (and last updated) evenly between start and end
+    time, page_size to a page.
+
+    Like the real thing, a page can run over page_size so as not to end
+    partway through a second, since the next page starts at a second.
+    """
+    def __init__(self, num_tickets, start_time_t, end_time_t, page_size,
+                 tag_mix):
+        span = end_time_t - start_time_t
+        self.times = array.array('q', (start_time_t + 1 +
+                                       i * span // num_tickets
+                                       for i in range(num_tickets)))
+        self.page_size = page_size
+        self.tag_mix = tag_mix
+        self._time_strings = {}
+
+    def _time_string(self, time_t):
+        s = self._time_strings.get(time_t)
+        if s is None:
+            if len(self._time_strings) > 100000:
+                self._time_strings.clear()
+            s = self._time_strings[time_t] = time.strftime(
+                '%Y-%m-%d %H:%M:%S %z', time.localtime(time_t))
+        return s
+
+    def tickets(self, start, end):
+        """The made-up tickets start to end (as indices)."""
+        return [_fake_ticket(i, self._time_string(self.times[i]),
+                             self.tag_mix)
+                for i in range(start, end)]
+
+    def respond(self, path, headers):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+        start_time_t = int(query['start_time'][0])
+        start = bisect.bisect_left(self.times, start_time_t)
+        end = min(start + self.page_size, len(self.times))
+        while end < len(self.times) and (self.times[end] ==
+                                         self.times[end - 1]):
+            end += 1
+        end_time_t = self.times[end - 1] + 1 if end > start else start_time_t
+        body = {
+            'results': self.tickets(start, end),
+            'count': end - start,
+            'end_time': end_time_t,
+            'next_page': ('%s?start_time=%d'
+                          % (urllib.parse.urlsplit(path).path, end_time_t)
+                          if end < len(self.times) else None),
+        }
+        return (200, {}, json.dumps(body).encode('utf-8'))
+
+
+class FakeIssues(object):
+    """Stands in for GitHub's issues API: num_tickets bug reports from
+    KhanBugz, newest first, on pages of whatever size we're asked for.
+    Like GitHub, we send a 304 for a page whose ETag we're sent."""
+    def __init__(self, num_tickets, start_time_t):
+        self.num_tickets = num_tickets
+        self.start_time_t = start_time_t
+
+    def _issue(self, number):
+        exercise = 'exercise_%d' % (number % 200)
+        created_at = time.strftime(
+            '%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.start_time_t + number))
+        return {
+            'number': number,
+            'title': 'Issue with %s' % exercise,
+            'user': {'login': 'KhanBugz'},
+            'html_url': 'https://github.com/Khan/khan-exercises/issues/%d'
+                        % number,
+            'created_at': created_at,
+            # Every report is from a different user, so none get dropped
+            # as repeats.
+            'body': ('Reported from Khan:master/exercises/%s.html\n'
+                     'User hash: %d\n' % (exercise, number)),
+        }
+
+    def respond(self, path, headers):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+        page = int(query.get('page', ['1'])[0])
+        per_page = int(query.get('per_page', ['30'])[0])
+        newest = self.num_tickets - (page - 1) * per_page
+        numbers = range(newest, max(newest - per_page, 0), -1)
+        url = '%s?page=%%d&per_page=%d' % (
+            github_reports.GITHUB_ISSUES_URL, per_page)
+        if newest - per_page > 0:
+            link = '<%s>; rel="next"' % (url % (page + 1))
+        else:
+            link = '<%s>; rel="first"' % (url % 1)
+        etag = '"%d-%d"' % (page, newest)
+        if headers.get('If-None-Match') == etag:
+            return (304, {'ETag': etag}, b'')
+        return (200, {'Link': link, 'ETag': etag},
+                json.dumps([self._issue(n) for n in numbers])
+                .encode('utf-8'))
+
+
+class _FakeAPIHandler(http.server.BaseHTTPRequestHandler):
+    # Keep connections alive, like the real APIs.
+    protocol_version = 'HTTP/1.1'
+    # We send the headers and the body separately; without this, the
+    # body waits on a delayed ACK for the headers, 40ms a request.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        (status, headers, body) = self.server.api.respond(self.path,
+                                                          self.headers)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _serve(api_class, args, ports):
+    # Runs in the server process.
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             _FakeAPIHandler)
+    server.api = api_class(*args)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+@contextlib.contextmanager
+def _served(api_class, *args):
+    """Serve api_class(*args) from another process, and yield its
+    base URL."""
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve,
+                                      args=(api_class, args, ports))
+    process.daemon = True
+    process.start()
+    try:
+        yield 'http://127.0.0.1:%d' % ports.get(timeout=60)
+    finally:
+        process.terminate()
+        process.join()
+
+
+@contextlib.contextmanager
+def _measured(result, trace_memory):
+    """Time the with block into result['seconds'], and if trace_memory,
+    put the most memory it had allocated at once in
+    result['peak_bytes']."""
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        result['seconds'] = time.perf_counter() - start
+        if trace_memory:
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+def bench_poisson_cdf(measure, rounds=20):
+    """util.poisson_cdf on counts around means big and small."""
+    means = [0.1, 1, 10, 100, 1000, 10000, 100000]
+    calls = [(int(mean * (0.5 + i / 50.0)), mean)
+             for mean in means for i in range(100)]
+    with measure():
+        for _ in range(rounds):
+            for (actual, mean) in calls:
+                util.poisson_cdf(actual, mean)
+    return rounds * len(calls)
+
+
+def bench_critical_count(measure, rounds=20):
+    """util.poisson_critical_count on means big and small, as we'd see
+    them from poll to poll: mostly ones we've seen before."""
+    means = [mean * (1 + i / 10000.0)
+             for mean in (0.1, 1, 10, 100, 1000, 10000, 100000)
+             for i in range(100)]
+    with measure():
+        for _ in range(rounds):
+            for mean in means:
+                util.poisson_critical_count(mean, 0.999)
+    return rounds * len(means)
+
+
+def bench_parse_time(measure, num_tickets):
+    """zendesk_reports._parse_time on a day of times."""
+    export = FakeExport(num_tickets, 1500000000, 1500000000 + 86400, 0,
+                        'technical')
+    times = [export._time_string(time_t) for time_t in export.times]
+    with measure():
+        for s in times:
+            zendesk_reports._parse_time(s)
+    return num_tickets
+
+
+def bench_handle_alerts(measure, num_tickets):
+    """handle_alerts for a surge of num_tickets, which mostly means
+    listing them (see format_ticket_list)."""
+    end_time_t = int(time.time())
+    start_time_t = end_time_t - POLL_SECONDS
+    export = FakeExport(num_tickets, start_time_t, end_time_t, 0,
+                        'technical')
+    tickets = ticket_batch.TicketBatch(
+        export.tickets(0, num_tickets), zendesk_reports.BATCH_FIELDS)
+    with replay._captured_alerts([end_time_t]) as captured:
+        with measure():
+            zendesk_reports.handle_alerts(
+                tickets, POLL_SECONDS, num_tickets / SURGE_RATIO, 1.0,
+                start_time_t, end_time_t)
+    assert captured, 'handle_alerts should have alerted'
+    return num_tickets
+
+
+def bench_zendesk_poll(measure, num_tickets, page_size, tag_mix):
+    """A whole poll() of an hour with num_tickets tickets in it, from a
+    stand-in export API, and save_state() after it."""
+    # poll() asks for tickets up to 5 minutes ago.
+    end_time_t = int(time.time()) - 300
+    start_time_t = end_time_t - POLL_SECONDS
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with _served(FakeExport, num_tickets, start_time_t, end_time_t,
+                     page_size, tag_mix) as url, \
+                replay._patched(
+                    zendesk_reports,
+                    ZENDESK_EXPORT_URL=url + '/api/v2/exports/tickets.json',
+                    ZENDESK_PASSWORD='password',
+                    ZENDESK_EXPORT_RATE_LIMITER=util.RateLimiter(
+                        10 ** 9, burst=10 ** 9, name='zendesk'),
+                    MINUTE_HISTORY_FILE=os.path.join(tmpdir, 'history'),
+                    TICKET_FILTER=None), \
+                replay._captured_alerts([end_time_t]) as captured:
+            state = zendesk_reports.load_state(state_store.StateStore(
+                os.path.join(tmpdir, 'state.sqlite3')))
+            state['baseline'].seed(
+                lambda hour: num_tickets / SURGE_RATIO / POLL_SECONDS,
+                4 * POLL_SECONDS, start_time_t)
+            state['last_time_t'] = start_time_t
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(devnull), measure():
+                zendesk_reports.poll(state)
+                zendesk_reports.save_state(state)
+            state['history'].close()
+            state['store'].close()
+        assert captured, 'poll should have alerted'
+    finally:
+        shutil.rmtree(tmpdir)
+    return num_tickets
+
+
+def bench_github(measure, num_tickets):
+    """A poll of github_reports.GitHubSource, which has history for some
+    exercises, with num_tickets new reports."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with _served(FakeIssues, num_tickets, 1500000000) as url, \
+                replay._patched(
+                    github_reports,
+                    GITHUB_ISSUES_URL=url + '/repos/Khan/khan-exercises/'
+                                            'issues',
+                    GITHUB_RATE_LIMITER=util.RateLimiter(
+                        10 ** 9, burst=10 ** 9, name='github'),
+                    GITHUB_CACHE_DIR=tmpdir):
+            store = state_store.StateStore(':memory:')
+            store.update('github', dict(
+                {'exercise_%d' % i: {'num_errors': 10} for i in range(100)},
+                elapsed_time=86400, last_time=time.time() - 3600, max_id=0))
+            source = github_reports.GitHubSource(store)
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(devnull), \
+                    replay._captured_alerts([time.time()]), measure():
+                source.poll()
+            assert source.reports['max_id'] == num_tickets
+            # Nothing's changed, so this one gets a 304 for the first page
+            # and stops there.
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(devnull), \
+                    replay._captured_alerts([time.time()]):
+                source.poll()
+            store.close()
+        assert source.reports['max_id'] == num_tickets
+    finally:
+        shutil.rmtree(tmpdir)
+    return num_tickets
+
+
+# (name, function, keyword args).  Renaming a case loses its baseline.
+CASES = [
+    ('poisson_cdf', bench_poisson_cdf, {}),
+    ('poisson_critical_count', bench_critical_count, {}),
+    ('parse_time', bench_parse_time, {'num_tickets': 100000}),
+    ('handle_alerts-10k', bench_handle_alerts, {'num_tickets': 10000}),
+    ('zendesk-1k', bench_zendesk_poll,
+     {'num_tickets': 1000, 'page_size': 1000, 'tag_mix': 'technical'}),
+    ('zendesk-10k', bench_zendesk_poll,
+     {'num_tickets': 10000, 'page_size': 1000, 'tag_mix': 'technical'}),
+    ('zendesk-100k', bench_zendesk_poll,
+     {'num_tickets': 100000, 'page_size': 1000, 'tag_mix': 'technical'}),
+    ('zendesk-100k-page100', bench_zendesk_poll,
+     {'num_tickets': 100000, 'page_size': 100, 'tag_mix': 'technical'}),
+    ('zendesk-100k-mixed', bench_zendesk_poll,
+     {'num_tickets': 100000, 'page_size': 1000, 'tag_mix': 'mixed'}),
+    ('zendesk-100k-many_tags', bench_zendesk_poll,
+     {'num_tickets': 100000, 'page_size': 1000, 'tag_mix': 'many_tags'}),
+    ('zendesk-1m', bench_zendesk_poll,
+     {'num_tickets': 1000000, 'page_size': 1000, 'tag_mix': 'technical'}),
+    ('github-1k', bench_github, {'num_tickets': 1000}),
+    ('github-10k', bench_github, {'num_tickets': 10000}),
+]
+
+
+def run_case(function, kwargs, repeat):
+    """Run a case repeat times, and once more tracing memory.
+
+    Returns a dict of how many items (tickets, or calls) it handled, its
+    best time, and its items_per_second and peak_bytes.
+    """
+    result = {}
+    best = None
+    for _ in range(repeat):
+        timing = {}
+        result['items'] = function(
+            lambda: _measured(timing, False), **kwargs)
+        if best is None or timing['seconds'] < best:
+            best = timing['seconds']
+    function(lambda: _measured(result, True), **kwargs)
+    result['seconds'] = best
+    result['items_per_second'] = result['items'] / best
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """Return a list of what got more than tolerance worse in result
+    than in baseline (e.g. ["peak memory +35%"]).
+
+    Throughput and latency are the same thing for a fixed number of
+    items, so we only check the one.
+    """
+    regressions = []
+    if (result['items_per_second'] <
+            baseline['items_per_second'] * (1 - tolerance)):
+        regressions.append('throughput %+.0f%%' % (
+            100.0 * (result['items_per_second'] /
+                     baseline['items_per_second'] - 1)))
+    if result['peak_bytes'] > baseline['peak_bytes'] * (1 + tolerance):
+        regressions.append('peak memory %+.0f%%' % (
+            100.0 * (result['peak_bytes'] / baseline['peak_bytes'] - 1)))
+    return regressions
+
+
+def _change(value, baseline_value):
+    if not baseline_value:
+        return ''
+    return ' (%+.0f%%)' % (100.0 * (value / baseline_value - 1))
+
+
+def main(patterns, max_tickets, repeat, baseline_file, save_baseline,
+         tolerance):
+    try:
+        with open(baseline_file) as f:
+            baseline = json.load(f)['cases']
+    except IOError:
+        baseline = {}
+
+    # handle_alerts logs each alert it would send.
+    logging.disable(logging.WARNING)
+
+    results = {}
+    regressed = []
+    print('%-24s %10s %15s %20s %18s'
+          % ('case', 'items', 'seconds', 'items/second', 'peak MB'))
+    for (name, function, kwargs) in CASES:
+        if patterns and not any(fnmatch.fnmatch(name, pattern)
+                                for pattern in patterns):
+            continue
+        if kwargs.get('num_tickets', 0) > max_tickets:
+            continue
+        result = results[name] = run_case(function, kwargs, repeat)
+        old = baseline.get(name, {})
+        regressions = compare(result, old, tolerance) if old else []
+        print('%-24s %10s %15s %20s %18s %s'
+              % (name, util.thousand_commas(result['items']),
+                 '%.3f%s' % (result['seconds'],
+                             _change(result['seconds'],
+                                     old.get('seconds'))),
+                 '%.0f%s' % (result['items_per_second'],
+                             _change(result['items_per_second'],
+                                     old.get('items_per_second'))),
+                 '%.1f%s' % (result['peak_bytes'] / 1e6,
+                             _change(result['peak_bytes'],
+                                     old.get('peak_bytes'))),
+                 'REGRESSED: ' + ', '.join(regressions)
+                 if regressions else ''))
+        if regressions:
+            regressed.append(name)
+
+    if save_baseline:
+        baseline.update(results)
+        util.atomic_write(baseline_file, json.dumps(
+            {'python': sys.version.split()[0], 'cases': baseline},
+            indent=2, sort_keys=True))
+        print('Saved these results as the baseline in %s' % baseline_file)
+    elif not baseline:
+        print('No baseline to compare with; save one with --save_baseline.')
+
+    if regressed:
+        print('%s case(s) got more than %.0f%% worse than the baseline: %s'
+              % (len(regressed), tolerance * 100, ', '.join(regressed)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=('Benchmark polling (and friends) on made-up surges,'
+                     ' against stand-in APIs, and compare with a'
+                     ' baseline.'))
+    parser.add_argument('--cases', action='append', default=[],
+                        help=('Only run cases matching this glob, e.g.'
+                              ' "zendesk-*"; may be repeated.'))
+    parser.add_argument('--max_tickets', type=int,
+                        default=DEFAULT_MAX_TICKETS,
+                        help='Skip cases with more tickets than this.')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='Time each case this many times; keep the best.')
+    parser.add_argument('--baseline', default=BASELINE_FILE,
+                        help='Where to keep the results to compare with.')
+    parser.add_argument('--save_baseline', action='store_true',
+                        help='Make these results the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=('How much worse (as a fraction) a case can get'
+                              ' before we call it a regression.'))
+    args = parser.parse_args()
+
+    sys.exit(main(args.cases, args.max_tickets, args.repeat, args.baseline,
+                  args.save_baseline, args.tolerance))
@@ -0,0 +1,113 @@
+"""Run polling jobs on a schedule in one long-lived process.
+
+Running from cron means every poll pays for starting python, importing
+everything, loading our state and opening new connections.  Instead, a
+daemon keeps all that around and polls as often as we like.
+
+Jobs run on a fixed schedule that doesn't drift: each run is planned for
+exactly `interval` seconds after the last planned run, however long the
+runs themselves take.  If a run takes so long that we miss planned runs,
+we skip them rather than running several back to back.  By default jobs
+run one at a time; given an executor, they run at once, so a slow job
+doesn't hold up the others.
+"""
+
+import concurrent.futures
+import logging
+import signal
+import threading
+import time
+
+
+class Job(object):
+    """A function to call every interval seconds."""
+    def __init__(self, name, interval, fn):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.next_run = None
+        # The future for our run in progress, if we run on an executor.
+        self.running = None
+
+    def schedule_after(self, now):
+        """Plan our next run for the first tick of our schedule after now."""
+        if self.next_run is None:
+            self.next_run = now
+        else:
+            self.next_run += self.interval
+            if self.next_run < now:
+                missed = int((now - self.next_run) // self.interval) + 1
+                logging.warning('%s: skipping %s missed run(s)'
+                                % (self.name, missed))
+                self.next_run += missed * self.interval
+
+
+def _handle_signals(stop):
+    def _stop(signum, frame):
+        logging.warning('Got signal %s, shutting down' % signum)
+        stop.set()
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+
+def _run_job(job):
+    try:
+        job.fn()
+    except Exception:
+        logging.exception('%s failed' % job.name)
+
+
+def run(jobs, checkpoint_fn=None, checkpoint_interval=600, stop=None,
+        executor=None):
+    """Run jobs on their schedules until we're told to stop.
+
+    checkpoint_fn, if given, is called every checkpoint_interval seconds
+    and once more when we stop (after any jobs still running finish), to
+    save our state.  We stop when the threading.Event stop is set; by
+    default, that's on SIGTERM or SIGINT.  A job raising an exception is
+    logged, and doesn't stop the others.
+
+    If executor (a concurrent.futures.Executor) is given, we run jobs on
+    it instead of one at a time.  A job still running when it's next due
+    skips that run.  checkpoint_fn still runs on our thread, so it may
+    run at the same time as jobs.
+    """
+    if stop is None:
+        stop = threading.Event()
+        _handle_signals(stop)
+
+    start = time.monotonic()
+    for job in jobs:
+        job.schedule_after(start)
+    next_checkpoint = start + checkpoint_interval
+
+    try:
+        while not stop.is_set():
+            now = time.monotonic()
+            for job in sorted(jobs, key=lambda job: job.next_run):
+                if job.next_run > now or stop.is_set():
+                    continue
+                if executor is None:
+                    _run_job(job)
+                elif job.running is not None and not job.running.done():
+                    logging.warning('%s: still running, skipping a run'
+                                    % job.name)
+                else:
+                    job.running = executor.submit(_run_job, job)
+                job.schedule_after(time.monotonic())
+
+            now = time.monotonic()
+            if checkpoint_fn is not None and now >= next_checkpoint:
+                checkpoint_fn()
+                next_checkpoint += checkpoint_interval
+                if next_checkpoint < now:
+                    next_checkpoint = now + checkpoint_interval
+
+            wake_time = min([job.next_run for job in jobs] +
+                            [next_checkpoint])
+            stop.wait(max(0, wake_time - time.monotonic()))
+    finally:
+        concurrent.futures.wait([job.running for job in jobs
+                                 if job.running is not None])
+        if checkpoint_fn is not None:
+            checkpoint_fn()
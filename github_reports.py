@@ -4,17 +4,21 @@
 # when it was originally taken out of production but confirmed in #support
 # chat room today. Leaving here for history / code re-use. -mroth 8/19/2015.
 
+import argparse
 import bisect
-import copy
+import hashlib
 import http.client
 import iso8601
 import json
+import os
 import re
 import socket
-import time
 import urllib.error
 import urllib.request
 
+import metrics
+import monitor
+import sources
 import util
 
 # Non-exercise keys in the dictionary
@@ -26,67 +30,209 @@ SPECIAL_VALUES = ["elapsed_time", "max_id", "last_time", "time_this_period"]
 PREPHANTOM_HASH = 1840534623
 # Regex to use for getting the user hash from the github report.
 # Used in association with rate-limiting of bug reports.
-USER_HASH_REGEX = re.compile("User hash: (\d+)")
+USER_HASH_REGEX = re.compile(r"User hash: (\d+)")
 # Frequency (seconds) with which one user can file bug reports
 # without some being ignored
 WAIT_PERIOD = 2 * 60
 
+# How sure we need to be that an exercise's report rate is elevated, and
+# how many reports we need to see, before we tell #support.
+ALERT_PROBABILITY = 0.997
+MIN_REPORTS_TO_ALERT = 2
+
+GITHUB_ISSUES_URL = 'https://api.github.com/repos/Khan/khan-exercises/issues'
+
+# Where we keep the last copy of each page of issues we fetched, so that
+# we can ask GitHub to only send it again if it's changed.  (GitHub
+# doesn't count those requests against our quota when it hasn't.)
+GITHUB_CACHE_DIR = util.relative_path("github_cache")
+
+# Where we used to keep our state as JSON, before we had a state_store.
+OLD_EXERCISE_REPORTS_FILE = util.relative_path("exercise_reports")
+
+# Labels we add to all our metrics (see metrics.py), so that they don't
+# clash with zendesk_reports' in the textfile collector.
+METRICS_LABELS = {'script': 'github_reports'}
+
+# Unauthenticated requests to the GitHub API get 60 an hour.  GitHub
+# tells us how many we have left, so we can afford to burst.
+GITHUB_RATE_LIMITER = util.RateLimiter(
+    60, 3600, burst=10,
+    state_file=util.relative_path("github_rate_limit.json"), name='github')
 
-def get_errors(old_reports):
-    stats = {}
-    issues = []
 
-    # The issue at which we should stop looking for more
-    # -1 indicates we shouldn't do more than 1 page
-    last_issue = old_reports.get("max_id", -1)
+def _link_rels(link):
+    """The rels in a Link header, like '<url>; rel="next", <url>;
+    rel="last"'.  GitHub leaves the header out when there's only one
+    page, so link may be None."""
+    rels = set()
+    for rel in re.findall(r'<[^>]*>[^,]*?;\s*rel="([^"]*)"', link or ''):
+        rels.update(rel.split())
+    return rels
 
-    # Track the number of the first issue we find this time
-    first_issue = [last_issue]  # Lets us modify this from within get_issues
+
+def _cache_filename(url):
+    return os.path.join(GITHUB_CACHE_DIR,
+                        hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+def _fetch_issues_page(url):
+    """Fetch a page of issues, unless it hasn't changed since we last
+    fetched it, in which case we use our cached copy.
+
+    Returns a dict with the page's "body" and "link" header, "changed"
+    (whether it was new to us), and "newest_report", the number of its
+    newest report from KhanBugz, if any.
+    """
+    try:
+        with open(_cache_filename(url)) as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        cached = None
+
+    request = urllib.request.Request(url)
+    if cached is not None:
+        if cached["etag"]:
+            request.add_header("If-None-Match", cached["etag"])
+        if cached["last_modified"]:
+            request.add_header("If-Modified-Since", cached["last_modified"])
+    response = util.urlopen(request, timeout=60,
+                            rate_limiter=GITHUB_RATE_LIMITER)
+    metrics.inc('beep_boop_pages_fetched_total', source='github')
+    body = response.read()
+    if response.status == 304:
+        if cached is None:
+            raise ValueError("Got a 304 for %s, which we haven't cached"
+                             % url)
+        cached["changed"] = False
+        return cached
+
+    page_issues = json.loads(body)
+    metrics.inc('beep_boop_tickets_fetched_total', len(page_issues),
+                source='github')
+    reports = [issue["number"] for issue in page_issues
+               if issue["user"]["login"] == "KhanBugz"]
+    cached = {"etag": response.headers.get("ETag"),
+              "last_modified": response.headers.get("Last-Modified"),
+              "link": response.headers.get("Link"),
+              "newest_report": max(reports) if reports else None,
+              "body": body.decode('utf-8')}
+    if not os.path.isdir(GITHUB_CACHE_DIR):
+        os.makedirs(GITHUB_CACHE_DIR)
+    util.atomic_write(_cache_filename(url), json.dumps(cached))
+    cached["changed"] = True
+    return cached
+
+
+def fetch_new_issues(last_issue):
+    """Return the bug reports from KhanBugz numbered after last_issue,
+    newest first, and the number of the newest of them (or last_issue,
+    if there are none).
+
+    If last_issue is -1, we only look at the first page.
+    """
+    issues = []
+    first_issue = last_issue
 
     urlfetch_errors = (socket.error, urllib.error.HTTPError,
                        http.client.HTTPException)
 
-    def get_issues(page):
-        url = ("https://api.github.com/repos/Khan/khan-exercises/issues"
-               "?page=%d&per_page=100" % page)
-        issue_data = util.retry(
-            lambda: urllib.request.urlopen(url, timeout=60),
-            'fetching khan-exercises issues',
-            lambda exc: isinstance(exc, urlfetch_errors))
+    page = 1
+    while True:
+        url = "%s?page=%d&per_page=100" % (GITHUB_ISSUES_URL, page)
+        cached = util.retry(lambda: _fetch_issues_page(url),
+                            'fetching khan-exercises issues',
+                            lambda exc: isinstance(exc, urlfetch_errors))
 
         # This flag is False if we should continue to the next page of
         # issues and True if we should stop looking at more pages.
         done = False
-        for issue in json.loads(issue_data.read()):
-            if issue["user"]["login"] == "KhanBugz":
-                if last_issue == -1:
-                    # If we have no data so far, only go one page.
-                    done = True
-
-                if issue["number"] > last_issue:
-                    first_issue[0] = max(first_issue[0], issue["number"])
-                    issues.append(issue)
-                else:
-                    # If we've come to an issue we already saw,
-                    # don't continue to further pages or issues
-                    done = True
-                    break
-
-        if ((re.findall(
-                r'<(.*?)>; rel="(.*?)"',
-                issue_data.info().get("Link"))[0][1] == "next") and
-                not done):
-            get_issues(page + 1)
-
-    get_issues(1)
-    first_issue = first_issue[0]
-
-    for issue in issues:
-        regex_matches = re.findall(
-            r'Khan:master/exercises/(.+?)\.html', issue["body"])
-        if len(regex_matches) == 0:
+        newest_report = cached["newest_report"]
+        if (not cached["changed"] and newest_report is not None and
+                newest_report <= last_issue):
+            # We've seen every report on this page before, so we'd stop
+            # at the first; no need to even look.
+            done = True
+        else:
+            for issue in json.loads(cached["body"]):
+                if issue["user"]["login"] == "KhanBugz":
+                    if last_issue == -1:
+                        # If we have no data so far, only go one page.
+                        done = True
+
+                    if issue["number"] > last_issue:
+                        first_issue = max(first_issue, issue["number"])
+                        issues.append(issue)
+                    else:
+                        # If we've come to an issue we already saw,
+                        # don't continue to further pages or issues
+                        done = True
+                        break
+
+        if done or 'next' not in _link_rels(cached["link"]):
+            break
+        page += 1
+    return (issues, first_issue)
+
+
+def generate_slack_links(links):
+    """Given a list of links, generate a string that can be inserted into
+    a Slack message with them."""
+    return ", ".join("<%s|%d>" % (el, idx + 1) for idx, el in enumerate(links))
+
+
+def _exercise(issue):
+    """The exercise a bug report is about, or None if we can't tell."""
+    regex_matches = re.findall(
+        r'Khan:master/exercises/(.+?)\.html', issue["body"])
+    return regex_matches[0] if regex_matches else None
+
+
+class GitHubSource(sources.CountingSource):
+    """Bug reports about khan-exercises, counted by exercise."""
+    name = 'github'
+    cursor_key = 'max_id'
+    slack_channels = ("#support",)
+    alert_probability = ALERT_PROBABILITY
+    min_reports_to_alert = MIN_REPORTS_TO_ALERT
+
+    def load(self):
+        """Return our saved reports.
+
+        The first time, we import them from the JSON file we used to keep.
+        """
+        ex_reports = self.store.get_all('github')
+        if not ex_reports:
+            try:
+                with open(OLD_EXERCISE_REPORTS_FILE) as f:
+                    ex_reports = json.load(f)
+                for ex in ex_reports:
+                    if ex not in SPECIAL_VALUES:
+                        ex_reports[ex] = {"num_errors":
+                                          ex_reports[ex]["num_errors"]}
+                self.store.update('github', ex_reports)
+            except IOError:
+                ex_reports = {"elapsed_time": 1,  # Filler value
+                              "max_id": -1,
+                              "last_time": 0}
+        # The JSON file may have this too, which we don't need.
+        ex_reports.pop("time_this_period", None)
+        return ex_reports
+
+    def fetch_since(self, cursor):
+        with metrics.timed('github_fetch'):
+            (issues, first_issue) = fetch_new_issues(cursor)
+        GITHUB_RATE_LIMITER.save()
+        # user hash -> when they filed the reports we've counted, sorted,
+        # for each exercise; for is_wanted.
+        self._report_times = {}
+        return (issues, first_issue)
+
+    def is_wanted(self, issue):
+        exercise = _exercise(issue)
+        if exercise is None:
             print(issue)
-            continue
+            return False
 
         user_hash = re.search(USER_HASH_REGEX, issue["body"])
         try:
@@ -97,124 +243,52 @@ def get_errors(old_reports):
         # We can't distinguish prephantom users from each other,
         # nor can we distinguish users with no hash. Put them all in the same,
         # non rate-limited bucket.
-        if user_hash == PREPHANTOM_HASH:
+        if user_hash == str(PREPHANTOM_HASH):
             user_hash = ""
 
         created_at = iso8601.parse_date(issue["created_at"])
-        exercise = regex_matches[0]
-
-        if exercise not in stats:
-            stats[exercise] = {}
-            stats[exercise]["href"] = [issue["html_url"]]
-
-            stats[exercise]["users"] = {user_hash: [created_at]}
-        else:
-            old_times = stats[exercise]["users"].get(user_hash, [])
-            # Rate-limit number of bugs we count -- if someone submits
-            # two bugs in a very short timeframe, only count 1 -- the rest
-            # are probably bogus
-            if (not user_hash or not old_times or
-               abs(created_at - old_times[-1]).total_seconds > WAIT_PERIOD):
-                # We keep this list sorted so that we can more quickly
-                # look at the frequency with which a user submits messages
-                bisect.insort(old_times, created_at)
-                stats[exercise]["href"].append(issue["html_url"])
-            else:
-                print("Ignoring %s because user %s has posted too frequently"
-                      % (issue["html_url"], user_hash))
-
-            stats[exercise]["users"][user_hash] = old_times
-
-    for ex in old_reports:
-        if ex not in SPECIAL_VALUES:
-            old_reports[ex]["this_period"] = 0
-
-    for ex in stats:
-        if ex not in old_reports:
-            old_reports[ex] = {"num_errors": 0,
-                               "this_period": 0}
-
-        users = stats[ex]["users"]
-        issue_count = sum([len(users[u]) for u in users])
-
-        old_reports[ex]["num_errors"] += issue_count
-        old_reports[ex]["this_period"] = issue_count
-        old_reports[ex]["href"] = stats[ex]["href"]
-
-    cur_time = time.time()
-
-    this_period = cur_time - old_reports["last_time"]
-
-    old_reports["max_id"] = first_issue
-    old_reports["elapsed_time"] += this_period
-    old_reports["last_time"] = cur_time
-    old_reports["time_this_period"] = this_period
-    return old_reports
-
-
-def generate_slack_links(links):
-    """Given a list of links, generate a string that can be inserted into
-    a Slack message with them."""
-    return ", ".join("<%s|%d>" % (el, idx + 1) for idx, el in enumerate(links))
-
-
-def main():
-    try:
-        exercise_file = open(util.relative_path("exercise_reports"), 'r+')
-        ex_reports = json.loads(exercise_file.read())
-    except IOError:
-        exercise_file = open(util.relative_path("exercise_reports"), 'w')
-        ex_reports = {"elapsed_time": 1,  # Filler value
-                      "max_id": -1,
-                      "last_time": 0}
-
-    new_reports = get_errors(copy.deepcopy(ex_reports))
-
-    period_len = new_reports["time_this_period"]
-
-    for ex in new_reports:
-        if ex in SPECIAL_VALUES:
-            continue
-
-        if ex in ex_reports and ex_reports[ex]["num_errors"] > 0:
-            errors_this_period = new_reports[ex]["this_period"]
-
-            mean, probability = util.probability(ex_reports[ex]["num_errors"],
-                                                 ex_reports["elapsed_time"],
-                                                 errors_this_period,
-                                                 period_len)
-
-            print("%s] TOTAL %s/%ss; %s-: %s/%ss; m=%.3f p=%.3f"
-                  % (time.strftime("%Y-%m-%d %H:%M:%S %Z"),
-                     ex_reports[ex]["num_errors"], ex_reports["elapsed_time"],
-                     ex_reports["last_time"],
-                     errors_this_period, period_len,
-                     mean, probability))
-
-            if (probability > 0.997 and errors_this_period > 1):
-                util.send_to_slack(
-                    "*Elevated exercise bug report rate in exercise `%s`\n"
-                    "Reports: %s.  We saw %s in the last %s minutes,"
-                    " while the mean indicates we should see around %s."
-                    " *Probability that this is abnormally elevated: %.4f.*"
-                    % (ex,
-                       generate_slack_links(new_reports[ex]["href"]),
-                       util.thousand_commas(errors_this_period),
-                       util.thousand_commas(int(period_len / 60)),
-                       util.thousand_commas(round(mean, 2)),
-                       probability),
-                    channel="#support")
-        if "href" in new_reports[ex]:
-            del new_reports[ex]["href"]  # don't need to keep the links around
-
-    del new_reports["time_this_period"]
-    # Overwrite with new contents
-    exercise_file.seek(0)
-    exercise_file.truncate()
-    exercise_file.write(json.dumps(new_reports))
-
-    exercise_file.close()
+        old_times = self._report_times.setdefault(exercise, {}).setdefault(
+            user_hash, [])
+        # Rate-limit number of bugs we count -- if someone submits
+        # two bugs in a very short timeframe, only count 1 -- the rest
+        # are probably bogus
+        if (not user_hash or not old_times or
+                abs(created_at - old_times[-1]).total_seconds() >
+                WAIT_PERIOD):
+            # We keep this list sorted so that we can more quickly
+            # look at the frequency with which a user submits messages
+            bisect.insort(old_times, created_at)
+            return True
+        print("Ignoring %s because user %s has posted too frequently"
+              % (issue["html_url"], user_hash))
+        return False
+
+    def series_keys(self, issue):
+        return [_exercise(issue)]
+
+    def alert_heading(self, ex, issues):
+        return ("*Elevated exercise bug report rate in exercise `%s`\n"
+                "Reports: %s.  "
+                % (ex, generate_slack_links([issue["html_url"]
+                                             for issue in issues])))
+
+
+def main(metrics_file=None):
+    monitor.main(['github'], metrics_file=metrics_file,
+                 metrics_labels=METRICS_LABELS)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description='Script to predict abnormal exercise bug reports.')
+    parser.add_argument('--record_dir',
+                        help=('Save everything GitHub sends us in this '
+                              'directory, for replay.py.'))
+    parser.add_argument('--metrics_file',
+                        help=('Write our metrics to this file, for the '
+                              'Prometheus textfile collector.'))
+    args = parser.parse_args()
+
+    if args.record_dir:
+        util.record_responses(args.record_dir)
+    main(args.metrics_file)
@@ -0,0 +1,184 @@
+"""Tests for github_reports.py.  Run with
+    python -m unittest github_reports_test
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+import urllib.parse
+
+import github_reports
+import state_store
+import util
+import util_test
+
+
+class _IssuesHandler(util_test._PagesHandler):
+    """Stands in for GitHub's issues API, serving the server's issues,
+    newest first, with an ETag for each page, and a 304 if we already
+    have it.  Like GitHub, we link to the other pages (the previous one
+    first), and not at all if there's only the one page."""
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        page = int(query['page'][0])
+        per_page = int(query['per_page'][0])
+        issues = self.server.issues[(page - 1) * per_page:page * per_page]
+        body = json.dumps(issues).encode('utf-8')
+        etag = '"%s"' % hash(body)
+        last_page = max(1, (len(self.server.issues) - 1) // per_page + 1)
+        links = []
+        if page > 1:
+            links.append((page - 1, 'prev'))
+        if page < last_page:
+            links.extend([(page + 1, 'next'), (last_page, 'last')])
+        if page > 1:
+            links.append((1, 'first'))
+        link = ', '.join('</issues?page=%d>; rel="%s"' % link
+                         for link in links)
+
+        if self.headers.get('If-None-Match') == etag:
+            self.server.requests.append((page, 304))
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.server.requests.append((page, 200))
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        if link:
+            self.send_header('Link', link)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FetchNewIssuesTest(util_test.StandInServerTestCase):
+    handler_class = _IssuesHandler
+
+    def setUp(self):
+        super(FetchNewIssuesTest, self).setUp()
+        self.server.issues = []
+        self.num_issues = 0
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        patcher = unittest.mock.patch.multiple(
+            github_reports,
+            GITHUB_ISSUES_URL=self.base_url + '/issues',
+            GITHUB_CACHE_DIR=cache_dir,
+            GITHUB_RATE_LIMITER=util.RateLimiter(1000, 1, burst=1000),
+            OLD_EXERCISE_REPORTS_FILE=os.path.join(cache_dir, 'none'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _file_issues(self, count, login='KhanBugz'):
+        for _ in range(count):
+            self.num_issues += 1
+            self.server.issues.insert(0, {
+                'number': self.num_issues,
+                'user': {'login': login},
+                'html_url': 'https://github.com/issues/%d' % self.num_issues,
+                'created_at': '2017-01-01T00:00:00Z',
+                'body': ('Khan:master/exercises/addition.html\n'
+                         'User hash: %d' % self.num_issues)})
+
+    def _fetch(self, last_issue):
+        """fetch_new_issues(last_issue), with just the issues' numbers.
+        Clears the server's record of requests first."""
+        del self.server.requests[:]
+        (issues, first_issue) = github_reports.fetch_new_issues(last_issue)
+        return ([issue['number'] for issue in issues], first_issue)
+
+    def test_first_time_only_looks_at_the_first_page(self):
+        self._file_issues(250)
+        self.assertEqual(self._fetch(-1),
+                         (list(range(250, 150, -1)), 250))
+        self.assertEqual(self.server.requests, [(1, 200)])
+
+    def test_pages_until_it_finds_an_old_issue(self):
+        self._file_issues(50)
+        self._file_issues(220)
+        self.assertEqual(self._fetch(50), (list(range(270, 50, -1)), 270))
+        self.assertEqual(self.server.requests, [(1, 200), (2, 200), (3, 200)])
+
+    def test_unchanged_page_is_not_sent_again(self):
+        self._file_issues(120)
+        self._fetch(-1)
+        self.assertEqual(self._fetch(120), ([], 120))
+        self.assertEqual(self.server.requests, [(1, 304)])
+
+    def test_unchanged_page_with_new_issues_on_it(self):
+        # If a page hasn't changed but has issues we haven't seen (say we
+        # crashed before saving), we still go through it.
+        self._file_issues(30)
+        self._fetch(-1)
+        self.assertEqual(self._fetch(25), ([30, 29, 28, 27, 26], 30))
+        self.assertEqual(self.server.requests, [(1, 304)])
+
+    def test_changed_page_is_sent_again(self):
+        self._file_issues(120)
+        self._fetch(-1)
+        self._file_issues(3)
+        self.assertEqual(self._fetch(120), ([123, 122, 121], 123))
+        self.assertEqual(self.server.requests, [(1, 200)])
+
+    def test_one_page(self):
+        # So there's no Link header, the first time or the next.
+        self._file_issues(30)
+        self.assertEqual(self._fetch(-1), (list(range(30, 0, -1)), 30))
+        self._file_issues(2)
+        self.assertEqual(self._fetch(0), (list(range(32, 0, -1)), 32))
+        self.assertEqual(self._fetch(0), (list(range(32, 0, -1)), 32))
+        self.assertEqual(self.server.requests, [(1, 304)])
+
+    def test_pages_past_prev_links(self):
+        # Page 2 links to page 1 before page 3.
+        self._file_issues(350)
+        self.assertEqual(self._fetch(10), (list(range(350, 10, -1)), 350))
+        self.assertEqual(self.server.requests,
+                         [(1, 200), (2, 200), (3, 200), (4, 200)])
+
+    def test_link_rels(self):
+        self.assertEqual(github_reports._link_rels(None), set())
+        self.assertEqual(github_reports._link_rels(''), set())
+        self.assertEqual(github_reports._link_rels(
+            '<https://api.github.com/issues?page=1>; rel="prev", '
+            '<https://api.github.com/issues?page=3>; rel="next", '
+            '<https://api.github.com/issues?page=9>; rel="last", '
+            '<https://api.github.com/issues?page=1>; rel="first"'),
+            {'prev', 'next', 'last', 'first'})
+        self.assertEqual(github_reports._link_rels(
+            '<https://x/issues?page=2&a=b,c>; title="more"; rel="next last"'),
+            {'next', 'last'})
+
+    def test_ignores_other_users(self):
+        self._file_issues(5)
+        self._file_issues(5, login='someone')
+        self._file_issues(5)
+        self.assertEqual(self._fetch(0),
+                         ([15, 14, 13, 12, 11, 5, 4, 3, 2, 1], 15))
+
+    def test_polls(self):
+        store = state_store.StateStore(':memory:')
+        self.addCleanup(store.close)
+        self._file_issues(40)
+        source = github_reports.GitHubSource(store)
+        with unittest.mock.patch('sys.stdout'), \
+                unittest.mock.patch('alerts.DISPATCHER.send') as send:
+            source.poll()
+            self._file_issues(10)
+            source.poll()
+            source.poll()
+        self.assertEqual(store.get_all('github')['max_id'], 50)
+        self.assertEqual(store.get_all('github')['addition'],
+                         {'num_errors': 50})
+        self.assertEqual(self.server.requests, [(1, 200), (1, 200), (1, 304)])
+        # 10 in no time at all is a lot.
+        self.assertEqual([call[0][0] for call in send.call_args_list],
+                         ['github:addition'])
+
+
+if __name__ == '__main__':
+    unittest.main()
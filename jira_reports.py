@@ -0,0 +1,114 @@
+"""Jira, as a source for monitor.py.
+
+This is a start: it counts the bugs filed in JIRA_PROJECT each poll, in
+all and by component, and alerts on any of those that's coming in faster
+than usual (see sources.CountingSource).  Try it with
+    ./monitor.py --sources jira
+once jira.cfg holds "<email>:<API token>" for a Jira user who can see
+the project.
+
+We fetch issues with the search API, by when they were created.  JQL
+only knows times to the minute, so each poll asks for whole minutes,
+from where the last one stopped up to JIRA_LAG_SECONDS ago, in local
+time, which needs to be the Jira user's time zone too.
+"""
+
+import base64
+import http.client
+import json
+import socket
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import metrics
+import sources
+import util
+
+JIRA_URL = 'https://khanacademy.atlassian.net'
+JIRA_SEARCH_PATH = '/rest/api/2/search'
+JIRA_PROJECT = 'SUPPORT'
+JIRA_CREDENTIALS_FILE = util.relative_path("jira.cfg")
+JIRA_CREDENTIALS = None     # set lazily
+
+# Issues can take a little while to show up in search.
+JIRA_LAG_SECONDS = 120
+
+# The search API gives us up to this many issues a page.
+JIRA_PAGE_SIZE = 100
+
+# Jira Cloud's quotas aren't published; this is well under what it
+# allows in practice.
+JIRA_RATE_LIMITER = util.RateLimiter(60, 60, burst=10, name='jira')
+
+
+def _jql_time(time_t):
+    return time.strftime('%Y/%m/%d %H:%M', time.localtime(time_t))
+
+
+def search(jql, start_at=0):
+    """Return a page of the issues matching jql, from the search API."""
+    global JIRA_CREDENTIALS
+    if JIRA_CREDENTIALS is None:
+        with open(JIRA_CREDENTIALS_FILE) as f:
+            JIRA_CREDENTIALS = f.read().strip()
+
+    url = '%s%s?%s' % (JIRA_URL, JIRA_SEARCH_PATH, urllib.parse.urlencode({
+        'jql': jql, 'startAt': start_at, 'maxResults': JIRA_PAGE_SIZE,
+        'fields': 'created,issuetype,components'}))
+    request = urllib.request.Request(url)
+    request.add_unredirected_header(
+        'Authorization', 'Basic %s' % base64.standard_b64encode(
+            JIRA_CREDENTIALS.encode('utf-8')).decode('utf-8'))
+
+    return json.load(util.retry(
+        lambda: util.urlopen(request, timeout=60,
+                             rate_limiter=JIRA_RATE_LIMITER),
+        'searching jira',
+        lambda exc: isinstance(exc, (socket.error, urllib.error.HTTPError,
+                                     http.client.HTTPException))))
+
+
+class JiraSource(sources.CountingSource):
+    """Bugs filed in JIRA_PROJECT, in all and by component.  Our cursor
+    is the time_t (on a minute) up to which we've fetched."""
+    name = 'jira'
+    slack_channels = ('#infrastructure-sre',)
+
+    def fetch_since(self, cursor):
+        until = (int(time.time()) - JIRA_LAG_SECONDS) // 60 * 60
+        if cursor is None:
+            cursor = until - self.poll_interval // 60 * 60
+        if cursor >= until:
+            return ([], cursor)
+
+        jql = ('project = "%s" AND created >= "%s" AND created < "%s"'
+               ' ORDER BY created ASC'
+               % (JIRA_PROJECT, _jql_time(cursor), _jql_time(until)))
+        issues = []
+        with metrics.timed('jira_fetch'):
+            while True:
+                page = search(jql, len(issues))
+                metrics.inc('beep_boop_pages_fetched_total', source='jira')
+                issues.extend(page['issues'])
+                if not page['issues'] or len(issues) >= page['total']:
+                    break
+        metrics.inc('beep_boop_tickets_fetched_total', len(issues),
+                    source='jira')
+        JIRA_RATE_LIMITER.save()
+        return (issues, until)
+
+    def is_wanted(self, issue):
+        return issue['fields']['issuetype']['name'] == 'Bug'
+
+    def series_keys(self, issue):
+        return ['all'] + ['component=%s' % component['name']
+                          for component in issue['fields']['components']]
+
+    def alert_heading(self, series, issues):
+        return ('*Elevated Jira bug rate in %s (%s)*\nE.g. %s.  '
+                % (JIRA_PROJECT, series,
+                   ', '.join('<%s/browse/%s|%s>'
+                             % (JIRA_URL, issue['key'], issue['key'])
+                             for issue in issues[:5])))
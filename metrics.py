@@ -0,0 +1,155 @@
+"""Counters and timings of what we're doing, for Prometheus to graph.
+
+When a run is slow, this tells us where the time went -- fetching pages,
+waiting out rate limits, retrying, scoring, sending alerts -- and how
+much we asked the APIs for.  Everything we count is listed in METRICS;
+we keep it all in memory, and render it in Prometheus' text format,
+either to a file for the node exporter's textfile collector (run with
+--metrics_file), or, in daemon mode, at /metrics on --metrics_port.
+
+Counters count since the process started, so in cron mode they count
+one run.
+"""
+
+import contextlib
+import http.server
+import threading
+import time
+
+# name -> (type, help).
+METRICS = {
+    'beep_boop_phase_seconds': (
+        'summary', 'Time we spent in each phase of a poll.'),
+    'beep_boop_last_poll_timestamp_seconds': (
+        'gauge', 'When we last finished polling each source.'),
+    'beep_boop_http_requests_total': (
+        'counter', 'HTTP requests we sent, by host and response code.'),
+    'beep_boop_http_response_bytes_total': (
+        'counter', 'Bytes of HTTP responses we downloaded, by host.'),
+    'beep_boop_rate_limit_wait_seconds_total': (
+        'counter', 'Time we spent waiting for API quota, by API.'),
+    'beep_boop_retries_total': (
+        'counter', 'Attempts that failed and that we retried, by what we'
+        ' were trying to do.'),
+    'beep_boop_pages_fetched_total': (
+        'counter', 'API pages we fetched, by source.'),
+    'beep_boop_tickets_fetched_total': (
+        'counter', 'Tickets (or issues) we fetched, by source.'),
+    'beep_boop_tickets_filtered_total': (
+        'counter', 'What our ticket filter did with the tickets we fetched'
+        ' (or got from webhooks), by rule (or "kept") and how we got them;'
+        ' each ticket once a poll.'),
+    'beep_boop_alerts_total': (
+        'counter', 'Alerts we sent, held back, or failed to send, by sink.'),
+}
+
+# Where a /metrics server serves from.
+METRICS_PATH = '/metrics'
+
+_lock = threading.Lock()
+# (name, sorted tuple of label (name, value) pairs) -> value; or for a
+# summary, [sum, count].
+_values = {}
+
+
+def _key(name, labels):
+    if name not in METRICS:
+        raise KeyError('Unknown metric %s' % name)
+    return (name, tuple(sorted((k, str(v)) for (k, v) in labels.items())))
+
+
+def inc(name, amount=1, **labels):
+    """Add amount to the counter name with the given labels."""
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = value
+
+
+def observe(name, value, **labels):
+    """Add an observation, like a duration, to the summary name."""
+    key = _key(name, labels)
+    with _lock:
+        entry = _values.setdefault(key, [0.0, 0])
+        entry[0] += value
+        entry[1] += 1
+
+
+@contextlib.contextmanager
+def timed(phase):
+    """Time the with block as phase, in beep_boop_phase_seconds."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe('beep_boop_phase_seconds', time.monotonic() - start,
+                phase=phase)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, value.replace('\\', r'\\').replace('"', r'\"')
+                     .replace('\n', r'\n'))
+        for (name, value) in labels)
+
+
+def render(extra_labels=None):
+    """Return all our metrics in Prometheus' text format, with
+    extra_labels (a dict) added to each."""
+    extra = tuple(sorted((extra_labels or {}).items()))
+    with _lock:
+        values = sorted((key, list(value) if isinstance(value, list)
+                         else value)
+                        for (key, value) in _values.items())
+    lines = []
+    last_name = None
+    for ((name, labels), value) in values:
+        if name != last_name:
+            (metric_type, help_text) = METRICS[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            last_name = name
+        labels = _format_labels(extra + labels)
+        if METRICS[name][0] == 'summary':
+            lines.append('%s_sum%s %r' % (name, labels, float(value[0])))
+            lines.append('%s_count%s %d' % (name, labels, value[1]))
+        else:
+            lines.append('%s%s %r' % (name, labels, float(value)))
+    return ''.join(line + '\n' for line in lines)
+
+
+def write_textfile(filename, extra_labels=None):
+    """Write render(extra_labels) to filename, for the node exporter's
+    textfile collector, which wants it written atomically."""
+    # util imports us, so we can't import it at the top.
+    import util
+    util.atomic_write(filename, render(extra_labels))
+
+
+def make_server(port, host='127.0.0.1', extra_labels=None):
+    """Return an HTTP server serving render(extra_labels) at METRICS_PATH.
+    Call serve_forever() on it (probably in a thread) to start it."""
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != METRICS_PATH:
+                self.send_error(404)
+                return
+            body = render(extra_labels).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return http.server.ThreadingHTTPServer((host, port), MetricsHandler)
@@ -0,0 +1,218 @@
+"""A compact per-minute history of event counts, kept in a ring buffer.
+
+Our saved totals only tell us about "everything since the last run".  To
+also catch slow-burn problems, we want to look at how many tickets we saw
+in the last 5 minutes, or the last 4 hours, without asking the API again.
+So we remember a count for every minute of the last few weeks.
+
+Slot (minute % slots) of the file holds the count for that minute, so
+adding an event at any minute we remember is O(1), even when a backfill
+adds them in no particular order.  To count the events in a window, we
+keep a running total for each minute in memory, and bring it up to date
+from the oldest minute that's changed only when we're asked for a count:
+so that's O(1) too, plus, once after a batch of adds, O(how far back the
+oldest add was).  The counts live in a memory-mapped file, so they cost
+nothing to load and we only ever write the pages we touch.
+"""
+
+import array
+import mmap
+import os
+import struct
+
+# Four weeks of minutes.
+DEFAULT_SLOTS = 28 * 24 * 60
+
+_MAGIC = b'BBMINHS2'
+# What we used to store: the running totals themselves.  We convert those.
+_TOTALS_MAGIC = b'BBMINHST'
+# magic, number of slots, first minute we have data for, newest minute,
+# and the caller's mark.
+_HEADER = struct.Struct('<8sqqqq')
+_NO_DATA = -1
+
+
+class MinuteHistory(object):
+    """Per-minute event counts for the last `slots` minutes, in a file.
+
+    Minutes are whole minutes since the epoch (time_t // 60).  We can only
+    add events at or after the oldest minute we still remember; normally
+    they're at or near the newest minute.
+    """
+    def __init__(self, filename, slots=DEFAULT_SLOTS):
+        size = _HEADER.size + 8 * slots
+        is_new = not os.path.exists(filename)
+        with open(filename, 'a+b') as f:
+            if is_new or os.path.getsize(filename) == 0:
+                f.truncate(size)
+                is_new = True
+            self._mmap = mmap.mmap(f.fileno(), 0)
+
+        if is_new:
+            _HEADER.pack_into(self._mmap, 0, _MAGIC, slots,
+                              _NO_DATA, _NO_DATA, _NO_DATA)
+        (magic, self.slots, self._first_minute, self._newest_minute,
+         self._mark) = _HEADER.unpack_from(self._mmap, 0)
+        if (magic not in (_MAGIC, _TOTALS_MAGIC) or self.slots != slots
+                or len(self._mmap) != size):
+            self._mmap.close()
+            raise ValueError('%s is not a minute history with %s slots'
+                             % (filename, slots))
+        self._counts = memoryview(self._mmap)[_HEADER.size:].cast('q')
+        if magic == _TOTALS_MAGIC:
+            self._totals_to_counts()
+
+        # Running totals, from _floor_minute(), in the same ring; those
+        # from _stale_from on need bringing up to date.
+        self._totals = array.array('q', bytes(8 * slots))
+        self._stale_from = (None if self._newest_minute == _NO_DATA
+                            else self._first_minute)
+
+    def _totals_to_counts(self):
+        """Convert a file of running totals to per-minute counts, in place.
+        (We go newest first, so each total we need is still there.)"""
+        if self._newest_minute != _NO_DATA:
+            floor = self._floor_minute()
+            for m in range(self._newest_minute, floor, -1):
+                previous = (self._counts[(m - 1) % self.slots]
+                            if m > self._first_minute else 0)
+                self._counts[m % self.slots] -= previous
+            if floor >= self._first_minute:
+                # We could never count this minute's events anyway.
+                self._counts[floor % self.slots] = 0
+        self._write_header()
+
+    def _write_header(self):
+        _HEADER.pack_into(self._mmap, 0, _MAGIC, self.slots,
+                          self._first_minute, self._newest_minute,
+                          self._mark)
+
+    @property
+    def mark(self):
+        """A minute of the caller's choosing, saved along with the counts
+        (e.g. how far some source of events has been recorded), or None."""
+        if self._mark == _NO_DATA:
+            return None
+        return self._mark
+
+    @mark.setter
+    def mark(self, minute):
+        self._mark = _NO_DATA if minute is None else minute
+        self._write_header()
+
+    @property
+    def newest_minute(self):
+        """The newest minute we have data for, or None if we have none."""
+        if self._newest_minute == _NO_DATA:
+            return None
+        return self._newest_minute
+
+    @property
+    def oldest_minute(self):
+        """The oldest minute we still have data for, or None."""
+        if self._newest_minute == _NO_DATA:
+            return None
+        return max(self._first_minute, self._newest_minute - self.slots + 1)
+
+    def _total(self, minute):
+        """Events up to and including minute, which must be no older than
+        _floor_minute(), relative to some fixed base.  _refresh() first!"""
+        if minute < self._first_minute:
+            return 0
+        return self._totals[minute % self.slots]
+
+    def _floor_minute(self):
+        """The oldest minute whose running total we know.  (Before we've
+        wrapped around, that's the minute before the first one, when the
+        total was 0.)"""
+        return max(self._first_minute - 1,
+                   self._newest_minute - self.slots + 1)
+
+    def _refresh(self):
+        """Bring the running totals up to date."""
+        if self._stale_from is None:
+            return
+        floor = self._floor_minute()
+        if self._stale_from <= floor + 1:
+            start = floor + 1
+            running = 0
+            if floor >= self._first_minute:
+                self._totals[floor % self.slots] = 0
+        else:
+            start = self._stale_from
+            running = self._totals[(start - 1) % self.slots]
+        for m in range(start, self._newest_minute + 1):
+            running += self._counts[m % self.slots]
+            self._totals[m % self.slots] = running
+        self._stale_from = None
+
+    def _mark_stale(self, minute):
+        if self._stale_from is None or minute < self._stale_from:
+            self._stale_from = minute
+
+    def advance(self, minute):
+        """Note that we've seen every event up to and including minute."""
+        if self._newest_minute == _NO_DATA:
+            self._first_minute = self._newest_minute = minute
+            self._counts[minute % self.slots] = 0
+            self._mark_stale(minute)
+        elif minute > self._newest_minute:
+            # No need to go round the ring more than once.
+            for m in range(max(self._newest_minute + 1,
+                               minute - self.slots + 1),
+                           minute + 1):
+                self._counts[m % self.slots] = 0
+            self._mark_stale(self._newest_minute + 1)
+            self._newest_minute = minute
+        self._write_header()
+
+    def add(self, minute, count=1):
+        """Record count events at minute.
+
+        Returns False (and records nothing) if minute is older than
+        anything we still remember.
+        """
+        if self._newest_minute == _NO_DATA or minute > self._newest_minute:
+            self.advance(minute)
+        if minute < self.oldest_minute:
+            if minute <= self._newest_minute - self.slots:
+                return False
+            # It's before our first minute, but we have room for it.
+            for m in range(minute, self._first_minute):
+                self._counts[m % self.slots] = 0
+            self._first_minute = minute
+            self._write_header()
+        self._counts[minute % self.slots] += count
+        self._mark_stale(minute)
+        return True
+
+    def count(self, end_minute, minutes):
+        """Return the number of events in the window of `minutes` minutes
+        ending with (and including) end_minute.
+
+        If we don't remember that far back, the window is cut short; use
+        covered_minutes to find out how much of it we actually have.
+        """
+        if self._newest_minute == _NO_DATA:
+            return 0
+        end_minute = min(end_minute, self._newest_minute)
+        start_minute = max(end_minute - minutes, self._floor_minute())
+        if end_minute <= start_minute:
+            return 0
+        self._refresh()
+        return self._total(end_minute) - self._total(start_minute)
+
+    def covered_minutes(self, end_minute, minutes):
+        """How many minutes of that window we actually have data for."""
+        if self._newest_minute == _NO_DATA:
+            return 0
+        end_minute = min(end_minute, self._newest_minute)
+        start_minute = max(end_minute - minutes, self._floor_minute())
+        return max(0, end_minute - start_minute)
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        self._counts.release()
+        self._mmap.close()
@@ -0,0 +1,187 @@
+"""Tests for minute_history.py.  Run with
+    python -m unittest minute_history_test
+"""
+
+import collections
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import minute_history
+
+
+class MinuteHistoryTest(unittest.TestCase):
+    SLOTS = 60
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.filename = os.path.join(directory, 'minutes')
+        self.history = self._open()
+        # What we've added, to check the history against.
+        self.counts = collections.Counter()
+
+    def _open(self, slots=None):
+        history = minute_history.MinuteHistory(self.filename,
+                                               slots or self.SLOTS)
+        self.addCleanup(history.close)
+        return history
+
+    def _reopen(self):
+        self.history.flush()
+        self.history = self._open()
+
+    def _add(self, minute, count=1):
+        self.assertTrue(self.history.add(minute, count))
+        self.counts[minute] += count
+
+    def _expected_count(self, end_minute, minutes):
+        """The number of events we added in that window that the history
+        could still know about."""
+        end_minute = min(end_minute, self.history.newest_minute)
+        start_minute = max(end_minute - minutes,
+                           self.history.newest_minute - self.SLOTS + 1)
+        return sum(self.counts[m] for m in range(start_minute + 1,
+                                                 end_minute + 1))
+
+    def assert_counts(self, minutes=(1, 2, 5, 17, 59, 100)):
+        newest = self.history.newest_minute
+        for end_minute in range(newest - self.SLOTS, newest + 2):
+            for window in minutes:
+                self.assertEqual(
+                    self.history.count(end_minute, window),
+                    self._expected_count(end_minute, window),
+                    'count(%s, %s)' % (end_minute, window))
+
+    def test_empty(self):
+        self.assertIsNone(self.history.newest_minute)
+        self.assertIsNone(self.history.oldest_minute)
+        self.assertEqual(self.history.count(1000, 5), 0)
+        self.assertEqual(self.history.covered_minutes(1000, 5), 0)
+
+    def test_windows(self):
+        for (minute, count) in ((1000, 1), (1000, 2), (1003, 1), (1004, 5),
+                                (1010, 1)):
+            self._add(minute, count)
+        self.assertEqual(self.history.count(1010, 1), 1)
+        self.assertEqual(self.history.count(1004, 2), 6)
+        self.assertEqual(self.history.count(1010, 11), 10)
+        self.assertEqual(self.history.count(1010, 1000), 10)
+        # Past the newest minute, we know there's nothing.
+        self.assertEqual(self.history.count(1020, 11), 10)
+        self.assert_counts()
+
+    def test_covered_minutes(self):
+        self._add(1000)
+        self.history.advance(1009)
+        self.assertEqual(self.history.covered_minutes(1009, 5), 5)
+        self.assertEqual(self.history.covered_minutes(1009, 10), 10)
+        self.assertEqual(self.history.covered_minutes(1009, 11), 10)
+        self.assertEqual(self.history.covered_minutes(1005, 100), 6)
+        # We only ever remember SLOTS - 1 minutes' worth of windows.
+        self.history.advance(2000)
+        self.assertEqual(self.history.covered_minutes(2000, 1000),
+                         self.SLOTS - 1)
+        self.assertEqual(self.history.oldest_minute, 2000 - self.SLOTS + 1)
+
+    def test_add_before_the_first_minute(self):
+        self._add(1000)
+        self._add(990, 3)
+        self.assertEqual(self.history.oldest_minute, 990)
+        self.assertEqual(self.history.count(1000, 11), 4)
+        self.assert_counts()
+
+    def test_too_old(self):
+        self._add(1000)
+        self.assertFalse(self.history.add(1000 - self.SLOTS))
+        self.assertEqual(self.history.count(1000, 1000), 1)
+
+    def test_wraparound(self):
+        rng = random.Random(4)
+        for minute in range(1000, 1000 + 5 * self.SLOTS):
+            self._add(minute, rng.randrange(4))
+            if minute % 7 == 0:
+                self.assert_counts()
+        self.assertEqual(self.history.oldest_minute,
+                         1000 + 4 * self.SLOTS)
+        self.assert_counts()
+
+    def test_jump_past_everything(self):
+        self._add(1000, 5)
+        self._add(1000 + 3 * self.SLOTS)
+        self.assertEqual(self.history.count(1000 + 3 * self.SLOTS, 1000), 1)
+        self.assert_counts()
+
+    def test_adds_in_any_order(self):
+        # As in a backfill, where tickets come in the order they were
+        # last updated.
+        rng = random.Random(9)
+        self.history.advance(2000)
+        for _ in range(500):
+            newest = self.history.newest_minute
+            self._add(rng.randrange(newest - self.SLOTS + 1, newest + 1))
+            if rng.random() < 0.05:
+                self.history.advance(self.history.newest_minute + 1)
+                self.assert_counts()
+        self.assert_counts()
+
+    def test_reopen(self):
+        for minute in range(1000, 1000 + 2 * self.SLOTS, 3):
+            self._add(minute, 2)
+        self.history.mark = 1100
+        self._reopen()
+        self.assertEqual(self.history.mark, 1100)
+        self.assertEqual(self.history.newest_minute, 1117)
+        self.assert_counts()
+        # And we can carry on from there.
+        self._add(self.history.newest_minute + 1)
+        self._add(self.history.newest_minute - 10)
+        self.assert_counts()
+
+    def test_reopen_with_other_slots(self):
+        self._add(1000)
+        self.history.flush()
+        with self.assertRaises(ValueError):
+            self._open(slots=self.SLOTS + 1)
+
+    def test_converts_running_totals(self):
+        # How we used to store the history: for each minute, the events up
+        # to and including it.
+        for minute in range(1000, 1000 + 2 * self.SLOTS, 2):
+            self._add(minute, minute % 5)
+        newest = self.history.newest_minute
+        self.history.close()
+        totals = [None] * self.SLOTS
+        for m in range(newest - self.SLOTS + 1, newest + 1):
+            totals[m % self.SLOTS] = sum(self.counts[n] for n in range(m + 1))
+        with open(self.filename, 'r+b') as f:
+            f.write(minute_history._HEADER.pack(
+                minute_history._TOTALS_MAGIC, self.SLOTS, 1000, newest, 1050))
+            for total in totals:
+                f.write(total.to_bytes(8, 'little', signed=True))
+
+        self.history = self._open()
+        self.assertEqual(self.history.mark, 1050)
+        self.assert_counts()
+        self._reopen()
+        self.assert_counts()
+
+    def test_backfill_newest_first(self):
+        # Four weeks of minutes, each added after a newer one.  (Adding an
+        # old minute used to touch every minute after it.)
+        history = minute_history.MinuteHistory(self.filename + '-big')
+        self.addCleanup(history.close)
+        newest = 10 ** 6
+        history.advance(newest)
+        minutes = range(newest, newest - history.slots, -10)
+        for minute in minutes:
+            self.assertTrue(history.add(minute, 2))
+        self.assertEqual(history.count(newest, history.slots),
+                         2 * len(minutes))
+        self.assertEqual(history.count(newest, 1), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
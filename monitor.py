@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""Poll all our sources of reports, at once, from one process.
+
+Each source (see sources.py) used to need a process of its own.  This
+polls as many as we like together, on a thread pool, sharing our state
+store, HTTP connections and alerting:
+    ./monitor.py --sources zendesk,github
+polls each once, like a cron job, and
+    ./monitor.py --daemon --sources zendesk,github --interval github=300
+keeps polling each every --interval seconds (by default, how often the
+source says), and saves our state every --checkpoint_interval seconds and
+when it gets a SIGTERM.
+
+zendesk_reports.py and github_reports.py run us for their own source.
+"""
+
+import argparse
+import concurrent.futures
+import logging
+
+import alerts
+import daemon
+import metrics
+import sources
+import state_store
+import util
+import webhook
+
+# Labels we add to all our metrics (see metrics.py).
+METRICS_LABELS = {'script': 'monitor'}
+
+
+def load_sources(names, store, options=None):
+    """Return the sources called names, loaded from store.
+
+    options maps a source's name to the options to load it with (see
+    sources.load_source).
+    """
+    options = options or {}
+    return [sources.load_source(name, store, **options.get(name, {}))
+            for name in names]
+
+
+def _poll(source):
+    with source.lock:
+        source.poll()
+
+
+def _save(source, wait=True):
+    """Save source, first waiting for any poll of it to finish, unless
+    not wait, in which case we skip it if it's polling.  Returns whether
+    we saved it."""
+    if not source.lock.acquire(wait):
+        return False
+    try:
+        source.save()
+    finally:
+        source.lock.release()
+    return True
+
+
+def main(names, options=None, metrics_file=None,
+         metrics_labels=METRICS_LABELS):
+    """Poll each of the sources called names once, all at once."""
+    store = state_store.StateStore()
+    alerts.DISPATCHER.set_store(store)
+    polled = load_sources(names, store, options)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(len(polled)) as executor:
+            futures = [executor.submit(_poll, source) for source in polled]
+        # Like a job in daemon mode, one source failing doesn't stop the
+        # others; but we save what we polled before we tell anyone.
+        for (source, future) in zip(polled, futures):
+            if future.exception() is None:
+                _save(source)
+    finally:
+        for source in polled:
+            source.close()
+    # We sent alerts in the background; wait for them before we exit.
+    alerts.DISPATCHER.flush()
+    if metrics_file:
+        metrics.write_textfile(metrics_file, metrics_labels)
+    for future in futures:
+        future.result()
+
+
+def run_daemon(intervals, checkpoint_interval, options=None,
+               metrics_file=None, metrics_port=None,
+               metrics_labels=METRICS_LABELS):
+    """Poll each source in intervals (a dict of source name -> seconds
+    between polls, or None for the source's own poll_interval) until we
+    get a SIGTERM, keeping our state in memory and saving it every
+    checkpoint_interval seconds.
+
+    If metrics_port is given, we serve our metrics there (see
+    metrics.py); if metrics_file is given, we write them there whenever
+    we save our state.
+    """
+    store = state_store.StateStore()
+    alerts.DISPATCHER.set_store(store)
+    polled = load_sources(list(intervals), store, options)
+    server = None
+    if metrics_port:
+        server = metrics.make_server(metrics_port,
+                                     extra_labels=metrics_labels)
+        webhook.serve_in_background(server, 'metrics')
+
+    def _checkpoint():
+        # A poll can take a while (e.g. waiting out a rate limit), and we
+        # mustn't hold up the others by waiting for it; we'll save that
+        # source next time.  (The last checkpoint comes after all the
+        # polls are done, so it saves everything.)
+        for source in polled:
+            if not _save(source, wait=False):
+                logging.warning('%s: still polling, not saving it yet'
+                                % source.name)
+        if metrics_file:
+            metrics.write_textfile(metrics_file, metrics_labels)
+
+    jobs = [daemon.Job(source.name,
+                       intervals[source.name] or source.poll_interval,
+                       lambda source=source: _poll(source))
+            for source in polled]
+    executor = concurrent.futures.ThreadPoolExecutor(
+        len(jobs), thread_name_prefix='poll')
+    try:
+        daemon.run(jobs, _checkpoint, checkpoint_interval, executor=executor)
+    finally:
+        executor.shutdown()
+        if server is not None:
+            server.shutdown()
+        alerts.DISPATCHER.flush()
+        for source in polled:
+            source.close()
+        store.close()
+
+
+def _parse_intervals(names, intervals):
+    """Return a dict of source name -> seconds between polls (or None),
+    from the names to poll and the --interval flags."""
+    result = dict.fromkeys(names)
+    for interval in intervals:
+        (name, seconds) = interval.split('=', 1)
+        if name not in result:
+            raise ValueError('--interval for %s, which we are not polling'
+                             % name)
+        result[name] = int(seconds)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Poll all our sources of reports, from one process.')
+    parser.add_argument('--sources', default='zendesk',
+                        help=('Comma-separated sources to poll, of: %s.'
+                              % ', '.join(sorted(sources.SOURCES))))
+    parser.add_argument('--daemon', action='store_true',
+                        help=('Keep running, polling each source every '
+                              '--interval, instead of polling once.'))
+    parser.add_argument('--interval', action='append', default=[],
+                        help=('In daemon mode, SOURCE=seconds between '
+                              'polls of SOURCE; may be repeated.'))
+    parser.add_argument('--checkpoint_interval', type=int, default=600,
+                        help='In daemon mode, seconds between state saves.')
+    parser.add_argument('--backfill_days', type=int,
+                        help=('How many days of Zendesk history to backfill '
+                              'when we have no saved state.'))
+    parser.add_argument('--webhook_port', type=int,
+                        help=('Also listen for Zendesk new-ticket webhooks '
+                              'on this port (see webhook.py).'))
+    parser.add_argument('--record_dir',
+                        help=('Save everything the APIs send us in this '
+                              'directory, for replay.py.'))
+    parser.add_argument('--metrics_file',
+                        help=('Write our metrics to this file, for the '
+                              'Prometheus textfile collector, after each '
+                              'run (in daemon mode, each state save).'))
+    parser.add_argument('--metrics_port', type=int,
+                        help=('In daemon mode, serve our metrics for '
+                              'Prometheus at /metrics on this port.'))
+    args = parser.parse_args()
+
+    names = args.sources.split(',')
+    for name in names:
+        if name not in sources.SOURCES:
+            parser.error('Unknown source %s' % name)
+    zendesk_options = {}
+    if args.backfill_days is not None:
+        zendesk_options['backfill_days'] = args.backfill_days
+    if args.webhook_port:
+        zendesk_options['webhook_port'] = args.webhook_port
+
+    if args.record_dir:
+        util.record_responses(args.record_dir)
+
+    if args.daemon:
+        run_daemon(_parse_intervals(names, args.interval),
+                   args.checkpoint_interval, {'zendesk': zendesk_options},
+                   args.metrics_file, args.metrics_port)
+    else:
+        main(names, {'zendesk': zendesk_options}, args.metrics_file)
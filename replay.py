@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+
+"""Replay recorded API responses through our alerting, to tune thresholds.
+
+Our alert thresholds (SIGNIFICANT_TICKET_COUNT, ALERT_PROBABILITY and
+friends in zendesk_reports.py, and ALERT_PROBABILITY and
+MIN_REPORTS_TO_ALERT in github_reports.py) were picked by eye.  To do
+better, first record what the APIs tell us for a while, by running
+    ./zendesk_reports.py --daemon --record_dir recorded
+(or github_reports.py with --record_dir), which saves every response,
+gzipped, in that directory.  Then
+    ./replay.py recorded --sweep SIGNIFICANT_TICKET_COUNT=3,5,7 \\
+        --sweep ALERT_PROBABILITY=0.999,0.9999
+replays it all, polling every --poll_minutes just like poll() does but
+as fast as we can, through the real get_tickets_between, util.probability
+and handle_alerts, with Slack and PagerDuty stubbed out (but repeat
+alerts held back as usual, see alerts.py).  It does that for every
+combination of the values given, and tells you how many alerts and
+pages each would have sent.
+
+To tell you how many of those alerts were real, and how quickly we
+noticed each problem, it needs to know when we had problems: give it an
+--incidents file, a JSON list of [start, end] times like
+    [["2017-07-01 10:00", "2017-07-01 12:30"]]
+(in local time), or have it --inject_surges of made-up tickets.
+"""
+
+import argparse
+import bisect
+import collections
+import contextlib
+import gzip
+import itertools
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import types
+
+import alerts
+import backtest
+import baseline
+import github_reports
+import sources
+import state_store
+import ticket_filter
+import util
+import zendesk_reports
+
+# The export API gives us up to this many tickets a page.
+EXPORT_PAGE_SIZE = 1000
+
+# The thresholds we know how to sweep, for each source.
+ZENDESK_THRESHOLDS = ('SIGNIFICANT_TICKET_COUNT',
+                      'MIN_TICKET_COUNT_TO_PAGE_SOMEONE',
+                      'ALERT_PROBABILITY', 'PAGE_PROBABILITY')
+GITHUB_THRESHOLDS = ('ALERT_PROBABILITY', 'MIN_REPORTS_TO_ALERT')
+
+# Every alert goes to this channel (and maybe others too), for each source.
+ZENDESK_ALERT_CHANNEL = '#infrastructure-sre'
+GITHUB_ALERT_CHANNEL = '#support'
+
+
+@contextlib.contextmanager
+def _patched(module, **values):
+    """Set the given attributes of module for the duration."""
+    old_values = {name: getattr(module, name) for name in values}
+    for (name, value) in values.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for (name, value) in old_values.items():
+            setattr(module, name, value)
+
+
+@contextlib.contextmanager
+def _captured_alerts(clock):
+    """Instead of sending alerts, collect them in the list we yield, as
+    (clock[0] when we sent it, 'slack' or 'pagerduty', channel).
+
+    We send them through a dispatcher of our own, which holds back
+    repeats just like alerts.DISPATCHER would, but by clock[0], and
+    right away.
+    """
+    captured = []
+    dispatcher = alerts.AlertDispatcher(
+        sinks={
+            'slack': lambda message, channel: captured.append(
+                (clock[0], 'slack', channel)),
+            'pagerduty': lambda message, service: captured.append(
+                (clock[0], 'pagerduty', service)),
+        },
+        workers=0, clock=lambda: clock[0])
+    with _patched(alerts, DISPATCHER=dispatcher):
+        yield captured
+
+
+def load_index(record_dir):
+    """Return the responses recorded in record_dir, oldest first."""
+    with open(os.path.join(record_dir, util.RECORD_INDEX_FILE)) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return sorted(entries, key=lambda entry: entry['time'])
+
+
+def read_body(record_dir, entry):
+    with gzip.open(os.path.join(record_dir, entry['file'])) as f:
+        return f.read()
+
+
+class ReplayedExport(object):
+    """Serves recorded tickets the way the export API would have.
+
+    We may have recorded several versions of a ticket, as it was updated.
+    Like the real export, a page has the latest version (as of now) of
+    each ticket updated since the page's start time, oldest update first.
+    Set now to the time we're pretending it is.
+    """
+    def __init__(self, tickets):
+        # Each distinct version, by when it was updated.
+        versions = {}
+        for ticket in tickets:
+            updated_at = zendesk_reports._parse_time(ticket['updated_at'])
+            versions[(ticket['id'], updated_at)] = ticket
+        self._versions = sorted(versions.items(),
+                                key=lambda item: item[0][1])
+        self._updated_times = [updated_at
+                               for ((_, updated_at), _) in self._versions]
+        self.now = 0
+
+    @classmethod
+    def from_recording(cls, record_dir):
+        tickets = []
+        for entry in load_index(record_dir):
+            if entry['url'].startswith(zendesk_reports.ZENDESK_EXPORT_URL):
+                tickets.extend(
+                    json.loads(read_body(record_dir, entry))['results'])
+        return cls(tickets)
+
+    def time_range(self):
+        """The first and last update time of any ticket we have."""
+        if not self._versions:
+            raise ValueError('There are no recorded Zendesk tickets')
+        return (self._updated_times[0], self._updated_times[-1])
+
+    def tickets(self):
+        return [ticket for (_, ticket) in self._versions]
+
+    def get_ticket_data(self, start_time_t, fields=None):
+        """Like zendesk_reports.get_ticket_data, but from our tickets."""
+        latest = {}
+        for i in range(bisect.bisect_left(self._updated_times, start_time_t),
+                       bisect.bisect_right(self._updated_times, self.now)):
+            ((ticket_id, updated_at), ticket) = self._versions[i]
+            latest[ticket_id] = (updated_at, ticket)
+        page = sorted(latest.values(), key=lambda item: item[0])
+        next_page = len(page) > EXPORT_PAGE_SIZE
+        page = page[:EXPORT_PAGE_SIZE]
+
+        results = [ticket for (_, ticket) in page]
+        if fields is not None:
+            results = [{field: ticket[field] for field in fields
+                        if field in ticket}
+                       for ticket in results]
+        return {
+            'results': results,
+            'next_page': 'more' if next_page else None,
+            'end_time': page[-1][0] + 1 if page else start_time_t,
+        }
+
+
+def _format_time(time_t):
+    return time.strftime('%Y-%m-%d %H:%M:%S %z', time.localtime(time_t))
+
+
+def inject_surges(export, count, ratio, minutes, warmup_seconds, rng):
+    """Add count surges of made-up tickets to export, each of ratio times
+    the usual rate of tickets we'd count, for minutes minutes.
+
+    Returns the (start, end) times of the surges.
+    """
+    wanted = ticket_filter.TicketFilter(ticket_filter.load_config())
+    (first_time, last_time) = export.time_range()
+    start_minute = int(first_time) // 60
+    counts = [0] * (int(last_time) // 60 - start_minute + 1)
+    for ticket in export.tickets():
+        if wanted.drop_reason(ticket) is None:
+            minute = int(zendesk_reports._parse_time(
+                ticket['created_at'])) // 60
+            if start_minute <= minute < start_minute + len(counts):
+                counts[minute - start_minute] += 1
+    rates = backtest.usual_rates(start_minute, counts)
+
+    injected = []
+    surges = []
+    ticket_ids = itertools.count(-1, -1)
+    for _ in range(count):
+        start = rng.randrange(int(first_time + warmup_seconds) // 60,
+                              int(last_time) // 60 - minutes)
+        surges.append((start * 60, (start + minutes) * 60))
+        for minute in range(start, start + minutes):
+            hour = baseline.hour_of_week(minute * 60)
+            for _ in range(backtest.random_poisson(
+                    rng, rates[hour] * (ratio - 1))):
+                created_at = _format_time(minute * 60 + rng.randrange(60))
+                injected.append({
+                    'id': next(ticket_ids),
+                    'subject': 'Made-up surge ticket',
+                    'created_at': created_at,
+                    'updated_at': created_at,
+                    'current_tags': sorted(wanted.required_tags),
+                })
+    return (ReplayedExport(export.tickets() + injected), surges)
+
+
+def replay_zendesk(export, poll_seconds, warmup_seconds):
+    """Poll export every poll_seconds, the way zendesk_reports.poll does.
+
+    Returns what we'd pass handle_alerts for each poll after the first
+    warmup_seconds, as (tickets, seconds, mean, probability, start, end).
+    """
+    polls = []
+    ticket_baseline = baseline.HourOfWeekBaseline()
+    (start_time, last_time) = export.time_range()
+    start_time = int(start_time)
+    with _patched(zendesk_reports, get_ticket_data=export.get_ticket_data):
+        for end_time in range(start_time + poll_seconds, int(last_time),
+                              poll_seconds):
+            poll_start_time = end_time - poll_seconds
+            # poll() asks for tickets up to 5 minutes ago.
+            export.now = end_time + 300
+            (tickets, _) = zendesk_reports.get_tickets_between(
+                poll_start_time, end_time, prefetch_pages=0)
+            if end_time - start_time > warmup_seconds:
+                (mean, probability) = util.probability(
+                    *ticket_baseline.past_totals(poll_start_time, end_time),
+                    errors_this_period=len(tickets),
+                    time_this_period=poll_seconds)
+                polls.append((tickets, poll_seconds, mean, probability,
+                              poll_start_time, end_time))
+            ticket_baseline.observe(poll_start_time, end_time,
+                                    tickets.times)
+    return polls
+
+
+def alert_zendesk(polls, settings):
+    """Run handle_alerts on each of polls, with the given thresholds.
+
+    Returns the alerts it would have sent, like _captured_alerts.
+    """
+    clock = [None]
+    with _patched(zendesk_reports, **settings), \
+            _captured_alerts(clock) as alerts:
+        for (tickets, seconds, mean, probability, start, end) in polls:
+            clock[0] = end
+            zendesk_reports.handle_alerts(tickets, seconds, mean,
+                                          probability, start, end)
+    return alerts
+
+
+def replay_github(record_dir, settings):
+    """Poll a github_reports.GitHubSource for each recorded GitHub poll in
+    record_dir, with the given thresholds.
+
+    Returns the alerts it would have sent, like _captured_alerts.
+    """
+    # Each poll starts by asking for the first page of issues.
+    runs = []
+    for entry in load_index(record_dir):
+        if entry['url'].startswith(github_reports.GITHUB_ISSUES_URL):
+            if '?page=1&' in entry['url'] or not runs:
+                runs.append({})
+            runs[-1][entry['url']] = entry
+
+    clock = [None]
+
+    def _urlopen(request, timeout=60, rate_limiter=None):
+        url = request if isinstance(request, str) else request.full_url
+        entry = responses[url]
+        return util.RecordedResponse(url, read_body(record_dir, entry),
+                                     entry['headers'], entry['status'])
+
+    # Polls ask time.time() how long it's been since the last one.
+    fake_time = types.SimpleNamespace(time=lambda: clock[0],
+                                      strftime=time.strftime)
+    store = state_store.StateStore(':memory:')
+    # We replay any 304s from our own cache of the pages we've replayed.
+    cache_dir = tempfile.mkdtemp()
+    # The thresholds are the GitHubSource's, under lower-case names.
+    source_settings = {name.lower(): value
+                       for (name, value) in settings.items()}
+    with _patched(sources, time=fake_time), \
+            _patched(github_reports, GITHUB_CACHE_DIR=cache_dir,
+                     OLD_EXERCISE_REPORTS_FILE=os.path.join(
+                         record_dir, 'no-such-file'),
+                     GITHUB_RATE_LIMITER=util.RateLimiter(60, 3600)), \
+            _patched(github_reports.GitHubSource, **source_settings), \
+            _patched(util, urlopen=_urlopen), \
+            _captured_alerts(clock) as alerts:
+        source = github_reports.GitHubSource(store)
+        for responses in runs:
+            clock[0] = min(entry['time'] for entry in responses.values())
+            source.poll()
+    store.close()
+    shutil.rmtree(cache_dir)
+    return alerts
+
+
+def _load_incidents(filename):
+    """Return the (start, end) times of the incidents in filename."""
+    with open(filename) as f:
+        incidents = json.load(f)
+    return [tuple(time.mktime(time.strptime(t, '%Y-%m-%d %H:%M'))
+                  for t in incident)
+            for incident in incidents]
+
+
+def score_alerts(alerts, channel, incidents, poll_seconds):
+    """Return (alerts, pages, precision, incidents caught, median minutes
+    to first alert) for the alerts we'd have sent, counting those sent to
+    Slack channel.
+
+    Precision and the rest are None if we have no incidents.  An alert
+    counts for an incident if it's sent during it, or by the end of the
+    first poll after it.
+    """
+    slack_times = sorted(alert_time
+                         for (alert_time, kind, alert_channel) in alerts
+                         if kind == 'slack' and alert_channel == channel)
+    pages = sum(1 for (_, kind, _) in alerts if kind == 'pagerduty')
+    if not incidents:
+        return (len(slack_times), pages, None, None, None)
+
+    true_alerts = 0
+    delays = []
+    for alert_time in slack_times:
+        if any(start < alert_time <= end + poll_seconds
+               for (start, end) in incidents):
+            true_alerts += 1
+    for (start, end) in incidents:
+        during = [alert_time for alert_time in slack_times
+                  if start < alert_time <= end + poll_seconds]
+        if during:
+            delays.append((during[0] - start) / 60.0)
+    precision = true_alerts / len(slack_times) if slack_times else None
+    return (len(slack_times), pages, precision, len(delays),
+            statistics.median(delays) if delays else None)
+
+
+def _parse_sweeps(sweeps, allowed):
+    """Turn --sweep NAME=v1,v2 arguments into a list of settings dicts,
+    one for every combination."""
+    values = collections.OrderedDict()
+    for sweep in sweeps:
+        (name, _, options) = sweep.partition('=')
+        if name not in allowed:
+            raise ValueError('We can only sweep %s' % ', '.join(allowed))
+        values[name] = [json.loads(option) for option in options.split(',')]
+    return [dict(zip(values, combination))
+            for combination in itertools.product(*values.values())]
+
+
+def _print_results(results, num_incidents):
+    print('%-60s %7s %6s %10s %10s %8s'
+          % ('settings', 'alerts', 'pages', 'precision', 'caught',
+             'latency'))
+    for (settings, (fired, pages, precision, caught, latency)) in results:
+        name = ' '.join('%s=%s' % item for item in sorted(settings.items()))
+        print('%-60s %7s %6s %10s %10s %8s'
+              % (name or '(current thresholds)', fired, pages,
+                 '-' if precision is None else '%.2f' % precision,
+                 '-' if caught is None else '%s/%s' % (caught, num_incidents),
+                 '-' if latency is None else '%.0fm' % latency))
+
+
+def main(record_dir, source, sweeps, poll_minutes, warmup_days,
+         incidents_file, inject_surges_count, surge_ratio, surge_minutes,
+         seed):
+    poll_seconds = poll_minutes * 60
+    if source == 'github':
+        all_settings = _parse_sweeps(sweeps, GITHUB_THRESHOLDS) or [{}]
+        results = [(settings, score_alerts(replay_github(record_dir,
+                                                         settings),
+                                           GITHUB_ALERT_CHANNEL, [],
+                                           poll_seconds))
+                   for settings in all_settings]
+        _print_results(results, 0)
+        return
+
+    all_settings = _parse_sweeps(sweeps, ZENDESK_THRESHOLDS) or [{}]
+    export = ReplayedExport.from_recording(record_dir)
+    incidents = _load_incidents(incidents_file) if incidents_file else []
+    if inject_surges_count:
+        (export, surges) = inject_surges(
+            export, inject_surges_count, surge_ratio, surge_minutes,
+            warmup_days * 86400, random.Random(seed))
+        incidents.extend(surges)
+
+    start = time.time()
+    polls = replay_zendesk(export, poll_seconds, warmup_days * 86400)
+    print('Replayed %s polls in %.1fs'
+          % (len(polls), time.time() - start))
+    # The thresholds only matter to handle_alerts, so we only need to
+    # fetch and score the tickets once, however many settings we try.
+    results = [(settings, score_alerts(alert_zendesk(polls, settings),
+                                       ZENDESK_ALERT_CHANNEL, incidents,
+                                       poll_seconds))
+               for settings in all_settings]
+    _print_results(results, len(incidents))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=('Replay recorded API responses through our alerting,'
+                     ' to see how different thresholds would have done.'))
+    parser.add_argument('record_dir',
+                        help='Where we recorded responses (--record_dir).')
+    parser.add_argument('--source', choices=('zendesk', 'github'),
+                        default='zendesk', help='Which API to replay.')
+    parser.add_argument('--sweep', action='append', default=[],
+                        help=('NAME=value,value,... to try each value of '
+                              'the threshold NAME; may be repeated.'))
+    parser.add_argument('--poll_minutes', type=int, default=5,
+                        help='How often to pretend we poll Zendesk.')
+    parser.add_argument('--warmup_days', type=int, default=7,
+                        help=('How many days of tickets to only learn the'
+                              ' baseline from.'))
+    parser.add_argument('--incidents',
+                        help='A JSON file of [start, end] incident times.')
+    parser.add_argument('--inject_surges', type=int, default=0,
+                        help='How many surges of made-up tickets to add.')
+    parser.add_argument('--surge_ratio', type=float, default=2,
+                        help='How many times the usual rate a surge is.')
+    parser.add_argument('--surge_minutes', type=int, default=60,
+                        help='How long a surge lasts.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed, for repeatable results.')
+    args = parser.parse_args()
+
+    main(args.record_dir, args.source, args.sweep, args.poll_minutes,
+         args.warmup_days, args.incidents, args.inject_surges,
+         args.surge_ratio, args.surge_minutes, args.seed)
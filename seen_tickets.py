@@ -0,0 +1,95 @@
+"""Which tickets we've already counted, so we never count one twice.
+
+The export gives us tickets by when they were last updated, and we only
+count those created in the window we asked for.  But windows can overlap
+-- a retried poll, a backfill, a crash before we saved where we'd got to
+-- and in daemon mode we count tickets from webhooks before the export
+gets to them.  So we remember what we've done with each ticket: whether
+a poll has counted it (COUNTED), and whether it's in the minute history
+(IN_HISTORY), which for webhook tickets comes first.
+
+We keep tickets in buckets by the hour they were created, and forget a
+bucket once it's older than horizon_hours: by then, no window we'll ask
+for can include its tickets.  So the horizon needs to cover the longest
+window we ask for, which is a backfill (see horizon_hours_for), and
+memory is bounded by how many tickets we get in that time; checking a
+ticket is a dict lookup.
+"""
+
+import math
+
+# What we've done with a ticket, as bit flags.
+COUNTED = 1
+IN_HISTORY = 2
+
+
+def horizon_hours_for(window_days):
+    """The horizon_hours we need to remember every ticket in a window of
+    window_days.  (The window needn't start on the hour, so its oldest
+    hour can be one more back.)"""
+    return int(math.ceil(window_days * 24)) + 1
+
+
+class SeenTickets(object):
+    """Flags for each ticket created in the last horizon_hours.
+
+    state, if given, is what to_state() returned last time.
+    """
+    def __init__(self, horizon_hours, state=None):
+        self.horizon_hours = horizon_hours
+        # ticket id -> [hour created, flags].
+        self._tickets = {}
+        # hour created -> set of ticket ids.
+        self._buckets = {}
+        for (hour, bucket) in (state or {}).items():
+            hour = int(hour)
+            self._buckets[hour] = set()
+            for (ticket_id, flags) in bucket.items():
+                self._tickets[int(ticket_id)] = [hour, flags]
+                self._buckets[hour].add(int(ticket_id))
+        self._newest_hour = max(self._buckets) if self._buckets else None
+        # The buckets we've changed, and forgotten, since we were loaded.
+        self.dirty = set()
+        self.evicted = set()
+
+    def flags(self, ticket_id):
+        """What we've done with the ticket, or 0 if we don't know it."""
+        entry = self._tickets.get(ticket_id)
+        return entry[1] if entry is not None else 0
+
+    def add(self, ticket_id, created_time_t, flags):
+        """Note that we've done flags with the ticket, created at
+        created_time_t (as well as anything we'd done before)."""
+        entry = self._tickets.get(ticket_id)
+        if entry is None:
+            hour = int(created_time_t) // 3600
+            if (self._newest_hour is not None and
+                    hour <= self._newest_hour - self.horizon_hours):
+                return      # too old to ever be asked about again
+            entry = self._tickets[ticket_id] = [hour, 0]
+            self._buckets.setdefault(hour, set()).add(ticket_id)
+            if self._newest_hour is None or hour > self._newest_hour:
+                self._newest_hour = hour
+                self._evict()
+        entry[1] |= flags
+        self.dirty.add(entry[0])
+
+    def _evict(self):
+        for hour in list(self._buckets):
+            if hour <= self._newest_hour - self.horizon_hours:
+                for ticket_id in self._buckets.pop(hour):
+                    del self._tickets[ticket_id]
+                self.dirty.discard(hour)
+                self.evicted.add(hour)
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def to_state(self, hours=None):
+        """Return the buckets for the given hours (default: all of them),
+        to save and later pass back in as state."""
+        if hours is None:
+            hours = self._buckets
+        return {str(hour): {str(ticket_id): self._tickets[ticket_id][1]
+                            for ticket_id in self._buckets[hour]}
+                for hour in hours if hour in self._buckets}
@@ -0,0 +1,165 @@
+"""Tests for seen_tickets.py.  Run with
+    python -m unittest seen_tickets_test
+"""
+
+import unittest
+
+import seen_tickets
+import state_store
+import zendesk_reports
+
+HOUR = 3600
+# Some time on the hour, and the hour it's in.
+T0 = 1500000 * HOUR
+H0 = T0 // HOUR
+
+
+class HorizonTest(unittest.TestCase):
+    def test_horizon_hours_for(self):
+        self.assertEqual(seen_tickets.horizon_hours_for(1), 25)
+        self.assertEqual(seen_tickets.horizon_hours_for(7), 169)
+        self.assertEqual(seen_tickets.horizon_hours_for(0.5), 13)
+        self.assertEqual(seen_tickets.horizon_hours_for(0.01), 2)
+
+    def test_remembers_a_whole_window(self):
+        # However a window of a day is placed, we still know about its
+        # oldest ticket once we've seen its newest.
+        horizon = seen_tickets.horizon_hours_for(1)
+        for offset in (0, 1, HOUR // 2, HOUR - 1):
+            seen = seen_tickets.SeenTickets(horizon)
+            start = T0 + offset
+            seen.add(1, start, seen_tickets.COUNTED)
+            seen.add(2, start + 24 * HOUR - 1, seen_tickets.COUNTED)
+            self.assertEqual(seen.flags(1), seen_tickets.COUNTED, offset)
+
+
+class SeenTicketsTest(unittest.TestCase):
+    def setUp(self):
+        self.seen = seen_tickets.SeenTickets(3)
+
+    def test_flags(self):
+        self.assertEqual(self.seen.flags(1), 0)
+        self.seen.add(1, T0, seen_tickets.IN_HISTORY)
+        self.assertEqual(self.seen.flags(1), seen_tickets.IN_HISTORY)
+        # Flags add up; the first time we saw it says which hour it's in.
+        self.seen.add(1, T0 + 5 * HOUR, seen_tickets.COUNTED)
+        self.assertEqual(self.seen.flags(1),
+                         seen_tickets.IN_HISTORY | seen_tickets.COUNTED)
+        self.assertEqual(self.seen.to_state(), {
+            str(H0): {'1': seen_tickets.IN_HISTORY | seen_tickets.COUNTED}})
+
+    def test_eviction(self):
+        self.seen.add(1, T0, seen_tickets.COUNTED)
+        self.seen.add(2, T0 + HOUR, seen_tickets.COUNTED)
+        self.seen.add(3, T0 + 2 * HOUR + HOUR - 1, seen_tickets.COUNTED)
+        self.assertEqual(len(self.seen), 3)
+        self.assertEqual(self.seen.evicted, set())
+        # Hour H0 + 3 pushes out H0 (but not H0 + 1).
+        self.seen.add(4, T0 + 3 * HOUR, seen_tickets.COUNTED)
+        self.assertEqual(self.seen.flags(1), 0)
+        self.assertEqual(self.seen.flags(2), seen_tickets.COUNTED)
+        self.assertEqual(len(self.seen), 3)
+        self.assertEqual(self.seen.evicted, {H0})
+        self.assertNotIn(H0, self.seen.dirty)
+
+    def test_too_old_to_add(self):
+        self.seen.add(1, T0 + 3 * HOUR, seen_tickets.COUNTED)
+        self.seen.add(2, T0, seen_tickets.COUNTED)
+        self.assertEqual(self.seen.flags(2), 0)
+        self.seen.add(3, T0 + HOUR, seen_tickets.COUNTED)
+        self.assertEqual(self.seen.flags(3), seen_tickets.COUNTED)
+
+    def test_out_of_order(self):
+        # Older tickets within the horizon don't evict anything.
+        self.seen.add(1, T0 + 2 * HOUR, seen_tickets.COUNTED)
+        self.seen.add(2, T0, seen_tickets.COUNTED)
+        self.seen.add(3, T0 + HOUR, seen_tickets.COUNTED)
+        self.assertEqual(len(self.seen), 3)
+
+
+class SaveAndLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.store = state_store.StateStore(':memory:')
+        self.addCleanup(self.store.close)
+
+    def _save(self, seen):
+        zendesk_reports._save_seen_tickets(
+            self.store, zendesk_reports._take_seen_ticket_changes(seen))
+
+    def _load(self, horizon_hours=3):
+        return seen_tickets.SeenTickets(horizon_hours,
+                                        self.store.get_all('zendesk_seen'))
+
+    def test_round_trip(self):
+        seen = self._load()
+        seen.add(1, T0, seen_tickets.IN_HISTORY)
+        seen.add(2, T0 + 10, seen_tickets.COUNTED)
+        seen.add(3, T0 + HOUR, seen_tickets.COUNTED | seen_tickets.IN_HISTORY)
+        self._save(seen)
+        self.assertEqual((seen.dirty, seen.evicted), (set(), set()))
+
+        loaded = self._load()
+        self.assertEqual(loaded.to_state(), seen.to_state())
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(loaded.flags(1), seen_tickets.IN_HISTORY)
+        self.assertEqual(loaded.flags(3),
+                         seen_tickets.COUNTED | seen_tickets.IN_HISTORY)
+        self.assertEqual(loaded.dirty, set())
+
+        # A webhook ticket that a poll then counts keeps both flags.
+        loaded.add(1, T0, seen_tickets.COUNTED)
+        self.assertEqual(loaded.dirty, {H0})
+        self._save(loaded)
+        self.assertEqual(self._load().flags(1),
+                         seen_tickets.COUNTED | seen_tickets.IN_HISTORY)
+
+    def test_only_saves_what_changed(self):
+        seen = self._load()
+        seen.add(1, T0, seen_tickets.COUNTED)
+        seen.add(2, T0 + HOUR, seen_tickets.COUNTED)
+        self._save(seen)
+        seen.add(3, T0 + HOUR, seen_tickets.IN_HISTORY)
+        (values, evicted) = zendesk_reports._take_seen_ticket_changes(seen)
+        self.assertEqual(values, {str(H0 + 1): {
+            '2': seen_tickets.COUNTED, '3': seen_tickets.IN_HISTORY}})
+        self.assertEqual(evicted, [])
+
+    def test_evicted_buckets_are_deleted(self):
+        seen = self._load()
+        seen.add(1, T0, seen_tickets.COUNTED)
+        seen.add(2, T0 + HOUR, seen_tickets.COUNTED | seen_tickets.IN_HISTORY)
+        self._save(seen)
+
+        seen = self._load()
+        seen.add(3, T0 + 3 * HOUR, seen_tickets.IN_HISTORY)
+        self._save(seen)
+        self.assertEqual(sorted(self.store.get_all('zendesk_seen')),
+                         [str(H0 + 1), str(H0 + 3)])
+
+        loaded = self._load()
+        self.assertEqual(loaded.flags(1), 0)
+        self.assertEqual(loaded.flags(2),
+                         seen_tickets.COUNTED | seen_tickets.IN_HISTORY)
+        self.assertEqual(loaded.flags(3), seen_tickets.IN_HISTORY)
+        # And the horizon still holds for what we loaded.
+        loaded.add(4, T0 + 4 * HOUR, seen_tickets.COUNTED)
+        self.assertEqual(loaded.flags(2), 0)
+        self.assertEqual(loaded.evicted, {H0 + 1})
+
+    def test_horizon_for_a_backfill(self):
+        # What load_state remembers is enough for a backfill of
+        # backfill_days to find every ticket it counted last time.
+        days = 2
+        seen = self._load(seen_tickets.horizon_hours_for(days))
+        start = T0 + 1234
+        for hour in range(days * 24):
+            seen.add(hour, start + hour * HOUR, seen_tickets.COUNTED)
+        self._save(seen)
+        loaded = self._load(seen_tickets.horizon_hours_for(days))
+        loaded.add(-1, start + days * 24 * HOUR - 1, seen_tickets.COUNTED)
+        for hour in range(days * 24):
+            self.assertEqual(loaded.flags(hour), seen_tickets.COUNTED)
+
+
+if __name__ == '__main__':
+    unittest.main()
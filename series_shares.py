@@ -0,0 +1,132 @@
+"""What share of our tickets each kind of ticket makes up.
+
+A surge confined to one product area -- say tickets tagged mobile_app --
+can be lost in the noise of all our tickets together.  So besides all
+tickets, we also look at each "series" of tickets: those with a given
+value in some dimension, like a tag, a group_id or a brand_id.
+
+Keeping a whole hour-of-week baseline for every series would be a lot of
+state, so instead we assume each series makes up a steady share of our
+tickets, and expect its share of however many tickets the overall
+baseline expects.  For each series we keep just an exponentially decayed
+count of its tickets (and one more for all tickets), so old data fades
+out just like in baseline.py.
+
+Some dimensions, like tags, can have a great many values, so we only keep
+the max_per_dimension biggest series in each dimension, using the
+SpaceSaving algorithm: when a new value turns up and there's no room, it
+takes over the smallest series' count.  That can only over-estimate a
+series' share, which errs on the side of not alerting.
+"""
+
+import collections
+import math
+
+import baseline
+
+# Our key for the count of all tickets.
+TOTAL_KEY = ''
+
+
+def series_key(dimension, value):
+    """A string naming the series, e.g. to save it under."""
+    return '%s=%s' % (dimension, value)
+
+
+class SeriesShares(object):
+    """Decayed ticket counts for the biggest series in each dimension.
+
+    state, if given, is what to_state() returned last time.
+    """
+    def __init__(self, state=None, max_per_dimension=100,
+                 half_life=baseline.DEFAULT_HALF_LIFE):
+        self.max_per_dimension = max_per_dimension
+        self.half_life = half_life
+        # [decayed count, as of], for all tickets.
+        self._total = [0.0, 0]
+        # dimension -> value -> [decayed count, as of].
+        self._series = collections.defaultdict(dict)
+        for (key, entry) in (state or {}).items():
+            if key == TOTAL_KEY:
+                self._total = list(entry)
+            else:
+                (dimension, value) = key.split('=', 1)
+                self._series[dimension][value] = list(entry)
+        # The keys we've changed, and evicted, since we were loaded.
+        self.dirty = set()
+        self.evicted = set()
+
+    def _decay_to(self, entry, now):
+        """Decay the count in entry to as of now, and return it."""
+        if now > entry[1]:
+            entry[0] *= math.pow(0.5, (now - entry[1]) / self.half_life)
+            entry[1] = now
+        return entry
+
+    def _make_room(self, dimension, now):
+        """Return a new entry for a series in dimension, evicting the
+        smallest series there if it's full."""
+        values = self._series[dimension]
+        if len(values) < self.max_per_dimension:
+            return [0.0, now]
+        smallest = min(values,
+                       key=lambda value: self._decay_to(values[value],
+                                                        now)[0])
+        smallest_count = values.pop(smallest)[0]
+        self.evicted.add(series_key(dimension, smallest))
+        return [smallest_count, now]
+
+    def observe(self, num_tickets, series_counts, now):
+        """Record num_tickets more tickets, of which series_counts (as
+        from TicketBatch.count_series) were in each series."""
+        self._decay_to(self._total, now)[0] += num_tickets
+        self.dirty.add(TOTAL_KEY)
+        for ((dimension, value), count) in series_counts.items():
+            values = self._series[dimension]
+            entry = values.get(value)
+            if entry is None:
+                entry = values[value] = self._make_room(dimension, now)
+            self._decay_to(entry, now)[0] += count
+            key = series_key(dimension, value)
+            self.dirty.add(key)
+            self.evicted.discard(key)
+
+    def all_series(self):
+        """Return every (dimension, value) series we're keeping track of."""
+        return [(dimension, value)
+                for (dimension, values) in self._series.items()
+                for value in values]
+
+    def share(self, series):
+        """The share of all tickets we think are in series, or 0 if we
+        don't know it."""
+        (dimension, value) = series
+        entry = self._series.get(dimension, {}).get(value)
+        if entry is None or not self._total[0]:
+            return 0.0
+        # Decay both to the same time before we compare them.
+        now = max(entry[1], self._total[1])
+        count = self._decay_to(list(entry), now)[0]
+        total = self._decay_to(list(self._total), now)[0]
+        return min(count / total, 1.0)
+
+    def _entry(self, key):
+        if key == TOTAL_KEY:
+            return self._total
+        (dimension, value) = key.split('=', 1)
+        return self._series.get(dimension, {}).get(value)
+
+    def to_state(self, keys=None):
+        """Return the data for the given keys (default: all of them), to
+        save and later pass back in as state."""
+        if keys is None:
+            keys = [TOTAL_KEY] + [series_key(dimension, value)
+                                  for (dimension, values)
+                                  in self._series.items()
+                                  for value in values]
+        state = {}
+        for key in keys:
+            entry = self._entry(key)
+            if entry is not None:
+                state[key] = entry
+        return state
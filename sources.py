@@ -0,0 +1,201 @@
+"""The places we get reports from, as plugins for monitor.py.
+
+We used to run a script per source, each with its own copy of fetching,
+state and alerting, and each needing a cron job (or daemon) of its own.
+Now each source is a Source: it loads what it keeps between polls from
+the StateStore we share, polls, and saves.  monitor.py polls them all,
+at once, from one process, so they also share our HTTP connections (see
+util.urlopen) and alerting (see alerts.py).
+
+Most sources just count reports, and alert on any series of them that's
+coming in faster than usual.  A CountingSource only needs to say how to
+    fetch_since(cursor): get the reports since the cursor it returned
+        last time,
+    is_wanted(report): whether to count a report, and
+    series_keys(report): which series to count it in,
+and it scores each series against its long-run rate, like
+util.probability, and alerts about those that look elevated.  Zendesk,
+which we watch more closely, has a detector of its own (see
+zendesk_reports.poll).
+
+To add a source, write a Source (usually a CountingSource) and add it to
+SOURCES.
+"""
+
+import collections
+import importlib
+import os
+import sys
+import threading
+import time
+
+import alerts
+import metrics
+import state_store
+import util
+
+# Source name -> (the module it's in, its class).  We only import the
+# modules for the sources we're asked to poll.
+SOURCES = {
+    'zendesk': ('zendesk_reports', 'ZendeskSource'),
+    'github': ('github_reports', 'GitHubSource'),
+    'jira': ('jira_reports', 'JiraSource'),
+}
+
+
+def _import(module_name):
+    """Import module_name, unless it's the script we're running (e.g.
+    ./zendesk_reports.py runs monitor.py for its source), in which case
+    we use that: importing it again would make a second copy, with its
+    own rate limiters, ticket filter and so on."""
+    main = sys.modules['__main__']
+    main_file = getattr(main, '__file__', None)
+    if (module_name not in sys.modules and main_file is not None and
+            os.path.splitext(os.path.basename(main_file))[0] ==
+            module_name):
+        return main
+    return importlib.import_module(module_name)
+
+
+def load_source(name, store, **options):
+    """Return the Source called name, loaded from store.  options are
+    passed on to it (e.g. Zendesk's backfill_days)."""
+    (module_name, class_name) = SOURCES[name]
+    return getattr(_import(module_name), class_name)(store, **options)
+
+
+class Source(object):
+    """Somewhere we poll for reports.
+
+    Subclasses set name, and fill in poll() (and save() and close(), if
+    they keep anything that needs it).  monitor.py holds lock while it
+    calls any of those, so they're never called at once.
+    """
+    name = None
+    # How often monitor.py polls us, in seconds, unless told otherwise.
+    poll_interval = 300
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+
+    def poll(self):
+        """Look for new reports, and alert if there are too many."""
+        raise NotImplementedError
+
+    def save(self):
+        """Save anything poll() hasn't saved already."""
+        pass
+
+    def close(self):
+        pass
+
+
+class CountingSource(Source):
+    """A source whose reports we count by series, and alert about when a
+    series' count is unusually high for its long-run rate.
+
+    We keep our state in the store under our name: for each series,
+    {"num_errors": how many reports we've counted in it}, along with
+    "elapsed_time" (how long we've been counting, in seconds),
+    "last_time" (when we last polled) and our cursor, under cursor_key.
+    """
+    # Where we keep our cursor in our state.
+    cursor_key = 'cursor'
+    # Where we alert, and how sure we need to be, and how many reports we
+    # need to see in a series, before we do.
+    slack_channels = ()
+    alert_probability = 0.997
+    min_reports_to_alert = 2
+
+    def __init__(self, store):
+        super(CountingSource, self).__init__(store)
+        self.reports = self.load()
+
+    def load(self):
+        """Return our state, as saved in the store."""
+        return self.store.get_all(self.name) or {
+            self.cursor_key: None, 'elapsed_time': 0,
+            'last_time': time.time()}
+
+    def _is_series(self, key):
+        return key not in (self.cursor_key, 'elapsed_time', 'last_time')
+
+    def fetch_since(self, cursor):
+        """Return the reports since cursor (None the first time), and the
+        cursor to pass next time."""
+        raise NotImplementedError
+
+    def is_wanted(self, report):
+        return True
+
+    def series_keys(self, report):
+        """Return the series to count report in."""
+        raise NotImplementedError
+
+    def alert_heading(self, series, reports):
+        """The start of the alert about series, given this poll's reports
+        in it."""
+        return '*Elevated %s report rate in `%s`*\n' % (self.name, series)
+
+    def poll(self):
+        """Count reports since we last polled, alert on any series with
+        too many, and save the changes to the store."""
+        old_reports = self.reports
+        (new, cursor) = self.fetch_since(old_reports[self.cursor_key])
+        now = time.time()
+        period_len = now - old_reports['last_time']
+
+        by_series = collections.defaultdict(list)
+        for report in new:
+            if self.is_wanted(report):
+                for series in self.series_keys(report):
+                    by_series[series].append(report)
+
+        # Score every series with a history in one batch.
+        scored = [series for (series, value) in old_reports.items()
+                  if self._is_series(series) and value['num_errors'] > 0]
+        (means, probabilities) = util.probabilities(
+            [old_reports[series]['num_errors'] for series in scored],
+            old_reports['elapsed_time'],
+            [len(by_series.get(series, ())) for series in scored],
+            period_len)
+
+        for (series, mean, probability) in zip(scored, means,
+                                               probabilities):
+            count = len(by_series.get(series, ()))
+            print("%s] %s %s: %s/%ss; %s-: %s/%ss; m=%.3f p=%.3f"
+                  % (time.strftime("%Y-%m-%d %H:%M:%S %Z"), self.name,
+                     series, old_reports[series]['num_errors'],
+                     old_reports['elapsed_time'], old_reports['last_time'],
+                     count, period_len, mean, probability))
+
+            if count >= max(self.min_reports_to_alert,
+                            util.poisson_critical_count(
+                                mean, self.alert_probability)):
+                alerts.DISPATCHER.send(
+                    '%s:%s' % (self.name, series),
+                    "%sWe saw %s in the last %s minutes,"
+                    " while the mean indicates we should see around %s."
+                    " *Probability that this is abnormally elevated: %.4f.*"
+                    % (self.alert_heading(series, by_series[series]),
+                       util.thousand_commas(count),
+                       util.thousand_commas(int(period_len / 60)),
+                       util.thousand_commas(round(mean, 2)),
+                       probability),
+                    slack_channels=self.slack_channels)
+
+        new_reports = dict(old_reports)
+        for (series, series_reports) in by_series.items():
+            new_reports[series] = {
+                'num_errors': (old_reports.get(series, {}).get('num_errors',
+                                                               0) +
+                               len(series_reports))}
+        new_reports[self.cursor_key] = cursor
+        new_reports['elapsed_time'] = old_reports['elapsed_time'] + period_len
+        new_reports['last_time'] = now
+        self.store.update(self.name, state_store.changed_values(old_reports,
+                                                                new_reports))
+        self.reports = new_reports
+        metrics.set_gauge('beep_boop_last_poll_timestamp_seconds',
+                          time.time(), source=self.name)
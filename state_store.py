@@ -0,0 +1,108 @@
+"""A small crash-safe key/value store for the state we keep between runs.
+
+We used to pickle (or JSON-dump) each script's whole state every run,
+which costs more the more series we track, and can leave a half-written
+file behind if we die at the wrong moment.  Instead we keep everything in
+one SQLite database in WAL mode, in (namespace, key) -> JSON value rows,
+and each run only writes the rows that changed, in a single transaction.
+"""
+
+import contextlib
+import json
+import sqlite3
+import threading
+
+import util
+
+STATE_FILE = util.relative_path("beep_boop_state.sqlite3")
+
+
+class StateStore(object):
+    """Namespaced, JSON-valued state, stored in a SQLite database.
+
+    It's safe to share one StateStore between threads.  Updates outside
+    a transaction() block are each committed atomically on their own.
+    """
+    def __init__(self, filename=STATE_FILE):
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._transaction_depth = 0
+        # We manage transactions ourselves, hence isolation_level=None.
+        self._conn = sqlite3.connect(filename, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS state ('
+                           ' namespace TEXT NOT NULL,'
+                           ' key TEXT NOT NULL,'
+                           ' value TEXT NOT NULL,'
+                           ' PRIMARY KEY (namespace, key)'
+                           ') WITHOUT ROWID')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group several updates into one atomic write.
+
+        Transactions may nest; only the outermost one commits.
+        """
+        with self._lock:
+            if self._transaction_depth == 0:
+                self._conn.execute('BEGIN IMMEDIATE')
+            self._transaction_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    self._conn.execute('ROLLBACK')
+                raise
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self._conn.execute('COMMIT')
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM state WHERE namespace = ? AND key = ?',
+                (namespace, key)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def get_all(self, namespace):
+        """Return everything in namespace, as a dict."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT key, value FROM state WHERE namespace = ?',
+                (namespace,)).fetchall()
+        return {key: json.loads(value) for (key, value) in rows}
+
+    def update(self, namespace, values):
+        """Set the keys in the dict values, leaving other keys alone."""
+        if not values:
+            return
+        with self.transaction():
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO state (namespace, key, value)'
+                ' VALUES (?, ?, ?)',
+                [(namespace, key, json.dumps(value))
+                 for (key, value) in values.items()])
+
+    def delete(self, namespace, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        with self.transaction():
+            self._conn.executemany(
+                'DELETE FROM state WHERE namespace = ? AND key = ?',
+                [(namespace, key) for key in keys])
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def changed_values(old, new):
+    """Return the entries of the dict new that differ from those in old."""
+    return {key: value for (key, value) in new.items()
+            if key not in old or old[key] != value}
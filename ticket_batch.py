@@ -0,0 +1,146 @@
+"""A compact, sorted batch of tickets, and fast parsing of their times.
+
+A poll used to keep a list of ticket dicts, parse each one's created_at
+up to three times (to sort them, to learn from them, and to list them in
+an alert), and look at its tags through a list of strings.  A surge, or
+a backfill of a week, is a lot of tickets to do that for.
+
+Instead, a TicketBatch keeps just what we use, in parallel columns,
+sorted by creation time: each ticket's id, its creation time as an int
+time_t (parsed once), a bitmask of its tags (a bit for each distinct tag
+in the batch), its subject (interned, since in a surge many are the
+same), and any other fields we're asked to keep.
+"""
+
+import array
+import calendar
+import collections
+import re
+import sys
+import time
+
+# Day ('YYYY-MM-DD') -> time_t of its start, in UTC.
+_day_starts = {}
+# What comes after the seconds in a time ('Z', ' -0700', '+00:00', '') ->
+# its offset from UTC in seconds, or None for local time.
+_offsets = {}
+# We don't let those caches grow past this.
+_MAX_CACHED = 10000
+
+_OFFSET_RE = re.compile(r'^(?:\.\d+)?\s*(?:(Z)|([+-])(\d\d):?(\d\d))?$')
+
+
+def _offset_seconds(suffix):
+    offset = _offsets.get(suffix)
+    if offset is None and suffix not in _offsets:
+        match = _OFFSET_RE.match(suffix)
+        if match is None:
+            raise ValueError('Bad time zone in time: %r' % suffix)
+        (zulu, sign, hours, minutes) = match.groups()
+        if zulu:
+            offset = 0
+        elif sign:
+            offset = (int(hours) * 3600 + int(minutes) * 60) * (
+                -1 if sign == '-' else 1)
+        if len(_offsets) > _MAX_CACHED:
+            _offsets.clear()
+        _offsets[suffix] = offset
+    return offset
+
+
+def parse_time(s):
+    """Convert a time like "YYYY-MM-DD HH:MM:SS -0700" (or an ISO 8601
+    one, like "YYYY-MM-DDTHH:MM:SSZ") to an int time_t.
+
+    A time without a UTC offset is taken to be in local time.  Since we
+    parse the same few days and offsets over and over, we cache those,
+    and the rest is arithmetic.
+    """
+    offset = _offset_seconds(s[19:])
+    if offset is None:
+        return int(time.mktime((int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                                int(s[11:13]), int(s[14:16]),
+                                int(s[17:19]), 0, 0, -1)))
+    day = s[:10]
+    day_start = _day_starts.get(day)
+    if day_start is None:
+        day_start = calendar.timegm((int(s[0:4]), int(s[5:7]),
+                                     int(s[8:10]), 0, 0, 0))
+        if len(_day_starts) > _MAX_CACHED:
+            _day_starts.clear()
+        _day_starts[day] = day_start
+    return (day_start + int(s[11:13]) * 3600 + int(s[14:16]) * 60 +
+            int(s[17:19]) - offset)
+
+
+class TicketBatch(object):
+    """Tickets (dicts, as from the export), sorted by creation time.
+
+    Besides 'id', 'created_at', 'current_tags' and 'subject', we keep
+    the fields named in fields, as a list each in self.fields.
+    """
+    def __init__(self, tickets=(), fields=()):
+        rows = sorted(((parse_time(ticket['created_at']), ticket)
+                       for ticket in tickets),
+                      key=lambda row: row[0])
+        self.times = array.array('q', [time_t for (time_t, _) in rows])
+        self.ids = array.array('q', [ticket['id'] for (_, ticket) in rows])
+        self.subjects = [sys.intern(ticket.get('subject') or '')
+                         for (_, ticket) in rows]
+        # The tag for each bit in a mask, and the bit for each tag.
+        self.tag_names = []
+        self._tag_bits = {}
+        self.tag_masks = [self._tag_mask(ticket.get('current_tags') or ())
+                          for (_, ticket) in rows]
+        self.fields = {field: [ticket.get(field) for (_, ticket) in rows]
+                       for field in fields}
+
+    def _tag_mask(self, tags):
+        mask = 0
+        for tag in tags:
+            bit = self._tag_bits.get(tag)
+            if bit is None:
+                bit = self._tag_bits[tag] = len(self.tag_names)
+                self.tag_names.append(tag)
+            mask |= 1 << bit
+        return mask
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def oldest_time(self):
+        """The creation time of the oldest ticket, or None if we have
+        none."""
+        return self.times[0] if self.times else None
+
+    def count_series(self, dimensions, ignore=()):
+        """Return a Counter of how many tickets are in each (dimension,
+        value) series (see series_shares.py), except those in ignore.
+
+        'current_tags' puts a ticket in a series for each of its tags;
+        any other dimension must be one of our fields.  Values are
+        always strings.
+        """
+        counts = collections.Counter()
+        for dimension in dimensions:
+            if dimension == 'current_tags':
+                # Tickets in a surge tend to have the same tags, so we
+                # count each distinct set of them once.
+                bit_counts = collections.Counter()
+                for (mask, count) in collections.Counter(
+                        self.tag_masks).items():
+                    while mask:
+                        low_bit = mask & -mask
+                        bit_counts[low_bit.bit_length() - 1] += count
+                        mask ^= low_bit
+                for (bit, count) in bit_counts.items():
+                    counts[(dimension, str(self.tag_names[bit]))] = count
+            else:
+                for (value, count) in collections.Counter(
+                        self.fields[dimension]).items():
+                    if value is not None:
+                        counts[(dimension, str(value))] = count
+        for series in ignore:
+            counts.pop(series, None)
+        return counts
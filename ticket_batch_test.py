@@ -0,0 +1,122 @@
+"""Tests for ticket_batch.py.  Run with
+    python -m unittest ticket_batch_test
+"""
+
+import calendar
+import os
+import time
+import unittest
+import unittest.mock
+
+import iso8601
+
+import ticket_batch
+
+
+def _iso8601_time_t(s):
+    """What iso8601 makes of s, as a time_t.  (It wants no space before
+    the offset, as the export puts there.)"""
+    s = s.replace(' +', '+').replace(' -', '-')
+    return calendar.timegm(iso8601.parse_date(s).utctimetuple())
+
+
+class ParseTimeTest(unittest.TestCase):
+    def setUp(self):
+        # Start each test with empty caches.
+        patcher = unittest.mock.patch.multiple(
+            ticket_batch, _day_starts={}, _offsets={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assert_parses(self, s, time_t):
+        self.assertEqual(ticket_batch.parse_time(s), time_t, s)
+        self.assertEqual(_iso8601_time_t(s), time_t, s)
+
+    def test_offsets(self):
+        time_t = 1500000000     # 2017-07-14 02:40:00 UTC
+        for s in ('2017-07-14T02:40:00Z',
+                  '2017-07-14 02:40:00Z',
+                  '2017-07-14T02:40:00+00:00',
+                  '2017-07-14 02:40:00 +0000',
+                  '2017-07-13 19:40:00 -0700',
+                  '2017-07-13T19:40:00-07:00',
+                  '2017-07-13T19:40:00-0700',
+                  '2017-07-14T08:10:00+05:30',
+                  '2017-07-14 08:10:00 +0530',
+                  '2017-07-13T23:10:00-03:30'):
+            self.assert_parses(s, time_t)
+
+    def test_fractional_seconds(self):
+        # We round down to the second, as time_t's always have.
+        for s in ('2017-07-14T02:40:00.999Z',
+                  '2017-07-14T02:40:00.1+00:00',
+                  '2017-07-13T19:40:00.123456-07:00',
+                  '2017-07-13 19:40:00.5 -0700'):
+            self.assert_parses(s, 1500000000)
+
+    def test_across_days(self):
+        # Leap days, year ends and midnights, each way of a time zone.
+        for s in ('2016-02-29T23:59:59Z', '2016-03-01 00:00:00 +0100',
+                  '2016-12-31 23:30:00 -0100', '2000-01-01T00:00:00Z',
+                  '2038-01-19T03:14:08Z'):
+            self.assertEqual(ticket_batch.parse_time(s), _iso8601_time_t(s),
+                             s)
+
+    def test_local_time(self):
+        patcher = unittest.mock.patch.dict(os.environ,
+                                           {'TZ': 'America/Denver'})
+        patcher.start()
+        self.addCleanup(time.tzset)
+        self.addCleanup(patcher.stop)
+        time.tzset()
+        # Daylight saving time, and not.
+        self.assertEqual(ticket_batch.parse_time('2017-07-13 20:40:00'),
+                         1500000000)
+        self.assertEqual(ticket_batch.parse_time('2017-01-13 19:40:00'),
+                         1484361600)
+
+    def test_bad_offsets(self):
+        for s in ('2017-07-14T02:40:00 PST', '2017-07-14T02:40:00+7',
+                  '2017-07-14T02:40:00Zulu'):
+            with self.assertRaises(ValueError, msg=s):
+                ticket_batch.parse_time(s)
+
+    def test_caches_day_starts(self):
+        ticket_batch.parse_time('2017-07-14T02:40:00Z')
+        ticket_batch.parse_time('2017-07-14T23:59:59-07:00')
+        ticket_batch.parse_time('2017-07-13 19:40:00 -0700')
+        self.assertEqual(ticket_batch._day_starts,
+                         {'2017-07-14': 1499990400,
+                          '2017-07-13': 1499990400 - 86400})
+        self.assertEqual(ticket_batch._offsets,
+                         {'Z': 0, '-07:00': -7 * 3600, ' -0700': -7 * 3600})
+
+        # We use what we cached rather than working it out again.
+        ticket_batch._day_starts['2017-07-14'] += 1
+        self.assertEqual(ticket_batch.parse_time('2017-07-14T02:40:00Z'),
+                         1500000001)
+
+    def test_caches_stay_small(self):
+        with unittest.mock.patch.object(ticket_batch, '_MAX_CACHED', 10):
+            for day in range(1, 29):
+                ticket_batch.parse_time('2017-02-%02dT00:00:00Z' % day)
+                self.assertLessEqual(len(ticket_batch._day_starts), 11)
+            self.assertEqual(
+                ticket_batch.parse_time('2017-02-28T00:00:00Z'),
+                _iso8601_time_t('2017-02-28T00:00:00Z'))
+
+
+class TicketBatchTest(unittest.TestCase):
+    def test_sorted_by_creation_time(self):
+        batch = ticket_batch.TicketBatch([
+            {'id': 1, 'created_at': '2017-07-14 02:40:00 +0000'},
+            {'id': 2, 'created_at': '2017-07-13T19:39:59-07:00'},
+            {'id': 3, 'created_at': '2017-07-14T02:40:01Z'}])
+        self.assertEqual(list(batch.ids), [2, 1, 3])
+        self.assertEqual(list(batch.times),
+                         [1499999999, 1500000000, 1500000001])
+        self.assertEqual(batch.oldest_time, 1499999999)
+
+
+if __name__ == '__main__':
+    unittest.main()
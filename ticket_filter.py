@@ -0,0 +1,175 @@
+"""Decide which Zendesk tickets we count, from a declarative config.
+
+Which tickets mean "a user hit a problem" changes over time -- new tags,
+new kinds of test tickets, new brands -- so rather than a chain of if's
+in the code, the rules live in a config: tags a ticket must have, tags it
+mustn't have, subjects to ignore, and which values of other fields (like
+brand_id or group_id) to require or ignore.  If zendesk_filter.json
+exists, that's our config; otherwise we use DEFAULT_CONFIG.  For example:
+    {"required_tags": ["technical_issue"],
+     "excluded_tags": ["spam", "translation_advocate"],
+     "excluded_subject_patterns": ["Request created from:"],
+     "required_fields": {"brand_id": [360000123]},
+     "excluded_fields": {"group_id": [360000456]}}
+Subject patterns are regular expressions, searched for anywhere in the
+subject.
+
+We compile the config once, so checking a ticket is a couple of set
+operations and at most one regex search, and we count how many tickets
+each rule drops, so we can see what we're leaving out.
+"""
+
+import collections
+import json
+import os
+import re
+import threading
+
+import util
+
+FILTER_CONFIG_FILE = util.relative_path("zendesk_filter.json")
+
+DEFAULT_CONFIG = {
+    # We only care about technical issues.
+    'required_tags': ['technical_issue'],
+    'excluded_tags': [
+        # Translation advocate tickets can be used for testing, and don't
+        # indicate a user-visible problem.
+        'translation_advocate',
+        # We don't care about spam, and don't want it to trigger alerts.
+        'spam',
+    ],
+    'excluded_subject_patterns': [
+        # Tickets created by user-support are submitted in batches, and
+        # cause false alarms.
+        'Request created from:',
+    ],
+    # Field name -> the values we require, or ignore.
+    'required_fields': {},
+    'excluded_fields': {},
+}
+
+# The key in TicketFilter.hits for tickets that no rule dropped.
+KEPT = 'kept'
+
+# How we got a ticket, for TicketFilter.hits: by polling the export, or
+# from a webhook.
+EXPORT = 'export'
+WEBHOOK = 'webhook'
+
+
+def load_config(filename=FILTER_CONFIG_FILE):
+    """Return the filter config from filename, or DEFAULT_CONFIG if there
+    isn't one.  Keys the file leaves out mean "no rules of that kind"."""
+    if not os.path.exists(filename):
+        return DEFAULT_CONFIG
+    with open(filename) as f:
+        config = json.load(f)
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError('Unknown filter rules in %s: %s'
+                         % (filename, ', '.join(sorted(unknown))))
+    return config
+
+
+class TicketFilter(object):
+    """A compiled filter config.  Call it on a ticket to find out whether
+    we should count it.
+
+    hits counts how many tickets each rule has dropped (and, under KEPT,
+    how many we kept), by how we got them (EXPORT or WEBHOOK) and then a
+    short description of the rule.  If several rules would drop a
+    ticket, only the first to match is counted, in the order: required
+    tags, excluded tags, subjects, required fields, excluded fields.  We
+    count each ticket (by id) once per way we got it until take_hits(),
+    however many times we're asked about it: overlapping backfill
+    partitions, say, both get some of the same tickets.  It's safe to
+    call from several threads at once.
+    """
+    def __init__(self, config=DEFAULT_CONFIG):
+        # Every ticket we keep has all of these.
+        self.required_tags = frozenset(config.get('required_tags', ()))
+        self._excluded_tags = frozenset(config.get('excluded_tags', ()))
+        # We describe each rule ahead of time, to keep drops cheap.
+        self._missing_tag_rules = {tag: 'missing tag %s' % tag
+                                   for tag in self.required_tags}
+        self._excluded_tag_rules = {tag: 'tag %s' % tag
+                                    for tag in self._excluded_tags}
+
+        patterns = list(config.get('excluded_subject_patterns', ()))
+        if patterns:
+            # We check all the patterns in one search.  (We don't use a
+            # named group per pattern, to tell which matched: that stops
+            # the regex engine from scanning for literal prefixes, which
+            # makes every search an order of magnitude slower.)
+            self._subject_re = re.compile('|'.join(
+                '(?:%s)' % pattern for pattern in patterns))
+        else:
+            self._subject_re = None
+        # Only for finding which pattern matched, once we know one did.
+        self._subject_rules = [(re.compile(pattern), 'subject /%s/' % pattern)
+                               for pattern in patterns]
+
+        self._required_fields = [
+            (field, frozenset(values),
+             '%s not in %s' % (field, ', '.join(map(str, values))))
+            for (field, values)
+            in sorted(config.get('required_fields', {}).items())]
+        self._excluded_fields = [
+            (field, frozenset(values), '%s in %s' % (
+                field, ', '.join(map(str, values))))
+            for (field, values)
+            in sorted(config.get('excluded_fields', {}).items())]
+
+        # The ticket fields we look at.
+        self.fields = ('current_tags', 'subject') + tuple(sorted(
+            set(field for (field, _, _) in
+                self._required_fields + self._excluded_fields)))
+
+        self.hits = collections.defaultdict(collections.Counter)
+        # How we got a ticket -> the ids of those we've counted in hits.
+        self._counted = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def drop_reason(self, ticket):
+        """Return the rule that drops ticket, or None if we keep it."""
+        tags = ticket['current_tags']
+        if self.required_tags and not self.required_tags.issubset(tags):
+            return self._missing_tag_rules[
+                min(self.required_tags.difference(tags))]
+        if not self._excluded_tags.isdisjoint(tags):
+            return self._excluded_tag_rules[
+                min(self._excluded_tags.intersection(tags))]
+
+        if self._subject_re is not None:
+            subject = ticket['subject'] or ''
+            if self._subject_re.search(subject):
+                for (pattern_re, rule) in self._subject_rules:
+                    if pattern_re.search(subject):
+                        return rule
+
+        for (field, values, rule) in self._required_fields:
+            if ticket.get(field) not in values:
+                return rule
+        for (field, values, rule) in self._excluded_fields:
+            if ticket.get(field) in values:
+                return rule
+
+        return None
+
+    def __call__(self, ticket, via=EXPORT):
+        reason = self.drop_reason(ticket)
+        with self._lock:
+            counted = self._counted[via]
+            if ticket['id'] not in counted:
+                counted.add(ticket['id'])
+                self.hits[via][reason or KEPT] += 1
+        return reason is None
+
+    def take_hits(self, via=EXPORT):
+        """Return the hit counts so far for tickets we got via via, and
+        start counting those again."""
+        with self._lock:
+            hits = self.hits.pop(via, collections.Counter())
+            self._counted.pop(via, None)
+        return hits
@@ -0,0 +1,158 @@
+"""Tests for ticket_filter.py.  Run with
+    python -m unittest ticket_filter_test
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import ticket_filter
+
+
+def _old_is_wanted(ticket):
+    """The checks we made before we had a filter config."""
+    tags = ticket['current_tags']
+    return ('technical_issue' in tags and
+            'translation_advocate' not in tags and
+            'spam' not in tags and
+            'Request created from:' not in ticket['subject'])
+
+
+def _ticket(ticket_id=1, tags=('technical_issue',), subject='Help',
+            **fields):
+    return dict(fields, id=ticket_id, current_tags=list(tags),
+                subject=subject)
+
+
+class DefaultConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.filter = ticket_filter.TicketFilter()
+
+    def test_same_as_the_old_checks(self):
+        tag_sets = [(), ('technical_issue',), ('spam',),
+                    ('technical_issue', 'spam'),
+                    ('technical_issue', 'translation_advocate'),
+                    ('technical_issue', 'other', 'more'),
+                    ('translation_advocate', 'spam', 'technical_issue')]
+        subjects = ['Video will not play', 'Request created from: Bob',
+                    'Re: Request created from: x', 'request created from:',
+                    '']
+        ticket_id = 0
+        for tags in tag_sets:
+            for subject in subjects:
+                ticket_id += 1
+                ticket = _ticket(ticket_id, tags, subject)
+                self.assertEqual(self.filter(ticket), _old_is_wanted(ticket),
+                                 ticket)
+
+    def test_drop_reasons(self):
+        self.assertEqual(self.filter.drop_reason(_ticket(tags=())),
+                         'missing tag technical_issue')
+        self.assertEqual(self.filter.drop_reason(
+            _ticket(tags=('technical_issue', 'spam'))), 'tag spam')
+        # Only the first rule that drops a ticket is counted.
+        self.assertEqual(self.filter.drop_reason(
+            _ticket(tags=('spam',), subject='Request created from: x')),
+            'missing tag technical_issue')
+        self.assertEqual(self.filter.drop_reason(
+            _ticket(subject='Request created from: x')),
+            'subject /Request created from:/')
+        self.assertIsNone(self.filter.drop_reason(_ticket()))
+
+    def test_no_subject(self):
+        self.assertTrue(self.filter(_ticket(subject=None)))
+
+    def test_hits(self):
+        self.filter(_ticket(1))
+        self.filter(_ticket(2))
+        self.filter(_ticket(3, tags=('technical_issue', 'spam')))
+        self.assertEqual(self.filter.take_hits(),
+                         {ticket_filter.KEPT: 2, 'tag spam': 1})
+        self.assertEqual(self.filter.take_hits(), {})
+
+    def test_hits_count_each_ticket_once(self):
+        # As when overlapping backfill partitions both get a ticket.
+        for _ in range(3):
+            self.assertTrue(self.filter(_ticket(1)))
+            self.assertFalse(self.filter(_ticket(2, tags=())))
+        self.assertEqual(self.filter.take_hits(),
+                         {ticket_filter.KEPT: 1,
+                          'missing tag technical_issue': 1})
+        # But once we've taken them, we count it again.
+        self.filter(_ticket(1))
+        self.assertEqual(self.filter.take_hits(), {ticket_filter.KEPT: 1})
+
+    def test_hits_by_how_we_got_the_ticket(self):
+        self.filter(_ticket(1))
+        self.filter(_ticket(1), ticket_filter.WEBHOOK)
+        self.filter(_ticket(2, tags=('technical_issue', 'spam')),
+                    ticket_filter.WEBHOOK)
+        self.assertEqual(self.filter.take_hits(ticket_filter.WEBHOOK),
+                         {ticket_filter.KEPT: 1, 'tag spam': 1})
+        self.assertEqual(self.filter.take_hits(ticket_filter.EXPORT),
+                         {ticket_filter.KEPT: 1})
+
+
+class ConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'zendesk_filter.json')
+
+    def _load(self, config):
+        with open(self.filename, 'w') as f:
+            json.dump(config, f)
+        return ticket_filter.TicketFilter(
+            ticket_filter.load_config(self.filename))
+
+    def test_no_file_means_the_default(self):
+        self.assertEqual(ticket_filter.load_config(self.filename),
+                         ticket_filter.DEFAULT_CONFIG)
+
+    def test_left_out_rules_mean_none(self):
+        wanted = self._load({'excluded_tags': ['spam']})
+        self.assertTrue(wanted(_ticket(tags=())))
+        self.assertTrue(wanted(_ticket(subject='Request created from: x')))
+        self.assertFalse(wanted(_ticket(tags=('spam',))))
+
+    def test_required_and_excluded_tags(self):
+        wanted = self._load({'required_tags': ['a', 'b'],
+                             'excluded_tags': ['c']})
+        self.assertTrue(wanted(_ticket(1, ('a', 'b', 'd'))))
+        self.assertFalse(wanted(_ticket(2, ('a',))))
+        self.assertFalse(wanted(_ticket(3, ('a', 'b', 'c'))))
+        self.assertEqual(wanted.drop_reason(_ticket(tags=())),
+                         'missing tag a')
+
+    def test_subject_patterns(self):
+        wanted = self._load({'excluded_subject_patterns': [
+            '^Test', r'order #\d+']})
+        self.assertTrue(wanted(_ticket(1, subject='A Test')))
+        self.assertFalse(wanted(_ticket(2, subject='Testing 1 2 3')))
+        self.assertFalse(wanted(_ticket(3, subject='Re: order #123')))
+        self.assertTrue(wanted(_ticket(4, subject='order #x')))
+        self.assertEqual(
+            wanted.drop_reason(_ticket(subject='about order #5')),
+            r'subject /order #\d+/')
+
+    def test_fields(self):
+        wanted = self._load({'required_fields': {'brand_id': [1, 2]},
+                             'excluded_fields': {'group_id': [9]}})
+        self.assertEqual(wanted.fields,
+                         ('current_tags', 'subject', 'brand_id', 'group_id'))
+        self.assertTrue(wanted(_ticket(1, brand_id=1, group_id=8)))
+        self.assertFalse(wanted(_ticket(2, brand_id=3)))
+        self.assertFalse(wanted(_ticket(3, group_id=8)))
+        self.assertFalse(wanted(_ticket(4, brand_id=2, group_id=9)))
+        self.assertEqual(wanted.drop_reason(_ticket(brand_id=2, group_id=9)),
+                         'group_id in 9')
+
+    def test_unknown_rules(self):
+        with self.assertRaises(ValueError):
+            self._load({'required_tag': ['a']})
+
+
+if __name__ == '__main__':
+    unittest.main()
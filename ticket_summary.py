@@ -0,0 +1,142 @@
+"""Group a surge's tickets by what they say, to list in an alert.
+
+We used to list every ticket in an alert, which in a real incident meant
+a Slack message hundreds of lines long.  But in an incident, most of the
+tickets are about the same thing, and say so in much the same words.
+
+So we group tickets whose subjects are near-duplicates -- "Video won't
+play" and "video wont play!!" -- and list each group once, biggest first,
+with how many tickets are in it.  To find near-duplicates without
+comparing every pair of subjects, we use MinHash: we cut each subject
+into overlapping runs of SHINGLE_SIZE characters ("shingles"), and hash
+them NUM_HASHES different ways, keeping the smallest hash each way.  Two
+subjects agree on each smallest hash with probability equal to the share
+of shingles they have in common (their Jaccard similarity).  We then
+split those hashes into bands, and only compare a subject with those
+that agree with it on every hash in some band ("locality-sensitive
+hashing"), which finds most subjects more similar than about 0.3, and
+few less similar than that.
+
+Each group is led by its first ticket, and we add a ticket to the group
+whose leader it's most similar to, if that's at least MIN_SIMILARITY.
+That's all linear in the number of tickets, and we only look at up to
+MAX_TICKETS of them, so it takes bounded time however big the surge.
+"""
+
+import random
+import re
+import zlib
+
+# How many characters make a shingle.
+SHINGLE_SIZE = 3
+
+# How many hashes we keep for each subject, and how we split them into
+# bands: we compare subjects that agree on all the hashes in some band.
+NUM_HASHES = 24
+BANDS = 12
+ROWS_PER_BAND = NUM_HASHES // BANDS
+
+# How similar (by our MinHash estimate) a subject must be to a group's
+# leader to join it.  On made-up surges of typo-ridden subjects, this
+# put most of each kind of ticket into a few groups, without putting
+# different kinds together.
+MIN_SIMILARITY = 0.4
+
+# The most tickets we'll look at.  Beyond that we look at an evenly
+# spaced sample.
+MAX_TICKETS = 2000
+
+# A Mersenne prime, bigger than any crc32.
+_PRIME = (1 << 61) - 1
+# (a, b) for each of the hash functions (a * x + b) % _PRIME.  We want the
+# same ones every time, so that groups don't change from run to run.
+_rng = random.Random(0)
+_HASH_PARAMS = [(_rng.randrange(1, _PRIME), _rng.randrange(_PRIME))
+                for _ in range(NUM_HASHES)]
+del _rng
+
+_NON_WORD_RE = re.compile(r'[\W_]+')
+_DIGITS_RE = re.compile(r'\d+')
+
+
+def normalize(subject):
+    """Lowercase subject and drop punctuation, and numbers (which are
+    often ticket or order ids, and don't make tickets different)."""
+    subject = _DIGITS_RE.sub('0', (subject or '').lower())
+    return _NON_WORD_RE.sub(' ', subject).strip()
+
+
+def shingles(text):
+    """The set of SHINGLE_SIZE-character substrings of text."""
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE]
+            for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def minhash(text):
+    """Return text's NUM_HASHES-long MinHash signature, as a tuple."""
+    hashes = [zlib.crc32(shingle.encode('utf-8'))
+              for shingle in shingles(text)]
+    return tuple(min((a * x + b) % _PRIME for x in hashes)
+                 for (a, b) in _HASH_PARAMS)
+
+
+def similarity(signature1, signature2):
+    """Estimate the Jaccard similarity of the texts with these
+    signatures."""
+    return (sum(1 for (h1, h2) in zip(signature1, signature2) if h1 == h2)
+            / float(NUM_HASHES))
+
+
+def _bands(signature):
+    return [(band, signature[band * ROWS_PER_BAND:
+                             (band + 1) * ROWS_PER_BAND])
+            for band in range(BANDS)]
+
+
+def group_subjects(subjects, max_samples=3):
+    """Group tickets with near-duplicate subjects, given their subjects.
+
+    Returns a list of (number of tickets, the indices into subjects of up
+    to max_samples of them) for each group, biggest first, and how many
+    tickets we looked at (which is fewer than all of them if there were
+    more than MAX_TICKETS).
+    """
+    indices = range(len(subjects))
+    if len(subjects) > MAX_TICKETS:
+        step = len(subjects) / float(MAX_TICKETS)
+        indices = [int(i * step) for i in range(MAX_TICKETS)]
+
+    # Each group is [count, samples, leader's signature].
+    groups = []
+    # Normalized subject -> group, so exact duplicates are quick.
+    by_subject = {}
+    # (band, hashes) -> groups whose leader has those hashes there.
+    by_band = {}
+    for index in indices:
+        subject = normalize(subjects[index])
+        group = by_subject.get(subject)
+        if group is None:
+            signature = minhash(subject)
+            candidates = {id(candidate): candidate
+                          for band in _bands(signature)
+                          for candidate in by_band.get(band, ())}
+            best = max([(similarity(signature, candidate[2]), candidate)
+                        for candidate in candidates.values()],
+                       key=lambda pair: pair[0], default=(0, None))
+            if best[0] >= MIN_SIMILARITY:
+                group = best[1]
+            else:
+                group = [0, [], signature]
+                groups.append(group)
+                for band in _bands(signature):
+                    by_band.setdefault(band, []).append(group)
+            by_subject[subject] = group
+        group[0] += 1
+        if len(group[1]) < max_samples:
+            group[1].append(index)
+
+    groups.sort(key=lambda group: -group[0])
+    return ([(count, samples) for (count, samples, _) in groups],
+            len(indices))
@@ -1,10 +1,29 @@
+import codecs
 import collections
-import decimal
+import email.message
+import functools
+import gzip
+import hashlib
+import http.client
+import io
+import json
 import logging
+import math
 import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
 
 import alertlib
 
+import metrics
+
 
 def probability(past_errors,
                 past_time,
@@ -20,34 +39,235 @@ def probability(past_errors,
     return (mean, poisson_cdf(errors_this_period - 1, mean))
 
 
+def probabilities(past_errors,
+                  past_time,
+                  errors_this_period,
+                  time_this_period):
+    """Like probability, but for many series at once.
+
+    Each argument is either a sequence (one entry per series) or a single
+    number shared by every series -- e.g. all exercises share the same
+    past_time and time_this_period.  Returns a pair of lists: the means
+    and the probabilities, in the same order as the input series.
+    """
+    columns = [past_errors, past_time, errors_this_period, time_this_period]
+    num_series = None
+    for column in columns:
+        if not isinstance(column, (int, float)):
+            if num_series is None:
+                num_series = len(column)
+            elif len(column) != num_series:
+                raise ValueError('All series must have the same length')
+    if num_series is None:
+        num_series = 1
+    columns = [[column] * num_series if isinstance(column, (int, float))
+               else column
+               for column in columns]
+
+    means = [(errors * 1.0 / elapsed) * period
+             for (errors, elapsed, period)
+             in zip(columns[0], columns[1], columns[3])]
+    with metrics.timed('poisson'):
+        probs = [poisson_cdf(actual - 1, mean)
+                 for (actual, mean) in zip(columns[2], means)]
+    return (means, probs)
+
+
 def poisson_cdf(actual, mean):
     """Return the probability that we see actual or anything smaller
     in a random measurement of a
     variable with a poisson distribution with mean mean.
-    Expects mean to be a Decimal or a float
-    (we use Decimal so that long periods and high numbers of reports work--
-    a mean of 746 or higher would cause a zero to propagate and make us report
-    a probability of 0 even if the actual probability was almost 1.)
+    Expects mean to be a Decimal or a float.
+
+    P(X <= actual) is the regularized upper incomplete gamma function
+    Q(actual + 1, mean), which we evaluate in log-space so that long
+    periods and high numbers of reports work (a mean of 746 or higher
+    used to make exp(-mean) underflow to zero), and in time that doesn't
+    grow with actual.
     """
     if actual < 0:
-        return decimal.Decimal(0)
+        return 0.0
+
+    mean = float(mean)
+    if mean <= 0:
+        return 1.0
+
+    return _gamma_q(actual + 1, mean)
+
+
+# Relative precision we ask of the series and continued fraction below.
+_GAMMA_EPSILON = 1e-15
+# Smallest float we let the continued fraction divide by.
+_GAMMA_TINY = 1e-300
+# Past this shape parameter the series and continued fraction need
+# O(sqrt(a)) terms, so we switch to Temme's uniform asymptotic expansion,
+# which costs the same for any a and is accurate to ~1e-14 out here.
+_TEMME_MIN_A = 10000
+# Taylor coefficients of Temme's C0 and C1 around eta = 0, where their
+# closed forms cancel catastrophically.  (DiDonato & Morris, 1986.)
+_TEMME_C0_TAYLOR = (-1.0 / 3, 1.0 / 12, -2.0 / 135, 1.0 / 864, 1.0 / 2835)
+_TEMME_C1_TAYLOR = (-1.0 / 540, -1.0 / 288, 1.0 / 378, -1.0 / 1296)
+
+
+def _gamma_q(a, x):
+    """Regularized upper incomplete gamma function Q(a, x), for a, x > 0."""
+    if a >= _TEMME_MIN_A:
+        return _gamma_q_temme(a, x)
+    if x < a + 1:
+        # The series for P converges quickly here, and Q isn't tiny
+        # (it's at least ~0.4) so 1 - P doesn't lose any precision.
+        return 1.0 - _gamma_p_series(a, x)
+    return _gamma_q_continued_fraction(a, x)
+
 
-    if isinstance(mean, float):
-        mean = decimal.Decimal(mean)
+def _gamma_p_series(a, x):
+    """Regularized lower incomplete gamma P(a, x) by its power series."""
+    log_prefix = a * math.log(x) - x - math.lgamma(a + 1)
+    term = total = 1.0
+    n = a
+    while True:
+        n += 1
+        term *= x / n
+        total += term
+        if term < total * _GAMMA_EPSILON:
+            break
+    return min(1.0, total * math.exp(log_prefix))
 
-    cum_prob = decimal.Decimal(0)
 
-    p = (-mean).exp()
-    cum_prob += p
-    for i in range(actual):
-        # We calculate the probability of each lesser value individually, and
-        # sum as we go
-        p *= mean
-        p /= i + 1
+def _gamma_q_continued_fraction(a, x):
+    """Regularized upper incomplete gamma Q(a, x) by its continued
+    fraction, using the modified Lentz method."""
+    log_prefix = a * math.log(x) - x - math.lgamma(a)
+    b = x + 1 - a
+    c = 1 / _GAMMA_TINY
+    d = 1 / b
+    h = d
+    i = 0
+    while True:
+        i += 1
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        if abs(d) < _GAMMA_TINY:
+            d = _GAMMA_TINY
+        c = b + an / c
+        if abs(c) < _GAMMA_TINY:
+            c = _GAMMA_TINY
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < _GAMMA_EPSILON:
+            break
+    return min(1.0, h * math.exp(log_prefix))
 
-        cum_prob += p
 
-    return float(cum_prob)
+def _gamma_q_temme(a, x):
+    """Regularized upper incomplete gamma Q(a, x) for large a, by the
+    first two terms of Temme's uniform asymptotic expansion."""
+    lam = x / a
+    mu = lam - 1
+    if mu <= -1:
+        # x is so far below a that x / a rounds away; then P is tiny, and
+        # its series converges in a term or two.
+        return 1.0 - _gamma_p_series(a, x)
+    # eta has the sign of mu, and eta**2 / 2 = mu - log(1 + mu).  log1p
+    # keeps this accurate when x is close to a.
+    eta = math.copysign(math.sqrt(2 * (mu - math.log1p(mu))), mu)
+
+    if abs(eta) < 1e-3:
+        c0 = sum(c * eta ** i for i, c in enumerate(_TEMME_C0_TAYLOR))
+        c1 = sum(c * eta ** i for i, c in enumerate(_TEMME_C1_TAYLOR))
+    else:
+        c0 = 1 / mu - 1 / eta
+        c1 = (1 / eta ** 3 - 1 / mu ** 3 - 1 / mu ** 2
+              - 1 / (12 * mu))
+
+    remainder = (math.exp(-0.5 * a * eta * eta)
+                 / math.sqrt(2 * math.pi * a)
+                 * (c0 + c1 / a))
+    q = 0.5 * math.erfc(eta * math.sqrt(a / 2)) + remainder
+    return min(1.0, max(0.0, q))
+
+
+# We cache critical counts (see poisson_critical_count) for ranges of
+# means.  Below _CRITICAL_COUNT_LINEAR_MEAN they're about 0.1% wide (this
+# many to each factor of e); above it, where the critical count goes up
+# by about one for each one the mean does, they're 0.01 wide.
+_CRITICAL_COUNT_STEPS = 1000
+_CRITICAL_COUNT_LINEAR_MEAN = 10
+
+
+def poisson_critical_count(mean, confidence):
+    """Return the fewest errors we'd have to see, when we expect mean of
+    them, to be more than confidence sure that the rate is elevated.
+
+    That is, the smallest count for which probability() would say more
+    than confidence.  It's the same answer, but we cache it, so deciding
+    whether to alert is just comparing counts, and it lets us say how
+    far off alerting we are.
+    """
+    if not 0 < confidence < 1:
+        raise ValueError('Confidence must be between 0 and 1, not %s'
+                         % confidence)
+    mean = float(mean)
+    if mean <= 0:
+        return 1
+    if mean < _CRITICAL_COUNT_LINEAR_MEAN:
+        mean_range = ('log', math.floor(math.log(mean) *
+                                        _CRITICAL_COUNT_STEPS))
+    else:
+        mean_range = ('linear', math.floor(mean * 100))
+    (low_mean, high_mean, low_count, high_count) = _critical_count_bounds(
+        mean_range, confidence)
+    # Critical counts only go up with the mean, so if both ends of the
+    # range have the same one, so does everything in between.
+    if low_count == high_count and low_mean <= mean <= high_mean:
+        return low_count
+    return _critical_count(mean, confidence)
+
+
+@functools.lru_cache(maxsize=4096)
+def _critical_count_bounds(mean_range, confidence):
+    """The means at either end of mean_range, and their critical
+    counts."""
+    (scale, step) = mean_range
+    if scale == 'log':
+        low_mean = math.exp(step / _CRITICAL_COUNT_STEPS)
+        high_mean = math.exp((step + 1) / _CRITICAL_COUNT_STEPS)
+    else:
+        (low_mean, high_mean) = (step / 100.0, (step + 1) / 100.0)
+    return (low_mean, high_mean, _critical_count(low_mean, confidence),
+            _critical_count(high_mean, confidence))
+
+
+def _critical_count(mean, confidence):
+    """poisson_critical_count, without the cache."""
+    def alerts(count):
+        return poisson_cdf(count - 1, mean) > confidence
+
+    # Start from the normal approximation, step away from it (taking
+    # bigger steps each time) until we're either side of the answer, and
+    # then bisect.  low never alerts and high always does.
+    guess = max(1, int(mean + statistics.NormalDist().inv_cdf(confidence)
+                       * math.sqrt(mean)) + 1)
+    step = max(1, int(math.sqrt(mean)))
+    if alerts(guess):
+        (low, high) = (max(0, guess - step), guess)
+        while low > 0 and alerts(low):
+            step *= 2
+            (low, high) = (max(0, low - step), low)
+    else:
+        (low, high) = (guess, guess + step)
+        while not alerts(high):
+            step *= 2
+            (low, high) = (high, high + step)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if alerts(middle):
+            high = middle
+        else:
+            low = middle
+    return high
 
 
 def relative_path(f):
@@ -75,6 +295,559 @@ def merge_int_dicts(d1, d2):
     return merged_dict
 
 
+# How much of a response we read at a time when streaming it.
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class _JSONStream(object):
+    """A buffer over a file-like object of JSON text, which reads more of
+    the file only as the parser needs it."""
+    def __init__(self, fp):
+        self.fp = fp
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read_more(self):
+        if self.eof:
+            raise ValueError('Unexpected end of JSON stream')
+        chunk = self.fp.read(_STREAM_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+        # Part of a character decodes to '', which isn't the end yet.
+        if isinstance(chunk, bytes):
+            chunk = self.decoder.decode(chunk, final=self.eof)
+        # Drop what we've already parsed so the buffer stays small.
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """Return the next non-whitespace character, without consuming it."""
+        while True:
+            while (self.pos < len(self.buf) and
+                   self.buf[self.pos] in ' \t\r\n'):
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            self._read_more()
+
+    def expect(self, chars):
+        """Consume the next non-whitespace character, which must be one of
+        chars, and return it."""
+        c = self.peek()
+        if c not in chars:
+            raise ValueError('Expected one of %r in JSON stream, got %r'
+                             % (chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Consume and return the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                (value, end) = self.json_decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # Most likely we just don't have the whole value yet.
+                self._read_more()
+                continue
+            # A number at the very end of the buffer might continue in
+            # the next chunk.
+            if end == len(self.buf) and not self.eof:
+                self._read_more()
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_list(fp, list_key, fields=None, page=None):
+    """Incrementally parse the JSON object in the file-like object fp,
+    yielding the items of its list_key list one at a time.
+
+    Only the keys in fields are kept from each item (all of them if
+    fields is None), and we never hold more than about one full item in
+    memory, no matter how big the object is.  The object's other
+    top-level values are stored in the dict page as we come across them;
+    read those once the generator is exhausted.
+    """
+    if page is None:
+        page = {}
+    stream = _JSONStream(fp)
+
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == list_key and stream.peek() == '[':
+            stream.expect('[')
+            if stream.peek() == ']':
+                stream.expect(']')
+            else:
+                while True:
+                    item = stream.value()
+                    if fields is not None:
+                        item = {k: item[k] for k in fields if k in item}
+                    yield item
+                    if stream.expect(',]') == ']':
+                        break
+        else:
+            page[key] = stream.value()
+        if stream.expect(',}') == '}':
+            return
+
+
+# How many connections we keep open to any one host.
+MAX_CONNECTIONS_PER_HOST = 4
+
+# Errors that mean a kept-alive connection was closed on the other end
+# while it sat in the pool, so we should just try again on a fresh one.
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected,
+                            http.client.CannotSendRequest,
+                            ConnectionResetError, BrokenPipeError)
+
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class HTTPConnectionPool(object):
+    """A pool of keep-alive HTTP(S) connections, shared between requests
+    to the same host, so that paging through an API doesn't pay for a new
+    TCP and TLS handshake on every page.
+
+    At most max_connections_per_host requests to a host are in flight at
+    once; more wait for one of them to finish.
+    """
+    def __init__(self, max_connections_per_host=MAX_CONNECTIONS_PER_HOST):
+        self.max_connections_per_host = max_connections_per_host
+        self.connections_opened = 0
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(list)
+        self._slots = {}
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(
+                    self.max_connections_per_host)
+            return self._slots[key]
+
+    def _get_connection(self, key, timeout):
+        with self._lock:
+            if self._idle[key]:
+                conn = self._idle[key].pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return (conn, True)
+            self.connections_opened += 1
+        (scheme, host, port) = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        return (conn, False)
+
+    def _release(self, key, conn, reusable):
+        if reusable:
+            with self._lock:
+                self._idle[key].append(conn)
+        else:
+            conn.close()
+        self._slot(key).release()
+
+    def urlopen(self, request, timeout=60):
+        """Fetch request (a url or a urllib.request.Request) like
+        urllib.request.urlopen does: follow redirects, raise HTTPError on
+        4xx and 5xx responses, and return a file-like response.
+
+        We ask for gzip and decompress it transparently.  The connection
+        goes back to the pool once the response has been read to the end.
+        """
+        if isinstance(request, str):
+            request = urllib.request.Request(request)
+        url = request.full_url
+        method = request.get_method()
+        headers = dict(request.header_items())
+        headers.setdefault('User-agent', 'beep-boop')
+        headers['Accept-encoding'] = 'gzip'
+
+        for _ in range(10):
+            response = self._request(url, method, request.data, headers,
+                                     timeout)
+            if response.status not in _REDIRECT_CODES:
+                break
+            location = response.headers.get('Location')
+            response.read()
+            url = urllib.parse.urljoin(url, location)
+            # Like urllib, we don't pass unredirected headers (e.g. auth)
+            # along to wherever we're redirected.
+            headers = {k: v for (k, v) in headers.items()
+                       if k not in request.unredirected_hdrs}
+            if response.status == 303:
+                method = 'GET'
+        if response.status >= 400:
+            body = response.read()
+            raise urllib.error.HTTPError(url, response.status,
+                                         response.reason, response.headers,
+                                         io.BytesIO(body))
+        return response
+
+    def _request(self, url, method, body, headers, timeout):
+        parsed = urllib.parse.urlsplit(url)
+        key = (parsed.scheme, parsed.hostname,
+               parsed.port or (443 if parsed.scheme == 'https' else 80))
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        self._slot(key).acquire()
+        try:
+            while True:
+                (conn, reused) = self._get_connection(key, timeout)
+                try:
+                    conn.request(method, path, body, headers)
+                    raw_response = conn.getresponse()
+                    break
+                except _STALE_CONNECTION_ERRORS:
+                    conn.close()
+                    if not reused:
+                        raise
+                except BaseException:
+                    conn.close()
+                    raise
+        except BaseException:
+            self._slot(key).release()
+            raise
+
+        return _PooledResponse(url, raw_response,
+                               lambda reusable: self._release(key, conn,
+                                                              reusable))
+
+
+class _PooledResponse(object):
+    """A file-like HTTP response that hands its connection back to the
+    pool once it has been read to the end (or closes it if we give up
+    reading early)."""
+    def __init__(self, url, raw_response, release_fn):
+        self.url = url
+        self.status = self.code = raw_response.status
+        self.reason = raw_response.reason
+        self.headers = raw_response.headers
+        self._raw = raw_response
+        self._release_fn = release_fn
+        self._host = urllib.parse.urlsplit(url).hostname
+        self._buffer = b''
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = None
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def _finish(self, reusable):
+        if self._release_fn is not None:
+            release_fn = self._release_fn
+            self._release_fn = None
+            release_fn(reusable and not self._raw.will_close)
+
+    def _read_raw(self, size):
+        try:
+            data = self._raw.read(size)
+        except BaseException:
+            self._finish(False)
+            raise
+        metrics.inc('beep_boop_http_response_bytes_total', len(data),
+                    host=self._host)
+        if self._decompressor is not None:
+            data = self._decompressor.decompress(data)
+        # http.client closes the response as soon as we've read all of
+        # it, which is our cue that the connection is free again.
+        if self._raw.isclosed():
+            if self._decompressor is not None:
+                data += self._decompressor.flush()
+            self._finish(True)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self._buffer]
+            self._buffer = b''
+            while self._release_fn is not None:
+                chunks.append(self._read_raw(_STREAM_CHUNK_SIZE))
+            return b''.join(chunks)
+
+        # A gzipped chunk can decompress to nothing, so keep going until
+        # we have some data or run out.
+        while not self._buffer and self._release_fn is not None:
+            self._buffer = self._read_raw(size)
+        (data, self._buffer) = (self._buffer[:size], self._buffer[size:])
+        return data
+
+    def close(self):
+        if self._release_fn is not None:
+            self._raw.close()
+            self._finish(False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+# The connection pool shared by everything in this process.
+HTTP_POOL = HTTPConnectionPool()
+
+# If set (see record_responses), the directory we save every response to.
+RECORD_DIR = None
+_RECORD_LOCK = threading.Lock()
+# Where in RECORD_DIR we list what we've saved, one JSON object per line.
+RECORD_INDEX_FILE = 'index.jsonl'
+_RECORD_SKIPPED_HEADERS = ('content-encoding', 'content-length',
+                           'transfer-encoding')
+
+
+class RecordedResponse(io.BytesIO):
+    """A response whose body we already have, like one we've recorded.
+
+    headers is a list of (name, value) pairs.
+    """
+    def __init__(self, url, body, headers=(), status=200):
+        super(RecordedResponse, self).__init__(body)
+        self.url = url
+        self.status = self.code = status
+        self.headers = email.message.Message()
+        for (name, value) in headers:
+            self.headers[name] = value
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+
+def record_responses(directory):
+    """Save a gzipped copy of the body of every successful response we get
+    from now on in directory, for replay.py.
+
+    We list each one in directory's RECORD_INDEX_FILE, with its URL,
+    headers and when we got it.
+    """
+    global RECORD_DIR
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    RECORD_DIR = directory
+
+
+def _record_response(response):
+    """Save response in RECORD_DIR, and return a copy to use instead."""
+    body = response.read()
+    response.close()
+    now = time.time()
+    url_hash = hashlib.sha1(response.url.encode('utf-8')).hexdigest()
+    filename = '%d-%s.json.gz' % (now * 1000, url_hash[:12])
+    with gzip.open(os.path.join(RECORD_DIR, filename), 'wb') as f:
+        f.write(body)
+    # We've already undone any transfer encoding.
+    headers = [(name, value) for (name, value) in response.headers.items()
+               if name.lower() not in _RECORD_SKIPPED_HEADERS]
+    entry = {'time': now, 'url': response.url, 'status': response.status,
+             'headers': headers, 'file': filename}
+    with _RECORD_LOCK:
+        with open(os.path.join(RECORD_DIR, RECORD_INDEX_FILE), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    return RecordedResponse(response.url, body, headers, response.status)
+
+
+def urlopen(request, timeout=60, rate_limiter=None):
+    """urllib.request.urlopen, but over our shared keep-alive pool.
+
+    If rate_limiter is given, we wait for it before sending the request,
+    and tell it about any quota information in the response.  If we're
+    recording responses, we read the whole response before returning it.
+    """
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+    url = request if isinstance(request, str) else request.full_url
+    host = urllib.parse.urlsplit(url).hostname
+    try:
+        response = HTTP_POOL.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as why:
+        metrics.inc('beep_boop_http_requests_total', host=host,
+                    code=why.code)
+        if rate_limiter is not None:
+            rate_limiter.update_from_headers(why.headers)
+        raise
+    except Exception:
+        metrics.inc('beep_boop_http_requests_total', host=host,
+                    code='error')
+        raise
+    metrics.inc('beep_boop_http_requests_total', host=host,
+                code=response.status)
+    if rate_limiter is not None:
+        if response.status == 304:
+            # APIs (e.g. GitHub's) don't count "not modified" against
+            # our quota.
+            rate_limiter.refund()
+        rate_limiter.update_from_headers(response.headers)
+    if RECORD_DIR is not None:
+        response = _record_response(response)
+    return response
+
+
+def _header_number(headers, names):
+    """Return the first of the given headers that's present, as a float."""
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
+
+
+class RateLimiter(object):
+    """A token bucket that paces requests to an API to just under its
+    quota, rather than running into it and waiting out 429s.
+
+    Tokens come in evenly at requests_per_period every period seconds,
+    and we can save up at most burst of them; every request takes one.
+    (A big burst lets us go faster for a bit, but can overrun a quota
+    that's enforced over a sliding window.)  We also believe what the API
+    tells us about our remaining quota (X-Rate-Limit-Remaining and
+    friends, Retry-After on a 429), and, if state_file is given, remember
+    where we were between runs, so that we don't start each run thinking
+    we have a full budget.  name is what we call the API in our metrics.
+    """
+    def __init__(self, requests_per_period, period=60, burst=1,
+                 state_file=None, name='api'):
+        self.name = name
+        self.capacity = burst
+        self.rate = requests_per_period * 1.0 / period
+        self.state_file = state_file
+        self.tokens = burst
+        self.updated = time.time()
+        self.blocked_until = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _load(self):
+        # Called with the lock held.
+        self._loaded = True
+        if self.state_file is None:
+            return
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return
+        self.tokens = min(self.capacity, state['tokens'])
+        self.updated = state['updated']
+        self.blocked_until = state['blocked_until']
+
+    def _refill(self, now):
+        # Called with the lock held.
+        if not self._loaded:
+            self._load()
+        if now > self.updated:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until we can send another request, and take a token."""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            logging.debug('Rate limiting: waiting %.2f seconds' % wait)
+            metrics.inc('beep_boop_rate_limit_wait_seconds_total', wait,
+                        api=self.name)
+            time.sleep(wait)
+
+    def refund(self):
+        """Give back the token for a request that didn't use up quota."""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def update_from_headers(self, headers):
+        """Update our idea of the quota from an API response's headers."""
+        remaining = _header_number(headers, ('X-Rate-Limit-Remaining',
+                                             'X-RateLimit-Remaining'))
+        retry_after = _header_number(headers, ('Retry-After',))
+        reset_time = _header_number(headers, ('X-RateLimit-Reset',))
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining)
+                if remaining < 1 and reset_time is not None:
+                    self.blocked_until = max(self.blocked_until, reset_time)
+            if retry_after is not None:
+                self.tokens = 0
+                self.blocked_until = max(self.blocked_until,
+                                         now + retry_after)
+        if retry_after is not None:
+            # acquire() counts the wait in our metrics.
+            logging.warning('%s told us to wait %s seconds (Retry-After)'
+                            % (self.name, retry_after))
+
+    def save(self):
+        """Remember our quota state for the next run, if we have a file."""
+        if self.state_file is None:
+            return
+        with self._lock:
+            self._refill(time.time())
+            state = {'tokens': self.tokens,
+                     'updated': self.updated,
+                     'blocked_until': self.blocked_until}
+        atomic_write(self.state_file, json.dumps(state))
+
+
+def atomic_write(filename, contents):
+    """Replace filename with contents, such that a crash leaves either the
+    old or the new contents but never a mix."""
+    if isinstance(contents, str):
+        contents = contents.encode('utf-8')
+    (fd, tmp_filename) = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix=os.path.basename(filename) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+
 def send_to_slack(message, channel):
     alertlib.Alert(message, severity=logging.ERROR) \
         .send_to_slack(channel, sender='beep-boop', icon_emoji='robot_face')
@@ -84,12 +857,17 @@ def send_to_pagerduty(message, service):
     alertlib.Alert(message).send_to_pagerduty(service)
 
 
-def retry(fn, description, should_retry_fn, retry_count=3):
+def retry(fn, description, should_retry_fn, retry_count=3,
+          backoff=1, max_backoff=60):
     """A simple retry function.
 
     should_retry_fn is a function taking an exception (raised by fn)
     and returning True if we should retry or False else.  Of course we
     ignore should_retry_fn after retry_count retries.
+
+    Between attempts we sleep a random time of up to backoff seconds,
+    doubling each attempt up to max_backoff ("full jitter"), so that
+    retries don't hammer a struggling server or line up with each other.
     """
     for i in range(1, retry_count):
         try:
@@ -98,7 +876,10 @@ def retry(fn, description, should_retry_fn, retry_count=3):
             if should_retry_fn(why):
                 logging.debug('FAILED: %s (attempt %s, retrying)'
                               % (description, i))
+                metrics.inc('beep_boop_retries_total', what=description)
             else:
                 raise
+        time.sleep(random.uniform(0, min(max_backoff,
+                                         backoff * 2 ** (i - 1))))
     # Try one last time, which will just raise if it fails.
     return fn()
@@ -0,0 +1,409 @@
+"""Tests for util.py.  Run with
+    python -m unittest util_test
+"""
+
+import contextlib
+import decimal
+import gzip
+import http.server
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import util
+
+
+def _decimal_poisson_cdf(actual, mean):
+    """How poisson_cdf used to work: summing the terms of the CDF in
+    Decimal, which is slow but, to 28 digits, right."""
+    if actual < 0:
+        return 0.0
+    mean = decimal.Decimal(mean)
+    p = (-mean).exp()
+    cum_prob = p
+    for i in range(actual):
+        p *= mean
+        p /= i + 1
+        cum_prob += p
+    return float(cum_prob)
+
+
+class PoissonCdfTest(unittest.TestCase):
+    def assert_matches_decimal(self, actual, mean):
+        expected = _decimal_poisson_cdf(actual, mean)
+        got = util.poisson_cdf(actual, mean)
+        self.assertAlmostEqual(
+            got / expected if expected else got, 1.0 if expected else 0.0,
+            delta=1e-10,
+            msg='poisson_cdf(%s, %s) = %r, not %r'
+                % (actual, mean, got, expected))
+
+    def _check_around(self, mean, widths):
+        """Check counts from far below mean to far above it, where widths
+        is how many standard deviations out to go."""
+        sd = mean ** 0.5
+        for width in widths:
+            actual = int(mean + width * sd)
+            if actual >= 0:
+                self.assert_matches_decimal(actual, mean)
+
+    def test_small_means(self):
+        for mean in (0.001, 0.1, 0.5, 1.0, 2.5, 7.0):
+            for actual in range(30):
+                self.assert_matches_decimal(actual, mean)
+
+    def test_medium_means(self):
+        for mean in (12.5, 50.0, 99.9, 300.0, 745.0, 746.0, 1000.0):
+            self._check_around(mean, (-8, -4, -2, -1, 0, 1, 2, 4, 8, 15))
+
+    def test_large_means(self):
+        # Past _TEMME_MIN_A, we use Temme's expansion.
+        for mean in (5000.0, 9990.5, 12000.0, 25000.0):
+            self._check_around(mean, (-6, -3, -1, 0, 1, 3, 6, 10))
+
+    def test_either_side_of_temme(self):
+        # The counts either side of where we switch methods.
+        for actual in (util._TEMME_MIN_A - 2, util._TEMME_MIN_A - 1,
+                       util._TEMME_MIN_A):
+            for mean in (9800.0, 10000.0, 10200.0):
+                self.assert_matches_decimal(actual, mean)
+
+    def test_large_counts_for_tiny_means(self):
+        # x / a rounds to 0 here, which Temme's expansion can't take.
+        for mean in (1e-17, 1e-300):
+            for actual in (util._TEMME_MIN_A, 50000):
+                self.assertEqual(util.poisson_cdf(actual, mean), 1.0)
+        self.assert_matches_decimal(util._TEMME_MIN_A, 1e-17)
+
+    def test_edges(self):
+        self.assertEqual(util.poisson_cdf(-1, 3.0), 0.0)
+        self.assertEqual(util.poisson_cdf(0, 0.0), 1.0)
+        self.assertEqual(util.poisson_cdf(5, decimal.Decimal('2.5')),
+                         util.poisson_cdf(5, 2.5))
+
+
+class _ChunkedFile(object):
+    """A file-like object that reads the given chunks, one per read(),
+    however much we ask for, as a socket might."""
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def read(self, size):
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+def _cut(doc, chunk_size):
+    return [doc[i:i + chunk_size] for i in range(0, len(doc), chunk_size)]
+
+
+class IterJSONListTest(unittest.TestCase):
+    # Something like a page from Zendesk's export API, with values of
+    # every kind for a chunk to end in the middle of.
+    DOC = json.dumps({
+        'count': 3,
+        'results': [
+            {'id': 1, 'subject': 'Can\'t log in \u2603 "quoted" \\o/',
+             'current_tags': ['technical_issue', 'spam'],
+             'score': -12.5e3, 'solved': True, 'assignee': None},
+            {'id': 22222222222, 'subject': '', 'current_tags': [],
+             'nested': {'a': [1, [2, {}]], 'b': False}},
+            {'id': 3, 'subject': 'caf\u00e9 \U0001F41B'},
+        ],
+        'next_page': 'https://khanacademy.zendesk.com/api?start_time=1',
+        'end_of_stream': False,
+    }, indent=1, ensure_ascii=False).encode('utf-8')
+
+    def _parse(self, chunks, fields=None):
+        """Return the results of iter_json_list over the bytes in chunks,
+        and the other keys it saw."""
+        page = {}
+        results = list(util.iter_json_list(_ChunkedFile(chunks), 'results',
+                                           fields, page))
+        return (results, page)
+
+    def _expected(self, doc):
+        page = json.loads(doc.decode('utf-8'))
+        return (page.pop('results'), page)
+
+    def test_small_chunks(self):
+        for chunk_size in (1, 7, 64 * 1024):
+            self.assertEqual(self._parse(_cut(self.DOC, chunk_size)),
+                             self._expected(self.DOC),
+                             'chunk size %s' % chunk_size)
+
+    def test_every_split(self):
+        # Cut the document in two at every byte: that ends a chunk in
+        # the middle of every string, number, true, null and character.
+        expected = self._expected(self.DOC)
+        for split in range(1, len(self.DOC)):
+            self.assertEqual(
+                self._parse([self.DOC[:split], self.DOC[split:]]), expected,
+                'split at %s' % split)
+
+    def test_number_at_the_end_of_a_chunk(self):
+        doc = b'{"results": [123456, 7], "next_page": 89}'
+        for chunk_size in range(1, len(doc)):
+            self.assertEqual(self._parse(_cut(doc, chunk_size)),
+                             ([123456, 7], {'next_page': 89}))
+
+    def test_next_page_before_or_after_results(self):
+        for doc in (b'{"next_page": "a", "results": [{"id": 1}]}',
+                    b'{"results": [{"id": 1}], "next_page": "a"}'):
+            for chunk_size in (1, 7):
+                self.assertEqual(self._parse(_cut(doc, chunk_size)),
+                                 ([{'id': 1}], {'next_page': 'a'}))
+
+    def test_no_results(self):
+        for doc in (b'{}', b'{"results": []}', b' { "results" : [ ] } ',
+                    b'{"results": null, "next_page": null}'):
+            self.assertEqual(self._parse(_cut(doc, 7))[0], [])
+
+    def test_fields(self):
+        (results, _) = self._parse(_cut(self.DOC, 7), fields=('id', 'solved'))
+        self.assertEqual(results, [{'id': 1, 'solved': True},
+                                   {'id': 22222222222}, {'id': 3}])
+
+    def test_truncated(self):
+        # Wherever the connection drops, we don't take what we got for the
+        # whole thing.
+        for end in range(len(self.DOC)):
+            with self.assertRaises(ValueError, msg='cut at %s' % end):
+                self._parse(_cut(self.DOC[:end], 7))
+
+    def test_not_an_object(self):
+        with self.assertRaises(ValueError):
+            self._parse([b'[1, 2]'])
+
+
+class _CountingServer(http.server.ThreadingHTTPServer):
+    """A stand-in API server that counts the connections it accepts."""
+    daemon_threads = True
+
+    def __init__(self, handler_class):
+        super(_CountingServer, self).__init__(('127.0.0.1', 0),
+                                              handler_class)
+        self.connections_accepted = 0
+        self.requests = []
+
+    def get_request(self):
+        self.connections_accepted += 1
+        return super(_CountingServer, self).get_request()
+
+
+class _PagesHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /pages?page=N, gzipped if asked, keeping connections open."""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers))
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        body = json.dumps({'page': int(query['page'][0]),
+                           'results': list(range(100))}).encode('utf-8')
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServerTestCase(unittest.TestCase):
+    """Runs a stand-in API server, with handler_class, for each test."""
+    handler_class = _PagesHandler
+
+    def setUp(self):
+        self.server = _CountingServer(self.handler_class)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = ('http://127.0.0.1:%s'
+                         % self.server.server_address[1])
+
+
+class HTTPConnectionPoolTest(StandInServerTestCase):
+    def setUp(self):
+        super(HTTPConnectionPoolTest, self).setUp()
+        self.pool = util.HTTPConnectionPool()
+
+    def _page_url(self, page):
+        return '%s/pages?page=%s' % (self.base_url, page)
+
+    def test_pages_share_a_connection(self):
+        for page in range(1, 11):
+            response = self.pool.urlopen(self._page_url(page))
+            self.assertEqual(json.loads(response.read())['page'], page)
+        self.assertEqual(self.server.connections_accepted, 1)
+        self.assertEqual(self.pool.connections_opened, 1)
+
+    def test_fewer_connections_than_urllib(self):
+        for page in range(1, 11):
+            self.pool.urlopen(self._page_url(page)).read()
+        pooled = self.server.connections_accepted
+        for page in range(1, 11):
+            urllib.request.urlopen(self._page_url(page)).read()
+        self.assertEqual((pooled, self.server.connections_accepted - pooled),
+                         (1, 10))
+
+    def test_decompresses_gzip(self):
+        response = self.pool.urlopen(self._page_url(3))
+        self.assertEqual(json.loads(response.read())['results'],
+                         list(range(100)))
+        self.assertEqual(self.server.requests[0][1]['Accept-Encoding'],
+                         'gzip')
+
+    def test_unread_response_closes_its_connection(self):
+        self.pool.urlopen(self._page_url(1)).close()
+        self.pool.urlopen(self._page_url(2)).read()
+        self.assertEqual(self.server.connections_accepted, 2)
+
+    def test_concurrent_requests_share_a_few_connections(self):
+        def fetch(page):
+            self.pool.urlopen(self._page_url(page)).read()
+        threads = [threading.Thread(target=fetch, args=(page,))
+                   for page in range(1, 21)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.requests), 20)
+        self.assertLessEqual(self.server.connections_accepted,
+                             util.MAX_CONNECTIONS_PER_HOST)
+
+
+class _QuotaHandler(_PagesHandler):
+    """Like _PagesHandler, but allows only QUOTA requests in any WINDOW
+    seconds, telling us how many we have left, and answering any more
+    with a 429 and how long to wait."""
+    QUOTA = 10
+    WINDOW = 1.0
+
+    def do_GET(self):
+        with self.server.lock:
+            now = time.time()
+            self.server.allowed = [t for t in self.server.allowed
+                                   if t > now - self.WINDOW]
+            if len(self.server.allowed) >= self.QUOTA:
+                self.server.rejected += 1
+                retry_after = self.server.allowed[0] + self.WINDOW - now
+            else:
+                self.server.allowed.append(now)
+                retry_after = None
+                remaining = self.QUOTA - len(self.server.allowed)
+        if retry_after is not None:
+            self.send_response(429)
+            self.send_header('Retry-After', '%.3f' % retry_after)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('X-Rate-Limit-Remaining', str(remaining))
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+
+class RateLimiterTest(StandInServerTestCase):
+    handler_class = _QuotaHandler
+
+    def setUp(self):
+        super(RateLimiterTest, self).setUp()
+        self.server.lock = threading.Lock()
+        self.server.allowed = []
+        self.server.rejected = 0
+        self.url = '%s/pages?page=1' % self.base_url
+
+    def _fetch(self, rate_limiter):
+        util.urlopen(self.url, rate_limiter=rate_limiter).read()
+
+    def test_without_a_limiter_we_overrun_the_quota(self):
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            for _ in range(_QuotaHandler.QUOTA + 1):
+                self._fetch(None)
+        self.assertEqual(context.exception.code, 429)
+
+    def test_paces_requests_under_the_quota(self):
+        # In any second, we send at most the burst of 2 plus 7 more.
+        limiter = util.RateLimiter(7, 1, burst=2)
+        start = time.time()
+        for _ in range(16):
+            self._fetch(limiter)
+        self.assertEqual(self.server.rejected, 0)
+        # The first 2 come at once, the next 14 at 7 a second.
+        self.assertGreaterEqual(time.time() - start, 1.9)
+
+    def test_concurrent_requests_share_the_quota(self):
+        limiter = util.RateLimiter(7, 1, burst=2)
+        threads = [threading.Thread(target=self._fetch, args=(limiter,))
+                   for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.rejected, 0)
+
+    def test_believes_the_remaining_quota(self):
+        # Someone else has used up most of our quota.
+        self.server.allowed = [time.time()] * (_QuotaHandler.QUOTA - 2)
+        limiter = util.RateLimiter(100, 1, burst=10)
+        self._fetch(limiter)
+        self.assertLess(limiter.tokens, 2)
+
+    def test_retry_waits_out_retry_after(self):
+        limiter = util.RateLimiter(100, 1, burst=100)
+        self.server.allowed = [time.time()] * _QuotaHandler.QUOTA
+        start = time.time()
+        util.retry(lambda: self._fetch(limiter), 'fetching',
+                   lambda exc: (isinstance(exc, urllib.error.HTTPError) and
+                                exc.code == 429),
+                   backoff=0.01)
+        # We got one 429, then waited out the Retry-After it gave us (of
+        # about a second) rather than trying again straight away.
+        self.assertEqual(self.server.rejected, 1)
+        self.assertGreaterEqual(time.time() - start, 0.9)
+
+    def test_retry_after_is_logged(self):
+        limiter = util.RateLimiter(100, 1, burst=100, name='zendesk')
+        with self.assertLogs(level='WARNING') as logs, \
+                contextlib.redirect_stdout(io.StringIO()) as stdout:
+            limiter.update_from_headers({'Retry-After': '0.2'})
+        self.assertEqual(logs.output, [
+            'WARNING:root:zendesk told us to wait 0.2 seconds (Retry-After)'])
+        self.assertEqual(stdout.getvalue(), '')
+        start = time.time()
+        limiter.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.15)
+
+    def test_remembers_quota_between_runs(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        state_file = os.path.join(directory, 'rate_limit.json')
+        limiter = util.RateLimiter(10, 1, burst=5, state_file=state_file)
+        for _ in range(5):
+            limiter.acquire()
+        limiter.save()
+        # A new run doesn't think it has a full budget: its next 3
+        # requests are paced at 10 a second, not sent at once.
+        limiter = util.RateLimiter(10, 1, burst=5, state_file=state_file)
+        start = time.time()
+        for _ in range(3):
+            limiter.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
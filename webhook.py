@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""Count Zendesk tickets as they're created, from Zendesk webhooks.
+
+Polling the export API means we only hear about a ticket 5 minutes (plus
+however long until our next poll) after it's created.  Instead, a Zendesk
+trigger can POST each new ticket to us as it comes in, so we can notice a
+surge within seconds.  We still poll the export API too, to catch any
+webhooks that went missing.
+
+The trigger should POST JSON to WEBHOOK_PATH with at least the ticket's
+id, subject, created_at and tags, e.g.
+    {"id": {{ticket.id}}, "subject": "{{ticket.title}}",
+     "created_at": "{{ticket.created_at_with_timestamp}}",
+     "tags": "{{ticket.tags}}"}
+We also understand Zendesk's ticket.created event payloads, which have
+the ticket under "detail".  If ticket_filter.py's config looks at
+brand_id or group_id, the payload needs to include those too.
+
+If zendesk_webhook.cfg exists, it holds the webhook's signing secret, and
+we reject any request that isn't signed with it.
+
+To try it out, run the daemon with --webhook_port and then
+    ./webhook.py --send_test_tickets 20 --url http://localhost:<port>
+"""
+
+import argparse
+import base64
+import datetime
+import hashlib
+import hmac
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+
+import util
+
+WEBHOOK_PATH = '/zendesk/ticket_created'
+
+WEBHOOK_SECRET_FILE = util.relative_path("zendesk_webhook.cfg")
+
+# Webhooks are small; anything bigger than this isn't one of ours.
+MAX_PAYLOAD_BYTES = 256 * 1024
+
+
+def load_secret():
+    """Return the webhook signing secret, or None if we don't have one."""
+    if not os.path.exists(WEBHOOK_SECRET_FILE):
+        return None
+    with open(WEBHOOK_SECRET_FILE) as f:
+        return f.read().strip()
+
+
+def sign(secret, timestamp, body):
+    """Return the signature Zendesk would send for this request."""
+    digest = hmac.new(secret.encode('utf-8'),
+                      timestamp.encode('utf-8') + body,
+                      hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def _format_time(time_t):
+    """Format time_t like the export API does."""
+    return time.strftime('%Y-%m-%d %H:%M:%S %z', time.localtime(time_t))
+
+
+def parse_ticket(payload):
+    """Turn a webhook payload into a ticket like the export API gives us,
+    with id, subject, created_at and current_tags (and brand_id and
+    group_id, if the payload has them)."""
+    ticket = payload
+    if isinstance(ticket, dict):
+        ticket = ticket.get('detail', ticket)
+    if not isinstance(ticket, dict):
+        raise ValueError('Expected a ticket, got %r' % ticket)
+    tags = ticket.get('current_tags', ticket.get('tags', []))
+    if isinstance(tags, str):
+        # {{ticket.tags}} is a space-separated list.
+        tags = tags.split()
+
+    created_at = ticket.get('created_at')
+    if not created_at:
+        created_at = _format_time(time.time())
+    elif 'T' in created_at:
+        # An ISO 8601 time, from an event webhook; convert it to the
+        # export's format.
+        created = datetime.datetime.fromisoformat(
+            created_at.replace('Z', '+00:00'))
+        created_at = _format_time(created.timestamp())
+
+    parsed = {'id': int(ticket['id']),
+              'subject': ticket.get('subject', ''),
+              'created_at': created_at,
+              'current_tags': tags}
+    # Our filter config may look at these, if the payload has them.
+    for field in ('brand_id', 'group_id'):
+        if ticket.get(field) is not None:
+            parsed[field] = int(ticket[field])
+    return parsed
+
+
+def make_server(on_ticket, port, host='127.0.0.1', secret=None):
+    """Return an HTTP server that calls on_ticket(ticket) for every ticket
+    POSTed to WEBHOOK_PATH.
+
+    on_ticket should return whether it counted the ticket.  Call
+    serve_forever() on the server (probably in a thread) to start it.
+    """
+    class WebhookHandler(http.server.BaseHTTPRequestHandler):
+        def _respond(self, code, response):
+            body = json.dumps(response).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != WEBHOOK_PATH:
+                return self._respond(404, {'error': 'not found'})
+            length = int(self.headers.get('Content-Length', 0))
+            if length > MAX_PAYLOAD_BYTES:
+                return self._respond(413, {'error': 'too big'})
+            body = self.rfile.read(length)
+
+            if secret is not None:
+                timestamp = self.headers.get(
+                    'X-Zendesk-Webhook-Signature-Timestamp', '')
+                signature = self.headers.get(
+                    'X-Zendesk-Webhook-Signature', '')
+                if not hmac.compare_digest(sign(secret, timestamp, body),
+                                           signature):
+                    return self._respond(401, {'error': 'bad signature'})
+
+            try:
+                ticket = parse_ticket(json.loads(body.decode('utf-8')))
+            except (ValueError, KeyError, TypeError) as why:
+                return self._respond(400, {'error': str(why)})
+
+            try:
+                counted = on_ticket(ticket)
+            except Exception:
+                logging.exception('Failed handling webhook for ticket %s'
+                                  % ticket['id'])
+                return self._respond(500, {'error': 'internal error'})
+            return self._respond(200, {'counted': bool(counted)})
+
+        def log_message(self, format, *args):
+            logging.debug('webhook: ' + format % args)
+
+    return http.server.ThreadingHTTPServer((host, port), WebhookHandler)
+
+
+def serve_in_background(server, name='zendesk-webhook'):
+    """Start server on a daemon thread, and return the thread."""
+    thread = threading.Thread(target=server.serve_forever, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def send_test_tickets(url, count, tags=('technical_issue',), secret=None):
+    """POST count synthetic new-ticket webhooks to the server at url."""
+    first_id = int(time.time() * 1000)
+    for i in range(count):
+        body = json.dumps({
+            'id': first_id + i,
+            'subject': 'Synthetic test ticket %s' % i,
+            'created_at': _format_time(time.time()),
+            'tags': ' '.join(tags),
+        }).encode('utf-8')
+        request = urllib.request.Request(
+            url.rstrip('/') + WEBHOOK_PATH, data=body,
+            headers={'Content-Type': 'application/json'})
+        if secret is not None:
+            timestamp = str(int(time.time()))
+            request.add_header('X-Zendesk-Webhook-Signature-Timestamp',
+                               timestamp)
+            request.add_header('X-Zendesk-Webhook-Signature',
+                               sign(secret, timestamp, body))
+        response = util.urlopen(request, timeout=10)
+        print('Ticket %s: %s' % (first_id + i, response.read().decode()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Send synthetic Zendesk webhooks, for testing.')
+    parser.add_argument('--url', default='http://127.0.0.1:8087',
+                        help='Where the webhook server is listening.')
+    parser.add_argument('--send_test_tickets', type=int, default=1,
+                        help='How many synthetic tickets to send.')
+    parser.add_argument('--tags', default='technical_issue',
+                        help='Space-separated tags for the tickets.')
+    args = parser.parse_args()
+    send_test_tickets(args.url, args.send_test_tickets, args.tags.split(),
+                      load_secret())
@@ -0,0 +1,271 @@
+"""Tests for webhook.py, and how zendesk_reports counts its tickets.
+Run with
+    python -m unittest webhook_test
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import unittest.mock
+import urllib.error
+import urllib.request
+
+import seen_tickets
+import state_store
+import util
+import util_test
+import webhook
+import zendesk_reports
+
+SECRET = 'shh'
+
+
+class _WebhookServerTestCase(unittest.TestCase):
+    """Runs webhook.make_server on a port of its own for each test, calling
+    on_ticket, with secret."""
+    secret = None
+
+    def setUp(self):
+        self.server = webhook.make_server(self.on_ticket, 0,
+                                          secret=self.secret)
+        webhook.serve_in_background(self.server)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = ('http://127.0.0.1:%s%s'
+                    % (self.server.server_address[1], webhook.WEBHOOK_PATH))
+
+    def post(self, payload, secret=None, timestamp=None, url=None):
+        """POST payload (JSON, unless it's already bytes), signed with
+        secret if given, and return (status, response)."""
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode('utf-8')
+        request = urllib.request.Request(url or self.url, data=payload)
+        if secret is not None:
+            timestamp = timestamp or str(int(time.time()))
+            request.add_header('X-Zendesk-Webhook-Signature-Timestamp',
+                               timestamp)
+            request.add_header('X-Zendesk-Webhook-Signature',
+                               webhook.sign(secret, timestamp, payload))
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return (response.status, json.loads(response.read()))
+        except urllib.error.HTTPError as e:
+            return (e.code, json.loads(e.read()))
+
+
+def _payload(ticket_id, created_time_t=None, tags='technical_issue'):
+    return {'id': ticket_id, 'subject': 'Help %s' % ticket_id,
+            'created_at': webhook._format_time(created_time_t or time.time()),
+            'tags': tags}
+
+
+class MakeServerTest(_WebhookServerTestCase):
+    def setUp(self):
+        super(MakeServerTest, self).setUp()
+        self.tickets = []
+
+    def on_ticket(self, ticket):
+        if ticket['id'] == 500:
+            raise RuntimeError('oops')
+        self.tickets.append(ticket)
+        return True
+
+    def test_ticket(self):
+        self.assertEqual(self.post(_payload(1, 1500000000, 'a b')),
+                         (200, {'counted': True}))
+        self.assertEqual(self.tickets, [{
+            'id': 1, 'subject': 'Help 1',
+            'created_at': webhook._format_time(1500000000),
+            'current_tags': ['a', 'b']}])
+
+    def test_event_payload(self):
+        self.post({'type': 'zen:event-type:ticket.created',
+                   'detail': {'id': '7', 'subject': 'Hi',
+                              'created_at': '2017-07-14T02:40:00Z',
+                              'tags': ['x'], 'brand_id': '3',
+                              'group_id': None}})
+        self.assertEqual(self.tickets, [{
+            'id': 7, 'subject': 'Hi',
+            'created_at': webhook._format_time(1500000000),
+            'current_tags': ['x'], 'brand_id': 3}])
+
+    def test_malformed(self):
+        for body in (b'', b'{"id": 1', b'[1, 2]', b'"id"', b'\xff\xfe',
+                     b'{"detail": [1]}',
+                     json.dumps({'subject': 'no id'}).encode('utf-8'),
+                     json.dumps({'id': 'one'}).encode('utf-8'),
+                     json.dumps({'id': 1, 'created_at': 'Tuesday-ish'})
+                     .encode('utf-8')):
+            (status, _) = self.post(body)
+            self.assertEqual(status, 400, body)
+        self.assertEqual(self.tickets, [])
+
+    def test_too_big(self):
+        payload = _payload(1)
+        payload['subject'] = 'x' * webhook.MAX_PAYLOAD_BYTES
+        self.assertEqual(self.post(payload)[0], 413)
+        self.assertEqual(self.tickets, [])
+
+    def test_wrong_path(self):
+        self.assertEqual(self.post(_payload(1), url=self.url + 'x')[0], 404)
+
+    def test_on_ticket_fails(self):
+        with unittest.mock.patch('logging.exception'):
+            self.assertEqual(self.post(_payload(500))[0], 500)
+        # And we carry on.
+        self.assertEqual(self.post(_payload(1))[0], 200)
+
+
+class SignedTest(MakeServerTest):
+    secret = SECRET
+
+    def post(self, payload, secret=SECRET, timestamp=None, url=None):
+        return super(SignedTest, self).post(payload, secret, timestamp, url)
+
+    def test_bad_signatures(self):
+        for secret in (None, 'not it', SECRET + ' '):
+            self.assertEqual(self.post(_payload(1), secret=secret),
+                             (401, {'error': 'bad signature'}), secret)
+        self.assertEqual(self.tickets, [])
+
+    def test_signature_covers_the_body(self):
+        payload = json.dumps(_payload(1)).encode('utf-8')
+        timestamp = '1500000000'
+        request = urllib.request.Request(
+            self.url, data=payload.replace(b'Help', b'Hack'),
+            headers={'X-Zendesk-Webhook-Signature-Timestamp': timestamp,
+                     'X-Zendesk-Webhook-Signature':
+                     webhook.sign(SECRET, timestamp, payload)})
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            urllib.request.urlopen(request, timeout=10)
+        self.assertEqual(context.exception.code, 401)
+        context.exception.close()
+
+    def test_send_test_tickets(self):
+        with unittest.mock.patch('sys.stdout'):
+            webhook.send_test_tickets(self.url[:-len(webhook.WEBHOOK_PATH)],
+                                      3, secret=SECRET)
+        self.assertEqual(len(self.tickets), 3)
+
+
+class _ExportHandler(util_test._PagesHandler):
+    """Stands in for Zendesk's export API, with the server's tickets all
+    on one page."""
+    def do_GET(self):
+        body = json.dumps({'results': self.server.tickets,
+                           'count': len(self.server.tickets),
+                           'end_time': int(time.time()),
+                           'next_page': None}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class WebhookAndPollTest(util_test.StandInServerTestCase,
+                         _WebhookServerTestCase):
+    """Tickets we hear about from both the webhook and the export are
+    only counted once by each: in the minute history (IN_HISTORY) as
+    soon as we hear of them, and in the baseline (COUNTED) by a poll."""
+    handler_class = _ExportHandler
+    secret = SECRET
+
+    def setUp(self):
+        util_test.StandInServerTestCase.setUp(self)
+        self.export = self.server
+        self.export.tickets = []
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for patcher in (
+                unittest.mock.patch.multiple(
+                    zendesk_reports,
+                    ZENDESK_EXPORT_URL=self.base_url + '/export',
+                    ZENDESK_PASSWORD='password',
+                    ZENDESK_EXPORT_RATE_LIMITER=util.RateLimiter(
+                        1000, burst=1000, name='zendesk'),
+                    MINUTE_HISTORY_FILE=os.path.join(directory, 'minutes'),
+                    TICKET_FILTER=None),
+                unittest.mock.patch('alerts.DISPATCHER.send'),
+                unittest.mock.patch('sys.stdout')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        store = state_store.StateStore(':memory:')
+        self.addCleanup(store.close)
+        self.state = zendesk_reports.load_state(store)
+        self.addCleanup(self.state['history'].close)
+        self.now = int(time.time())
+        # We've polled before, an hour ago.
+        self.state['last_time_t'] = self.now - 3600
+        self.state['history'].advance((self.now - 3600) // 60)
+
+        _WebhookServerTestCase.setUp(self)
+
+    def on_ticket(self, ticket):
+        return zendesk_reports.ingest_webhook_ticket(self.state, ticket)
+
+    def _export_has(self, *ticket_ids):
+        """Have the export give us ticket_ids, created 10 minutes ago."""
+        for ticket_id in ticket_ids:
+            ticket = webhook.parse_ticket(
+                _payload(ticket_id, self.now - 600))
+            self.export.tickets.append(ticket)
+
+    def _history_count(self):
+        return self.state['history'].count(self.now // 60, 24 * 60)
+
+    def _flags(self, ticket_id):
+        return self.state['seen_tickets'].flags(ticket_id)
+
+    def test_webhook_then_poll(self):
+        self.assertEqual(self.post(_payload(1, self.now - 600), SECRET),
+                         (200, {'counted': True}))
+        self.assertEqual(self._flags(1), seen_tickets.IN_HISTORY)
+        self.assertEqual(self._history_count(), 1)
+
+        self._export_has(1, 2)
+        zendesk_reports.poll(self.state)
+        # The poll counted both, but only added 2 to the history.
+        self.assertEqual(self._flags(1),
+                         seen_tickets.IN_HISTORY | seen_tickets.COUNTED)
+        self.assertEqual(self._flags(2),
+                         seen_tickets.IN_HISTORY | seen_tickets.COUNTED)
+        self.assertEqual(self._history_count(), 2)
+
+    def test_poll_then_webhook(self):
+        # A webhook that comes in late, or is sent again.
+        self._export_has(1)
+        zendesk_reports.poll(self.state)
+        self.assertEqual(self.post(_payload(1, self.now - 600), SECRET),
+                         (200, {'counted': False}))
+        self.assertEqual(self._history_count(), 1)
+
+    def test_webhook_twice(self):
+        self.post(_payload(1, self.now - 60), SECRET)
+        self.assertEqual(self.post(_payload(1, self.now - 60), SECRET),
+                         (200, {'counted': False}))
+        self.assertEqual(self._history_count(), 1)
+
+    def test_unwanted_webhook_ticket(self):
+        self.assertEqual(self.post(_payload(1, tags='spam'), SECRET),
+                         (200, {'counted': False}))
+        self.assertEqual(self._flags(1), 0)
+
+    def test_counted_across_saves(self):
+        self.post(_payload(1, self.now - 600), SECRET)
+        zendesk_reports.save_state(self.state)
+        seen = zendesk_reports.load_state(self.state['store'])[
+            'seen_tickets']
+        self.assertEqual(seen.flags(1), seen_tickets.IN_HISTORY)
+
+    def test_unsigned(self):
+        self.assertEqual(self.post(_payload(1))[0], 401)
+        self.assertEqual(self._flags(1), 0)
+        self.assertEqual(self._history_count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
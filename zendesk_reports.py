@@ -9,28 +9,42 @@ page, and then UserVoice, we now use Zendesk:
 Zendesk supports an API for getting all the tickets ever opened, but
 we use the incremental API to get all tickets reported since last time.
 
-In case of sudden surge / decrease in traffic, you can reset the mean using:
-
-  ./sendesk_reports.py --reset_weekend <X1> --reset_weekday <X2>
-
-Where the expected value can be obtained by looking at previous alerts to
-establish a sensible value.
+We compare against a separate mean for each hour of the week, which
+slowly forgets old data (see baseline.py), so it follows sudden surges or
+decreases in traffic on its own without needing to be reset.
 """
 
 import base64
+import concurrent.futures
 import pickle
 import datetime
 import json
 import http.client
 import logging
+import math
+import queue
 import re
 import socket
+import threading
 import time
 import urllib.request
 import urllib.error
 import argparse
 
+import alerts
+import baseline
+import cusum
+import metrics
+import minute_history
+import monitor
+import seen_tickets
+import series_shares
+import sources
+import ticket_batch
+import ticket_filter
+import ticket_summary
 import util
+import webhook
 
 # In theory, you can use an API key to access zendesk data, but I
 # couldn't get it to work in my tests (I got 'access denied'), so we
@@ -47,22 +61,148 @@ SIGNIFICANT_TICKET_COUNT = 5
 # We have a higher ticket boundary for paging someone.
 MIN_TICKET_COUNT_TO_PAGE_SOMEONE = 7
 
-
-def _parse_time(s):
-    """Convert a string of the form "YYYY-MM-DD HH:MM:SS -0700" to time_t.
-
-    We ignore the -0700; it looks like all times (and time_t's!)
-    reported by the API are given as PDT times, so I'm assuming
-    they'll change appropriately when daylight savings time ends.
+# How sure we need to be that the rate is elevated before we tell Slack,
+# and before we page someone.  replay.py can tell you how other values
+# would have done.
+ALERT_PROBABILITY = 0.999
+PAGE_PROBABILITY = 0.9995
+
+# The only ticket fields we look at (besides any our filter config asks
+# for).  Export pages hold up to 1000 full tickets, descriptions and all,
+# so we only keep these while parsing.
+TICKET_FIELDS = ('id', 'subject', 'created_at', 'current_tags', 'brand_id',
+                 'group_id')
+
+# Which tickets we count; see ticket_filter.py.
+TICKET_FILTER = None        # set lazily
+_TICKET_FILTER_LOCK = threading.Lock()
+
+ZENDESK_EXPORT_URL = (
+    'https://khanacademy.zendesk.com/api/v2/exports/tickets.json')
+
+# The incremental export API allows 10 requests a minute.  We stay
+# just under that, and remember how much of it we've used between runs.
+ZENDESK_EXPORT_RATE_LIMITER = util.RateLimiter(
+    9, 60, state_file=util.relative_path("zendesk_rate_limit.json"),
+    name='zendesk')
+
+# Labels we add to all our metrics (see metrics.py), so that they don't
+# clash with github_reports' in the textfile collector.
+METRICS_LABELS = {'script': 'zendesk_reports'}
+
+# Where we used to pickle our state, before we had a state_store.
+OLD_ZENDESK_STATUS_FILE = util.relative_path("zendesk")
+
+# Our state the first time we run.  (The weekday/weekend counters are
+# only still here to seed the hour-of-week baseline from.)
+DEFAULT_STATE = {"elapsed_time_weekday": 0.0001,   # avoid a divide-by-0
+                 "elapsed_time_weekend": 0.0001,   # avoid a divide-by-0
+                 "ticket_count_weekday": 0,
+                 "ticket_count_weekend": 0,
+                 "last_time_t": None,
+                 }
+
+# When we first switch to the hour-of-week baseline, we start each hour
+# off as though we'd watched it for this long at the old weekday/weekend
+# rate, so real data takes over quickly.
+BASELINE_SEED_SECONDS = 3600
+
+# Where we keep per-minute ticket counts for the last few weeks.
+MINUTE_HISTORY_FILE = util.relative_path("zendesk_minutes")
+
+# In an alert, we list tickets grouped by subject (see ticket_summary.py):
+# this many groups at most, with up to this many ticket ids each, and
+# this much of the subject.
+MAX_TICKET_GROUPS_TO_LIST = 10
+MAX_SAMPLE_TICKETS_PER_GROUP = 3
+MAX_SUBJECT_LENGTH = 150
+# What we strip from subjects before we put them in Slack.
+UNSAFE_SUBJECT_CHARS_RE = re.compile(r"[^\w\-\.'%&:,\[\]/\\\(\)\" ]")
+
+# Besides the tickets since our last run, we look at the tickets in these
+# windows (in minutes) of recent history, to catch problems that build up
+# too slowly to stand out in any one run.
+DETECTION_WINDOWS = (5, 15, 60, 240)
+
+# Besides all tickets, we look for surges in each kind of ticket: those
+# with a given value of one of these fields (see series_shares.py).
+# Tickets without one of these (the export may not give us a locale, for
+# instance) just aren't in any series for it.
+DETECTION_DIMENSIONS = ('current_tags', 'group_id', 'brand_id', 'locale')
+# Tags alone could make for thousands of series; we only keep track of
+# this many of the biggest in each dimension.
+MAX_SERIES_PER_DIMENSION = 100
+# The fields we keep in a TicketBatch for that.
+BATCH_FIELDS = tuple(dimension for dimension in DETECTION_DIMENSIONS
+                     if dimension != 'current_tags')
+# We test a lot of series each run, so we need to be surer about any one
+# of them before we say something.
+SERIES_ALERT_PROBABILITY = 0.9999
+
+# We also keep a CUSUM (see cusum.py) for all tickets and for each series,
+# to catch rises too small to stand out in any one run.  For the same
+# reason as above, we need more evidence for a series; since its false
+# alarm rate goes as exp(-threshold), this keeps the false alarm rate
+# across all the series about that of one.
+SERIES_CUSUM_THRESHOLD = cusum.DEFAULT_THRESHOLD + math.log(
+    MAX_SERIES_PER_DIMENSION * len(DETECTION_DIMENSIONS))
+
+# In daemon mode, we can also count tickets as they come in, from
+# webhooks, and check for a surge on every one (alerts.DISPATCHER keeps
+# us from notifying about it every time).  seen_tickets.py keeps us from
+# counting them again when they show up in the export.
+
+# How many export pages we let the fetcher thread get ahead of the
+# filtering.  0 fetches and filters strictly one after the other.
+PREFETCH_PAGES = 2
+
+# On our first run we backfill this many days of history for the mean.
+BACKFILL_DAYS = 7
+
+# When backfilling, we split the range into partitions this long and
+# walk up to BACKFILL_WORKERS of them at once.  They all share the one
+# export quota, so more workers mostly helps hide request latency.
+BACKFILL_PARTITION_SECONDS = 86400
+BACKFILL_WORKERS = 4
+
+
+# Convert a time from the API, like "YYYY-MM-DD HH:MM:SS -0700", to an
+# int time_t.
+_parse_time = ticket_batch.parse_time
+
+
+def get_ticket_filter():
+    """Return our TicketFilter, loading its config the first time.
+
+    Prefetch threads, backfill workers and webhooks all want it, so we
+    make sure they get the same one (else we'd lose some of its hits).
+    """
+    global TICKET_FILTER
+    if TICKET_FILTER is None:
+        with _TICKET_FILTER_LOCK:
+            if TICKET_FILTER is None:
+                TICKET_FILTER = ticket_filter.TicketFilter(
+                    ticket_filter.load_config())
+    return TICKET_FILTER
+
+
+def _ticket_fields():
+    """The ticket fields to keep while parsing export pages."""
+    fields = list(TICKET_FIELDS)
+    for field in get_ticket_filter().fields + DETECTION_DIMENSIONS:
+        if field not in fields:
+            fields.append(field)
+    return fields
+
+
+def get_ticket_data(start_time_t, fields=None):
+    """Given start_time to export from, call Zendesk API for ticket data.
+
+    If fields is given, we stream the page instead of loading it all at
+    once: 'results' is then a generator of tickets with only those
+    fields, and 'next_page' and 'end_time' are only filled in once that
+    generator has been exhausted.
     """
-    # We could use strptime, but this is just as easy.
-    (yyyy, mm, dd, HH, MM, SS) = (int(s[0:4]), int(s[5:7]), int(s[8:10]),
-                                  int(s[11:13]), int(s[14:16]), int(s[17:19]))
-    return time.mktime((yyyy, mm, dd, HH, MM, SS, 0, 0, -1))
-
-
-def get_ticket_data(start_time_t):
-    """Given start_time to export from, call Zendesk API for ticket data."""
     global ZENDESK_PASSWORD
     if ZENDESK_PASSWORD is None:
         with open(ZENDESK_PASSWORD_FILE) as f:
@@ -75,8 +215,7 @@ def get_ticket_data(start_time_t):
     if int(time.time()) - start_time_t <= 300:
         return None
 
-    url = ('https://khanacademy.zendesk.com/api/v2/exports/tickets.json'
-           '?start_time=%s' % start_time_t)
+    url = '%s?start_time=%s' % (ZENDESK_EXPORT_URL, start_time_t)
     request = urllib.request.Request(url)
     # This is the best way to set the user, according to
     #    http://stackoverflow.com/questions/2407126/python-urllib2-basic-auth-problem
@@ -86,71 +225,252 @@ def get_ticket_data(start_time_t):
         'Authorization', 'Basic %s' % encoded_password.decode('utf-8'))
 
     def _should_retry(exc):
-        if isinstance(exc, urllib.error.HTTPError) and exc.code == 429:
-            # quota limits: try again, but wait first.
-            print("Got 429, waiting %s seconds" % exc.headers['Retry-After'])
-            time.sleep(int(exc.headers['Retry-After']))
+        # On a 429 the rate limiter has already read Retry-After, and
+        # will make us wait that long before we try again.
         return isinstance(exc, (socket.error, urllib.error.HTTPError,
                                 http.client.HTTPException))
 
-    data = util.retry(lambda: urllib.request.urlopen(request, timeout=60),
-                      'loading zendesk ticket data',
-                      _should_retry, 15)
+    data = util.retry(
+        lambda: util.urlopen(request, timeout=60,
+                             rate_limiter=ZENDESK_EXPORT_RATE_LIMITER),
+        'loading zendesk ticket data',
+        _should_retry, 15)
 
-    return json.load(data)
+    if fields is None:
+        return json.load(data)
 
+    page = {}
+    page['results'] = util.iter_json_list(data, 'results', fields, page)
+    return page
 
-def get_tickets_between(start_time_t, end_time_t):
-    """Return the number of tickets created between start and end time.
 
-    Also return the time of the oldest ticket seen, as a time_t, which
-    is useful for getting an actual date-range when start_time is 0.
-    """
-    tickets = []
-    oldest_ticket_time_t = None
+def _iter_export_pages(start_time_t, end_time_t):
+    """Yield the tickets on each export page from start_time_t until we
+    pass end_time_t or run out of pages.
 
+    Each page's tickets are a streaming generator, which must be exhausted
+    before asking for the next page (that's when we learn where it starts).
+    """
     while start_time_t < end_time_t:
-        ticket_data = get_ticket_data(start_time_t)
+        ticket_data = get_ticket_data(start_time_t, _ticket_fields())
         if not ticket_data:
             break
 
-        for ticket in ticket_data['results']:
-            # we only care about technical issues
-            if 'technical_issue' not in ticket['current_tags']:
-                continue
+        metrics.inc('beep_boop_pages_fetched_total', source='zendesk')
+        yield ticket_data['results']
 
-            # Ignore translation advocate tickets. They can be used
-            # for testing and don't indicate a user-visible problem.
-            if 'translation_advocate' in ticket['current_tags']:
-                continue
+        if not ticket_data['next_page']:
+            break
+        start_time_t = ticket_data['end_time']
 
-            # We dont care about spam and dont want them to trigger alert
-            if 'spam' in ticket['current_tags']:
-                continue
 
-            # Skip tickets created by user-support, since they are
-            # submitted in batches and cause false alarms
-            if 'Request created from:' in ticket['subject']:
-                continue
+def _iter_prefetched_export_pages(start_time_t, end_time_t, prefetch_pages):
+    """Like _iter_export_pages, but fetch and parse pages on a background
+    thread, up to prefetch_pages ahead of the caller, so the network time
+    for the next page overlaps with filtering this one.
 
-            ticket_time_t = _parse_time(ticket['created_at'])
-            if ticket_time_t > end_time_t or ticket_time_t <= start_time_t:
-                continue
-            tickets += [ticket]
-            # See if we're the oldest ticket
-            if (oldest_ticket_time_t is None or
-                    oldest_ticket_time_t > ticket_time_t):
-                oldest_ticket_time_t = ticket_time_t
+    Each page's tickets come as a list.
+    """
+    pages = queue.Queue(maxsize=prefetch_pages)
+    done = object()
+    stop = threading.Event()
+
+    def _put(item):
+        # Give up if our consumer has gone away, rather than blocking on a
+        # full queue forever.
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-        if not ticket_data['next_page']:
-            break
-        start_time_t = ticket_data['end_time']
+    def _fetch_pages():
+        try:
+            for tickets in _iter_export_pages(start_time_t, end_time_t):
+                if not _put(list(tickets)):
+                    return
+            _put(done)
+        except Exception as why:
+            _put(why)
+
+    # Make our filter (which tells the fetcher what fields to keep) before
+    # the fetcher and we both want it.
+    get_ticket_filter()
+    fetcher = threading.Thread(target=_fetch_pages, name='zendesk-prefetch')
+    fetcher.daemon = True
+    fetcher.start()
+    try:
+        while True:
+            item = pages.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def iter_tickets_between(start_time_t, end_time_t,
+                         prefetch_pages=PREFETCH_PAGES, seen=None):
+    """Yield the tickets we care about created between start and end time.
+
+    Tickets come out one at a time as we stream the export pages, with
+    only the fields we need kept from each.  With prefetch_pages, the next
+    pages are fetched in the background while we filter this one.  If
+    seen (a seen_tickets.SeenTickets) is given, we leave out any tickets
+    it says we've already counted.
+    """
+    if prefetch_pages:
+        pages = _iter_prefetched_export_pages(start_time_t, end_time_t,
+                                              prefetch_pages)
+    else:
+        pages = _iter_export_pages(start_time_t, end_time_t)
 
-    # Sort tickets in order by date to make things easier later
-    tickets = sorted(tickets,
-                     key=lambda ticket: _parse_time(ticket["created_at"]))
+    for tickets in pages:
+        for ticket in tickets:
+            if (_is_wanted_ticket(ticket, start_time_t, end_time_t) and
+                    not (seen is not None and
+                         seen.flags(ticket['id']) & seen_tickets.COUNTED)):
+                yield ticket
 
-    return (tickets, oldest_ticket_time_t)
+
+def _is_wanted_ticket(ticket, start_time_t, end_time_t,
+                      via=ticket_filter.EXPORT):
+    """Return whether ticket is one we count, created in the time range.
+
+    Our filter's hit counts include every ticket we're asked about, even
+    those outside the range, under how we got it (see ticket_filter.py).
+    """
+    if not get_ticket_filter()(ticket, via):
+        return False
+
+    # The export gives us tickets by when they were last updated, so
+    # we may see tickets created before (or after) the range we want.
+    ticket_time_t = _parse_time(ticket['created_at'])
+    if not start_time_t < ticket_time_t <= end_time_t:
+        return False
+
+    return True
+
+
+def _sorted_with_oldest_time(tickets):
+    """Return tickets as a TicketBatch, sorted by creation time, along
+    with the time of the oldest one (or None if there are none)."""
+    batch = ticket_batch.TicketBatch(tickets, BATCH_FIELDS)
+    return (batch, batch.oldest_time)
+
+
+def get_tickets_between(start_time_t, end_time_t,
+                        prefetch_pages=PREFETCH_PAGES, seen=None):
+    """Return the tickets created between start and end time, as a
+    ticket_batch.TicketBatch, except those seen says we've counted
+    already (see iter_tickets_between).
+
+    Also return the time of the oldest ticket seen, as a time_t, which
+    is useful for getting an actual date-range when start_time is 0.
+    """
+    return _sorted_with_oldest_time(
+        iter_tickets_between(start_time_t, end_time_t, prefetch_pages,
+                             seen))
+
+
+def backfill_tickets_between(start_time_t, end_time_t,
+                             partition_seconds=BACKFILL_PARTITION_SECONDS,
+                             workers=BACKFILL_WORKERS, seen=None):
+    """Like get_tickets_between, but for long ranges.
+
+    We split the export's time cursor into partitions and walk them
+    concurrently.  Each walk keeps the tickets created anywhere in the
+    whole range, and the last page of one partition can overlap the next,
+    so we deduplicate by ticket id; the result is the same set of tickets
+    as a single walk from start to end would find.  (Except perhaps for
+    tickets updated since end_time: the last page of a walk runs on past
+    it, and how far depends on where the page started.  We keep those
+    we find, since the next poll, starting at end_time, won't.)
+    """
+    partitions = [(t, min(t + partition_seconds, end_time_t))
+                  for t in range(start_time_t, end_time_t, partition_seconds)]
+
+    def _fetch_partition(partition):
+        (partition_start_time_t, partition_end_time_t) = partition
+        return [ticket
+                for tickets in _iter_export_pages(partition_start_time_t,
+                                                  partition_end_time_t)
+                for ticket in tickets
+                if (_is_wanted_ticket(ticket, start_time_t, end_time_t) and
+                    not (seen is not None and
+                         seen.flags(ticket['id']) & seen_tickets.COUNTED))]
+
+    tickets_by_id = {}
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        for tickets in pool.map(_fetch_partition, partitions):
+            for ticket in tickets:
+                tickets_by_id[ticket['id']] = ticket
+
+    return _sorted_with_oldest_time(tickets_by_id.values())
+
+
+def _format_ticket_time(time_t):
+    return datetime.datetime.fromtimestamp(time_t).strftime("%I:%M %p")
+
+
+def format_ticket_list(tickets):
+    """List tickets (a TicketBatch) for an alert, a line for each group
+    of tickets with much the same subject (see ticket_summary.py),
+    biggest first.
+
+    We list at most MAX_TICKET_GROUPS_TO_LIST groups, so however many
+    tickets there are, the list stays short.
+    """
+    (groups, num_grouped) = ticket_summary.group_subjects(
+        tickets.subjects, MAX_SAMPLE_TICKETS_PER_GROUP)
+    if num_grouped < len(tickets):
+        # We only grouped a sample, so scale up its counts.
+        scale = len(tickets) / float(num_grouped)
+        groups = [(int(round(count * scale)), samples)
+                  for (count, samples) in groups]
+    lines = []
+    for (count, samples) in groups[:MAX_TICKET_GROUPS_TO_LIST]:
+        first = samples[0]
+        # Strip any non-safe characters from the subject line
+        subject = UNSAFE_SUBJECT_CHARS_RE.sub(
+            '', tickets.subjects[first])[:MAX_SUBJECT_LENGTH]
+        if count == 1:
+            lines.append("*[%s][Ticket #%d]:* %s"
+                         % (_format_ticket_time(tickets.times[first]),
+                            tickets.ids[first], subject))
+        else:
+            lines.append("*[%s][%s%s tickets, e.g. %s]:* %s"
+                         % (_format_ticket_time(tickets.times[first]),
+                            '' if num_grouped == len(tickets) else '~',
+                            util.thousand_commas(count),
+                            ', '.join('#%d' % tickets.ids[i]
+                                      for i in samples),
+                            subject))
+    others = groups[MAX_TICKET_GROUPS_TO_LIST:]
+    if others:
+        lines.append("...and %s more tickets in %s other groups."
+                     % (util.thousand_commas(sum(count for (count, _)
+                                                 in others)),
+                        util.thousand_commas(len(others))))
+    if num_grouped < len(tickets):
+        lines.append("(Counts are estimated from %s of the %s tickets.)"
+                     % (util.thousand_commas(num_grouped),
+                        util.thousand_commas(len(tickets))))
+    return ''.join('\n' + line for line in lines)
+
+
+def alert_thresholds(mean):
+    """Return how many tickets it takes, when we expect mean of them, for
+    handle_alerts to alert, and to page someone."""
+    alert_count = max(SIGNIFICANT_TICKET_COUNT,
+                      util.poisson_critical_count(mean, ALERT_PROBABILITY))
+    page_count = max(alert_count, MIN_TICKET_COUNT_TO_PAGE_SOMEONE,
+                     util.poisson_critical_count(mean, PAGE_PROBABILITY))
+    return (alert_count, page_count)
 
 
 def handle_alerts(new_tickets,
@@ -163,13 +483,16 @@ def handle_alerts(new_tickets,
 
     If probability of elevated ticket count is high, a notification
     is sent to Slack. A Pagerduty alert is only sent out
-    if a significantly elevated rate is detected.
+    if a significantly elevated rate is detected.  (We decide both by
+    comparing the count of new_tickets, a TicketBatch, against
+    alert_thresholds.)
     """
     # TODO(jacqueline): Including SIGNIFICANT_TICKET_COUNT hard
     # threshold here so as to catch false positives, especially during
     # transition. Maybe consider removing this once change in mean
     # starts flattening out; August 2017?
     num_new_tickets = len(new_tickets)
+    (alert_count, page_count) = alert_thresholds(mean)
     message = (
         "We saw %s in the last %s minutes,"
         " while the mean indicates we should see around %s."
@@ -179,59 +502,231 @@ def handle_alerts(new_tickets,
            util.thousand_commas(round(mean, 2)),
            probability))
 
-    if (mean != 0 and probability > 0.999 and
-            num_new_tickets >= SIGNIFICANT_TICKET_COUNT):
+    if mean != 0 and num_new_tickets >= alert_count:
         # Too many errors!  Point people to the slack channel.
         message = ("Elevated Zendesk report rate (#zendesk-technical)\n"
                    + message)
 
         # Generated a list of tickets that we will send to Slack along with the
         # original message
-        ticket_list = ''
-        for ticket in new_tickets:
-            created_at = _parse_time(ticket['created_at'])
-            created_at = datetime.datetime.fromtimestamp(created_at)
-            ticket_list += "\n*[%s][Ticket #%d]:* %s" % (
-                created_at.strftime("%I:%M %p"),
-                ticket['id'],
-                # Strip any non-safe characters from the subject line
-                re.sub(r"[^\w\-\.'%&:,\[\]/\\\(\)\" ]", '', ticket['subject']))
+        ticket_list = format_ticket_list(new_tickets)
+
+        if num_new_tickets < page_count:
+            page_note = ("\n(%s more and we'd page someone.)"
+                         % util.thousand_commas(page_count - num_new_tickets))
+        else:
+            page_note = ''
 
         logging.warning("Sending message: {}".format(message))
         # TODO (Boris, INFRA-4451): Re-evaluate if we want to alert the team
         #    We will still send to slack, and create pager duty if number
         #    of tickets are *abnormally* high
-        util.send_to_slack(message + ticket_list,
-                           channel='#infrastructure-sre')
         # TODO (Boris, INFRA-4451) At Laurie's request
         # https://khanacademy.slack.com/archives/C8XGW76FQ/p1585321100055200?thread_ts=1585320913.054500&cid=C8XGW76FQ
         # we have allowed noisy alerts to go to #user-issues
         # we should restore this back to list below once we have confidence.
-        util.send_to_slack(message + ticket_list, channel='#user-issues')
+        alerts.DISPATCHER.send(
+            'zendesk', message + page_note + ticket_list,
+            slack_channels=['#infrastructure-sre', '#user-issues'])
 
         # Before we start texting people, make sure we've hit higher threshold.
         # TODO(benkraft/jacqueline): Potentially could base this off more
         # historical data from analogous dow/time datapoints, but doesn't look
         # like Zendesk API has a good way of doing this, running into request
         # quota issues. Readdress this option if threshold is too noisy.
-        if (probability > 0.9995 and
-                num_new_tickets >= MIN_TICKET_COUNT_TO_PAGE_SOMEONE):
-            util.send_to_slack(message + ticket_list, channel='#1s-and-0s')
-            util.send_to_pagerduty(message, service='beep-boop')
+        if num_new_tickets >= page_count:
+            alerts.DISPATCHER.send('zendesk', message + ticket_list,
+                                   slack_channels=['#1s-and-0s'])
+            alerts.DISPATCHER.send('zendesk', message,
+                                   pagerduty_services=['beep-boop'])
+
+
+def score_windows(history, end_time, ticket_baseline):
+    """Score the last DETECTION_WINDOWS of history against the baseline.
+
+    Returns a list of (window minutes, tickets, mean, probability), for
+    the windows we have full history for.
+    """
+    end_minute = end_time // 60
+    windows = [window for window in DETECTION_WINDOWS
+               if history.covered_minutes(end_minute, window) == window]
+    counts = [history.count(end_minute, window) for window in windows]
+    past_totals = [ticket_baseline.past_totals(end_time - window * 60,
+                                               end_time)
+                   for window in windows]
+    (means, probabilities) = util.probabilities(
+        [past_tickets for (past_tickets, _) in past_totals],
+        [past_time for (_, past_time) in past_totals],
+        counts,
+        [window * 60 for window in windows])
+    return list(zip(windows, counts, means, probabilities))
+
+
+def handle_window_alerts(window_scores, time_this_period):
+    """Send a notification if any window longer than this run's period
+    has an elevated ticket rate.
+
+    Shorter windows are covered by handle_alerts.  We only notify Slack:
+    a slow-burn problem isn't worth waking someone up for.  Returns
+    whether we found one (even if the dispatcher held back the
+    notification, because we sent one recently).
+    """
+    elevated = [(probability, window, count, mean)
+                for (window, count, mean, probability) in window_scores
+                if (window * 60 > time_this_period and mean != 0 and
+                    probability > ALERT_PROBABILITY and
+                    count >= SIGNIFICANT_TICKET_COUNT)]
+    if not elevated:
+        return False
+
+    (probability, window, count, mean) = max(elevated)
+    message = (
+        "Slowly elevated Zendesk report rate (#zendesk-technical)\n"
+        "We saw %s in the last %s minutes,"
+        " while the mean indicates we should see around %s."
+        " *Probability that this is abnormally elevated: %.4f.*"
+        % (util.thousand_commas(count),
+           util.thousand_commas(window),
+           util.thousand_commas(round(mean, 2)),
+           probability))
+    logging.warning("Sending message: {}".format(message))
+    alerts.DISPATCHER.send('zendesk-window', message,
+                           slack_channels=['#infrastructure-sre'])
+    return True
+
+
+def _ignored_series():
+    """Series that every ticket we count is in, and so are no different
+    from all tickets."""
+    return [('current_tags', tag) for tag in get_ticket_filter().required_tags]
+
+
+def score_series(series_counts, shares, ticket_baseline,
+                 start_time, end_time):
+    """Score the tickets in each series between start and end time, as
+    counted by TicketBatch.count_series, against its share of the
+    baseline.
+
+    Returns a list of (series, tickets, mean, probability), for the
+    series we know a share for.
+    """
+    (past_tickets, past_time) = ticket_baseline.past_totals(start_time,
+                                                            end_time)
+    series = []
+    counts = []
+    past_series_tickets = []
+    for (one_series, count) in series_counts.items():
+        share = shares.share(one_series)
+        if share:
+            series.append(one_series)
+            counts.append(count)
+            past_series_tickets.append(past_tickets * share)
+    (means, probabilities) = util.probabilities(
+        past_series_tickets, past_time, counts, end_time - start_time)
+    return list(zip(series, counts, means, probabilities))
+
+
+def handle_series_alerts(series_scores, time_this_period):
+    """Send a notification naming each series with an elevated ticket
+    rate, if there are any.
+
+    Like handle_window_alerts, we only notify Slack.  Returns whether
+    there were any.
+    """
+    elevated = sorted(
+        [(probability, series, count, mean)
+         for (series, count, mean, probability) in series_scores
+         if (mean != 0 and probability > SERIES_ALERT_PROBABILITY and
+             count >= SIGNIFICANT_TICKET_COUNT)],
+        reverse=True)
+    if not elevated:
+        return False
+
+    message = ("Elevated Zendesk report rate for some kinds of tickets"
+               " (#zendesk-technical)\n"
+               "In the last %s minutes:"
+               % util.thousand_commas(int(time_this_period / 60)))
+    for (probability, (dimension, value), count, mean) in elevated:
+        message += (
+            "\n*%s %s:* we saw %s, while the mean indicates we should"
+            " see around %s.  Probability that this is abnormally"
+            " elevated: %.4f."
+            % (dimension, value, util.thousand_commas(count),
+               util.thousand_commas(round(mean, 2)), probability))
+    logging.warning("Sending message: {}".format(message))
+    alerts.DISPATCHER.send('zendesk-series', message,
+                           slack_channels=['#infrastructure-sre'])
+    return True
+
+
+def update_cusums(detector, num_new_tickets, mean, series_counts, shares,
+                  start_time):
+    """Add this run's tickets to the CUSUMs for all tickets and for each
+    series we know a share for.
+
+    mean is how many tickets we expected in all.  Returns a list of
+    (series, or None for all tickets, tickets, expected tickets, since
+    time_t) for each CUSUM that passed its threshold.
+    """
+    alarms = []
+    keys = [series_shares.TOTAL_KEY]
+    if mean:
+        alarm = detector.update(series_shares.TOTAL_KEY, num_new_tickets,
+                                mean, start_time)
+        if alarm:
+            alarms.append((None,) + alarm)
+    for one_series in shares.all_series():
+        share = shares.share(one_series)
+        key = series_shares.series_key(*one_series)
+        keys.append(key)
+        if mean and share:
+            alarm = detector.update(key, series_counts.get(one_series, 0),
+                                    mean * share, start_time,
+                                    SERIES_CUSUM_THRESHOLD)
+            if alarm:
+                alarms.append((one_series,) + alarm)
+    detector.retain(keys)
+    return alarms
+
+
+def handle_cusum_alerts(cusum_alarms, end_time):
+    """Send a notification about everything whose CUSUM says its rate has
+    gone up, if there's anything.
+
+    Like handle_window_alerts, we only notify Slack.  Returns whether
+    there was anything.
+    """
+    if not cusum_alarms:
+        return False
+
+    message = "Steadily elevated Zendesk report rate (#zendesk-technical)"
+    for (one_series, tickets, expected, since) in cusum_alarms:
+        if one_series is None:
+            name = 'All tickets'
+        else:
+            name = '%s %s' % one_series
+        message += (
+            "\n*%s:* we saw %s in the last %s minutes,"
+            " while the mean indicates we should see around %s."
+            % (name, util.thousand_commas(tickets),
+               util.thousand_commas(int((end_time - since) / 60)),
+               util.thousand_commas(round(expected, 2))))
+    logging.warning("Sending message: {}".format(message))
+    alerts.DISPATCHER.send('zendesk-cusum', message,
+                           slack_channels=['#infrastructure-sre'])
+    return True
 
 
 def _is_off_hours(dt):
     """Returns whether we consider this time to be "off hours".
 
-    We consider weekends and evenings to be off-hours, and track separate
-    metrics for them, so that we aren't oversensitive during the weekday and
-    undersensitive otherwise.
+    We used to consider weekends and evenings to be off-hours, and track
+    separate metrics for them, so that we weren't oversensitive during the
+    weekday and undersensitive otherwise.  Now we have a baseline for each
+    hour of the week, and only use this to seed that from the old metrics.
 
     Arguments: dt should be a datetime.datetime object, in Pacific Time (PDT or
     PST, whichever is currently active).
-
-    TODO(benkraft): Something smarter and more adaptive to what the real data
-    looks like.
     """
     if dt.weekday() in [5, 6]:
         return True
@@ -244,42 +739,227 @@ def _is_off_hours(dt):
         return True
 
 
-def main():
-    try:
-        zendesk_status_file = util.relative_path("zendesk")
-        with open(zendesk_status_file, 'rb') as f:
-            old_data = pickle.load(f)
-    except (IOError, EOFError):
-        old_data = {"elapsed_time_weekday": 0.0001,   # avoid a divide-by-0
-                    "elapsed_time_weekend": 0.0001,   # avoid a divide-by-0
-                    "ticket_count_weekday": 0,
-                    "ticket_count_weekend": 0,
-                    "last_time_t": None,
-                    "last_time_t_weekday": None,
-                    "last_time_t_weekend": None,
-                    }
+def _load_state(store):
+    """Return our saved state from store.
+
+    The first time, we import it from the pickle file we used to keep.
+    """
+    data = store.get_all('zendesk')
+    if not data:
+        try:
+            with open(OLD_ZENDESK_STATUS_FILE, 'rb') as f:
+                data = pickle.load(f)
+            store.update('zendesk', data)
+        except (IOError, EOFError):
+            pass
+    return dict(DEFAULT_STATE, **data)
+
+
+def _load_baseline(store, data):
+    """Return our hour-of-week baseline from store.
+
+    The first time, we seed it from the old weekday/weekend counters in
+    data, if we have any.
+    """
+    ticket_baseline = baseline.HourOfWeekBaseline(
+        store.get_all('zendesk_baseline'))
+    if (ticket_baseline.is_empty() and
+            data['elapsed_time_weekday'] > 1 and
+            data['elapsed_time_weekend'] > 1):
+        on_hours_rate = (data['ticket_count_weekday'] * 1.0 /
+                         data['elapsed_time_weekday'])
+        off_hours_rate = (data['ticket_count_weekend'] * 1.0 /
+                          data['elapsed_time_weekend'])
+        # A Monday, from which we count hours of the week.
+        monday = datetime.datetime(2017, 1, 2)
+
+        def _old_rate(hour):
+            if _is_off_hours(monday + datetime.timedelta(hours=hour)):
+                return off_hours_rate
+            return on_hours_rate
+
+        ticket_baseline.seed(_old_rate, BASELINE_SEED_SECONDS, time.time())
+    return ticket_baseline
+
+
+def _save_baseline(store, ticket_baseline):
+    """Save the hours of ticket_baseline that have changed."""
+    store.update('zendesk_baseline',
+                 ticket_baseline.to_state(ticket_baseline.dirty))
+    ticket_baseline.dirty.clear()
+
+
+def _save_series_shares(store, shares):
+    """Save the series in shares that have changed, or been evicted."""
+    store.update('zendesk_series', shares.to_state(shares.dirty))
+    store.delete('zendesk_series', shares.evicted)
+    shares.dirty.clear()
+    shares.evicted.clear()
+
+
+def _save_cusum(store, detector):
+    """Save the CUSUMs that have changed, deleting those back at 0."""
+    values = detector.to_state(detector.dirty)
+    store.update('zendesk_cusum', values)
+    store.delete('zendesk_cusum', detector.dirty - set(values))
+    detector.dirty.clear()
+
+
+def _take_seen_ticket_changes(seen):
+    """Return the buckets of seen that have changed, and the hours of
+    those that have been forgotten, as of now, for _save_seen_tickets."""
+    changes = (seen.to_state(seen.dirty),
+               [str(hour) for hour in seen.evicted])
+    seen.dirty.clear()
+    seen.evicted.clear()
+    return changes
+
+
+def _save_seen_tickets(store, changes):
+    """Save changes from _take_seen_ticket_changes."""
+    (values, evicted) = changes
+    store.update('zendesk_seen', values)
+    store.delete('zendesk_seen', evicted)
+
+
+def _record_history(state, new_tickets, start_time, end_time):
+    """Add the tickets we got from the export to the minute history."""
+    history = state['history']
+    seen = state['seen_tickets']
+    with state['lock']:
+        # The history is saved as soon as we write to it, so if we crashed
+        # since we last saved our state we may be seeing some tickets
+        # again.  Its mark says how far we'd got; don't count those twice.
+        export_minute = history.mark
+        refetching = (start_time is not None and export_minute is not None
+                      and start_time // 60 < export_minute)
+        for (ticket_id, created_time_t) in zip(new_tickets.ids,
+                                               new_tickets.times):
+            minute = created_time_t // 60
+            if refetching and minute <= export_minute:
+                continue
+            if seen.flags(ticket_id) & seen_tickets.IN_HISTORY:
+                continue    # we already counted it when it came in
+            history.add(minute)
+            seen.add(ticket_id, created_time_t, seen_tickets.IN_HISTORY)
+        history.advance(end_time // 60)
+        history.mark = end_time // 60
+
+
+def ingest_webhook_ticket(state, ticket):
+    """Count a ticket we heard about from a webhook, and check right away
+    whether we're seeing a surge.  Returns whether we counted it."""
+    now = int(time.time())
+    # Allow for a little clock skew between us and Zendesk.
+    if not _is_wanted_ticket(ticket, 0, now + 60, ticket_filter.WEBHOOK):
+        return False
+
+    with state['lock']:
+        seen = state['seen_tickets']
+        if seen.flags(ticket['id']):
+            return False
+        created_time_t = _parse_time(ticket['created_at'])
+        if not state['history'].add(int(created_time_t) // 60):
+            return False
+        seen.add(ticket['id'], created_time_t, seen_tickets.IN_HISTORY)
+
+        window_scores = score_windows(state['history'], now,
+                                      state['baseline'])
+    # Not under the lock: alerting takes the store's lock, and save_state
+    # takes ours inside that.
+    handle_window_alerts(window_scores, 0)
+    return True
+
+
+def load_state(store, backfill_days=BACKFILL_DAYS):
+    """Load everything we keep between polls from store, as a dict.
+
+    We remember which tickets we've counted for as far back as a backfill
+    of backfill_days reaches, so that we never count them again.
+    """
+    data = _load_state(store)
+    alerts.DISPATCHER.set_store(store)
+    return {
+        'store': store,
+        'last_time_t': data['last_time_t'],
+        'baseline': _load_baseline(store, data),
+        'series_shares': series_shares.SeriesShares(
+            store.get_all('zendesk_series'), MAX_SERIES_PER_DIMENSION),
+        'cusum': cusum.PoissonCusum(store.get_all('zendesk_cusum')),
+        'history': minute_history.MinuteHistory(MINUTE_HISTORY_FILE),
+        'seen_tickets': seen_tickets.SeenTickets(
+            seen_tickets.horizon_hours_for(backfill_days),
+            store.get_all('zendesk_seen')),
+        # Webhooks come in on other threads; this protects the history
+        # and seen_tickets.
+        'lock': threading.Lock(),
+    }
+
+
+def save_state(state):
+    """Save what poll() has changed in state since we last saved."""
+    store = state['store']
+    # Webhook threads take our lock and then, to alert, the store's; so we
+    # mustn't wait for ours while we hold the store's.
+    with state['lock']:
+        seen_changes = _take_seen_ticket_changes(state['seen_tickets'])
+    with metrics.timed('zendesk_save'), store.transaction():
+        _save_baseline(store, state['baseline'])
+        _save_series_shares(store, state['series_shares'])
+        _save_cusum(store, state['cusum'])
+        _save_seen_tickets(store, seen_changes)
+        store.update('zendesk', {'last_time_t': state['last_time_t']})
+    state['history'].flush()
+    ZENDESK_EXPORT_RATE_LIMITER.save()
+
+
+def poll(state, backfill_days=BACKFILL_DAYS):
+    """Look for tickets since we last polled, and alert if there are too
+    many.  We update state in memory; use save_state to save it."""
+    ticket_baseline = state['baseline']
+    history = state['history']
 
     # We compare the number of tickets in the last few minutes against
-    # the historical average for all time.  But we don't start "all
-    # time" at AD 1, we start it a week ago.  Longer than that and it
-    # takes forever due to quota issues.  That's still plenty of
-    # historical data. :-)
+    # the historical average for those hours of the week.  The first
+    # time, we build that from the last backfill_days (by default a
+    # week).  We fetch that backfill in parallel partitions, but longer
+    # than a few months still takes forever due to quota issues.  A week
+    # is still plenty of historical data to start with. :-)
     #
     # Zendesk seems to wait 5 minutes to update API data :-(, so we
     # ask for data that's a bit time-lagged
     end_time = int(time.time()) - 300
-    start_time = old_data['last_time_t']
+    start_time = state['last_time_t']
     print("start_time: %s, end_time: %s" % (start_time, end_time))
 
-    # Set flag to track if current time period is a weekend. Separate
-    # ticket_count/elapsed_time stats are kept for weekend vs. weekday
-    # to improve sensitivity to increases during low-traffic periods
-    is_off_hours = _is_off_hours(datetime.datetime.fromtimestamp(end_time))
-
-    (new_tickets, oldest_ticket_time_t) = get_tickets_between(
-        start_time or (end_time - 86400 * 7), end_time)
+    with metrics.timed('zendesk_fetch'):
+        if start_time is None:
+            (new_tickets, oldest_ticket_time_t) = backfill_tickets_between(
+                end_time - 86400 * backfill_days, end_time,
+                seen=state['seen_tickets'])
+        else:
+            (new_tickets, oldest_ticket_time_t) = get_tickets_between(
+                start_time, end_time, seen=state['seen_tickets'])
     num_new_tickets = len(new_tickets)
 
+    filter_hits = get_ticket_filter().take_hits(ticket_filter.EXPORT)
+    metrics.inc('beep_boop_tickets_fetched_total', sum(filter_hits.values()),
+                source='zendesk')
+    for (rule, count) in filter_hits.items():
+        metrics.inc('beep_boop_tickets_filtered_total', count, rule=rule,
+                    via=ticket_filter.EXPORT)
+    # Webhook tickets weren't fetched, so they only count here.
+    for (rule, count) in get_ticket_filter().take_hits(
+            ticket_filter.WEBHOOK).items():
+        metrics.inc('beep_boop_tickets_filtered_total', count, rule=rule,
+                    via=ticket_filter.WEBHOOK)
+    print("%s] FILTER: %s"
+          % (time.strftime("%Y-%m-%d %H:%M:%S %Z"),
+             ', '.join('%s: %s' % (rule, count)
+                       for (rule, count) in sorted(filter_hits.items()))))
+
+    _record_history(state, new_tickets, start_time, end_time)
+
     # The first time we run this, we take the starting time to be the
     # time of the first bug report.
 
@@ -288,99 +968,159 @@ def main():
 
     time_this_period = end_time - start_time
 
-    if is_off_hours:
-        # To simplify backcompat we still use "weekend" and "weekday" in the
-        # saved data; really they mean "on hours" and "off hours" now.
-        ticket_count = old_data['ticket_count_weekend']
-        elapsed_time = old_data['elapsed_time_weekend']
-    else:
-        ticket_count = old_data['ticket_count_weekday']
-        elapsed_time = old_data['elapsed_time_weekday']
-
-    (mean, probability) = util.probability(ticket_count,
-                                           elapsed_time,
-                                           num_new_tickets,
-                                           time_this_period)
-
-    print("%s] TOTAL %s/%ss; %s-: %s/%ss; m=%.3f p=%.3f"
-          % (time.strftime("%Y-%m-%d %H:%M:%S %Z"),
-             ticket_count, int(elapsed_time),
-             start_time,
-             num_new_tickets, time_this_period,
-             mean, probability))
-
-    handle_alerts(new_tickets, time_this_period, mean, probability,
-                  start_time, end_time)
-
-    if is_off_hours:
-        new_data = {"elapsed_time_weekend": (
-            old_data["elapsed_time_weekend"] + time_this_period),
-            "ticket_count_weekend": (
-            old_data["ticket_count_weekend"] + num_new_tickets),
-            "elapsed_time_weekday": old_data["elapsed_time_weekday"],
-            "ticket_count_weekday": old_data["ticket_count_weekday"],
-        }
-    else:
-        new_data = {"elapsed_time_weekend": old_data["elapsed_time_weekend"],
-                    "ticket_count_weekend": old_data["ticket_count_weekend"],
-                    "elapsed_time_weekday": (
-                        old_data["elapsed_time_weekday"] + time_this_period),
-                    "ticket_count_weekday": (
-                        old_data["ticket_count_weekday"] + num_new_tickets),
-                    }
-
-    new_data['last_time_t'] = end_time
-
-    with open(zendesk_status_file, 'wb') as f:
-        pickle.dump(new_data, f)
-
-
-def reset_mean(weekday_mean=None, weekend_mean=None):
-    zendesk_status_file = util.relative_path("zendesk")
-    try:
-        with open(zendesk_status_file) as f:
-            data = pickle.load(f)
-    except (IOError, EOFError):
-        data = {"elapsed_time_weekday": 0.0001,   # avoid a divide-by-0
-                "elapsed_time_weekend": 0.0001,   # avoid a divide-by-0
-                "ticket_count_weekday": 0,
-                "ticket_count_weekend": 0,
-                "last_time_t": None,
-                "last_time_t_weekday": None,
-                "last_time_t_weekend": None,
-                }
-
-    if weekday_mean is not None:
-        # Note: on python 2.7
-        print("Resetting from weekday from {} to {}".format(
-            1.0 * data['ticket_count_weekday'] / data['elapsed_time_weekday'],
-            weekday_mean
-        ))
-        data['ticket_count_weekday'] = weekday_mean * \
-            data['elapsed_time_weekday']
-
-    if weekend_mean is not None:
-        print("Resetting from weekend from {} to {}".format(
-            1.0 * data['ticket_count_weekend'] / data['elapsed_time_weekend'],
-            weekend_mean
-        ))
-        data['ticket_count_weekend'] = weekend_mean * \
-            data['elapsed_time_weekend']
-
-    with open(zendesk_status_file, 'w') as f:
-        pickle.dump(data, f)
+    with metrics.timed('zendesk_detect'):
+        (mean, probability) = util.probability(
+            *ticket_baseline.past_totals(start_time, end_time),
+            errors_this_period=num_new_tickets,
+            time_this_period=time_this_period)
+
+        hour = baseline.hour_of_week(end_time)
+        (alert_count, page_count) = alert_thresholds(mean)
+        print("%s] HOUR %s: %.3f/%ss; %s-: %s/%ss; m=%.3f p=%.3f;"
+              " alert at %s, page at %s"
+              % (time.strftime("%Y-%m-%d %H:%M:%S %Z"),
+                 hour, ticket_baseline.buckets[hour][0],
+                 int(ticket_baseline.buckets[hour][1]),
+                 start_time,
+                 num_new_tickets, time_this_period,
+                 mean, probability, alert_count, page_count))
+
+        handle_alerts(new_tickets, time_this_period, mean, probability,
+                      start_time, end_time)
+
+        window_scores = score_windows(history, end_time, ticket_baseline)
+        for (window, count, window_mean, window_probability) in window_scores:
+            print("%s] %s-minute window: %s; m=%.3f p=%.3f"
+                  % (time.strftime("%Y-%m-%d %H:%M:%S %Z"), window, count,
+                     window_mean, window_probability))
+        handle_window_alerts(window_scores, time_this_period)
+
+        series_counts = new_tickets.count_series(DETECTION_DIMENSIONS,
+                                                 _ignored_series())
+        series_scores = score_series(series_counts, state['series_shares'],
+                                     ticket_baseline, start_time, end_time)
+        handle_series_alerts(series_scores, time_this_period)
+
+        # A backfill isn't a run like the others, so it's no evidence of a
+        # rise or otherwise.
+        if state['last_time_t'] is not None:
+            cusum_alarms = update_cusums(state['cusum'], num_new_tickets, mean,
+                                         series_counts, state['series_shares'],
+                                         start_time)
+            handle_cusum_alerts(cusum_alarms, end_time)
+
+    with metrics.timed('zendesk_learn'):
+        ticket_baseline.observe(start_time, end_time, new_tickets.times)
+        state['series_shares'].observe(num_new_tickets, series_counts,
+                                       end_time)
+        with state['lock']:
+            for (ticket_id, created_time_t) in zip(new_tickets.ids,
+                                                   new_tickets.times):
+                state['seen_tickets'].add(ticket_id, created_time_t,
+                                          seen_tickets.COUNTED)
+    state['last_time_t'] = end_time
+    metrics.set_gauge('beep_boop_last_poll_timestamp_seconds', time.time(),
+                      source='zendesk')
+
+
+class ZendeskSource(sources.Source):
+    """Zendesk, for monitor.py.
+
+    We don't just count tickets, so this isn't a CountingSource: we look
+    for surges against an hour-of-week baseline, in several windows, and
+    in each series (see poll).  If webhook_port is given, we also listen
+    there for new-ticket webhooks from Zendesk (see webhook.py).
+    """
+    name = 'zendesk'
+    poll_interval = 60
+
+    def __init__(self, store, backfill_days=BACKFILL_DAYS,
+                 webhook_port=None):
+        super(ZendeskSource, self).__init__(store)
+        self.backfill_days = backfill_days
+        self.state = load_state(store, backfill_days)
+        self.server = None
+        if webhook_port:
+            self.server = webhook.make_server(
+                lambda ticket: ingest_webhook_ticket(self.state, ticket),
+                webhook_port, secret=webhook.load_secret())
+            webhook.serve_in_background(self.server)
+
+    def poll(self):
+        poll(self.state, self.backfill_days)
+
+    def save(self):
+        save_state(self.state)
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+        self.state['history'].close()
+
+
+def main(backfill_days=BACKFILL_DAYS, metrics_file=None):
+    monitor.main(['zendesk'], {'zendesk': {'backfill_days': backfill_days}},
+                 metrics_file, METRICS_LABELS)
+
+
+def run_daemon(poll_interval, checkpoint_interval,
+               github_poll_interval=None, backfill_days=BACKFILL_DAYS,
+               webhook_port=None, metrics_file=None, metrics_port=None):
+    """Poll Zendesk every poll_interval seconds (and GitHub every
+    github_poll_interval seconds, if given) until we get a SIGTERM; see
+    monitor.run_daemon.
+
+    If webhook_port is given, we also listen there for new-ticket
+    webhooks from Zendesk (see webhook.py).
+    """
+    intervals = {'zendesk': poll_interval}
+    if github_poll_interval:
+        intervals['github'] = github_poll_interval
+    monitor.run_daemon(
+        intervals, checkpoint_interval,
+        {'zendesk': {'backfill_days': backfill_days,
+                     'webhook_port': webhook_port}},
+        metrics_file, metrics_port, METRICS_LABELS)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Script to predict abnormal zendesk alerts.'
     )
-    parser.add_argument('--reset_weekday', type=int,
-                        help='Hard reset weekday mean to expected value.')
-    parser.add_argument('--reset_weekend', type=int,
-                        help='Hard reset weekend mean to expected value.')
+    parser.add_argument('--backfill_days', type=int, default=BACKFILL_DAYS,
+                        help=('How many days of history to backfill when '
+                              'we have no saved state.'))
+    parser.add_argument('--daemon', action='store_true',
+                        help=('Keep running, polling every --poll_interval '
+                              'seconds, instead of polling once.'))
+    parser.add_argument('--poll_interval', type=int, default=60,
+                        help='In daemon mode, seconds between polls.')
+    parser.add_argument('--checkpoint_interval', type=int, default=600,
+                        help='In daemon mode, seconds between state saves.')
+    parser.add_argument('--github_poll_interval', type=int,
+                        help=('In daemon mode, also poll GitHub every this '
+                              'many seconds.'))
+    parser.add_argument('--webhook_port', type=int,
+                        help=('In daemon mode, also listen for Zendesk '
+                              'new-ticket webhooks on this port.'))
+    parser.add_argument('--record_dir',
+                        help=('Save everything the APIs send us in this '
+                              'directory, for replay.py.'))
+    parser.add_argument('--metrics_file',
+                        help=('Write our metrics to this file, for the '
+                              'Prometheus textfile collector, after each '
+                              'run (in daemon mode, each state save).'))
+    parser.add_argument('--metrics_port', type=int,
+                        help=('In daemon mode, serve our metrics for '
+                              'Prometheus at /metrics on this port.'))
     args = parser.parse_args()
-    if (args.reset_weekday is not None) or (args.reset_weekend is not None):
-        reset_mean(args.reset_weekday, args.reset_weekend)
 
-    main()
+    if args.record_dir:
+        util.record_responses(args.record_dir)
+
+    if args.daemon:
+        run_daemon(args.poll_interval, args.checkpoint_interval,
+                   args.github_poll_interval, args.backfill_days,
+                   args.webhook_port, args.metrics_file, args.metrics_port)
+    else:
+        main(args.backfill_days, args.metrics_file)